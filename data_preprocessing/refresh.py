@@ -0,0 +1,25 @@
+# %%
+import sys
+
+# Allow importing the shared philly_house_predictor package from the repository root
+sys.path.append('..')
+from philly_house_predictor.incremental import refresh
+
+# Applies a new monthly OPA snapshot to the artifacts of the last full run of preprocessing.py: only the added / changed parcels
+# (by parcel_number) are preprocessed, encoded and scaled with the transforms fitted by that run, and replace their old rows.
+# Re-run preprocessing.py instead to refit the encoder, the winsorize caps and the scaler on the new snapshot.
+NEW_SNAPSHOT = sys.argv[1] if len(sys.argv) > 1 else '../data_collection/opa_properties_public.csv'
+# Stop before writing anything when the snapshot drifted from the one the transforms were fitted on (a DriftError with the report),
+# instead of only reporting the drifted columns. See philly_house_predictor/drift.py
+CHECK_DRIFT = False
+
+summary = refresh(NEW_SNAPSHOT, check_drift=CHECK_DRIFT)
+print(f"{summary['added_or_changed']} added or changed and {summary['removed']} removed parcels out of {summary['snapshot_rows']}, "
+      f"{summary['kept_after_filters']} new training rows")
+print(summary['seconds'])
+if summary['removed_artifacts']:
+    print(f"Removed {summary['removed_artifacts']}, re-run feature_selection.py to write them again")
+if summary['drift_report'] is not None:
+    print(summary['drift_report'].round(4).to_string())
+    if summary['drifted_columns']:
+        print(f"Drifted from the training snapshot: {summary['drifted_columns']}, consider re-running preprocessing.py")
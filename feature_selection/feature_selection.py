@@ -1,33 +1,37 @@
 # %%
-import pandas as pd
-from sklearn.decomposition import PCA
+import sys
 
-df = pd.read_csv('scaled.csv')
-df = df.drop(columns='Unnamed: 0') # This was an index column generated by accident
-df.corrwith(df['market_value_capped']).to_csv('all_corrs.csv', header=True)
+# Allow importing the shared philly_house_predictor package from the repository root
+sys.path.append('..')
+from philly_house_predictor.artifacts import read_artifact
+from philly_house_predictor.workflow import TARGET, select_features
 
-correlations = df.corrwith(df['market_value_capped'])
+# The feature selection itself lives in philly_house_predictor/workflow.py, which `python -m philly_house_predictor select-features`
+# runs as well, so this notebook and the command line interface never drift apart.
 
-correlations = correlations.sort_values()
+# Fit an IncrementalPCA over batches of the scaled artifact instead of loading it, for datasets larger than memory
+# such as the whole city inventory. The in-memory path fits the exact PCA.
+OUT_OF_CORE = False
 
-# Select TOP 10 Positive Features
-top_10_features = correlations.tail(11) # Includes market_value_capped which we will exclude
-print(top_10_features)
+# Correlations of every feature of the scaled artifact (written by data_preprocessing/preprocessing.py) with market_value_capped and
+# with each other, computed in one streaming pass (see philly_house_predictor/feature_ranking.py) and cached until the artifact changes.
+# The TOP_K features most correlated with market_value_capped are selected, new encoded columns are ranked without editing anything.
+TOP_K = 10
+# Skip a feature whose absolute correlation with an already selected feature is above this, None keeps the plain top k
+REDUNDANCY_ABOVE = None
 
 # %%
-selected_features = df[['homestead_exemption_encoded', 'number_stories', 'depth_capped', 'total_area_capped', 'total_livable_area_capped', 'exempt_building_capped', 'frontage_capped', 'zip_code_0', 'taxable_building_capped', 'taxable_land_capped', 'market_value_capped']]
-selected_features.to_csv('high_correlations.csv')
+# Writes the all_corrs, high_correlations and pca_10component artifacts. Per stage metrics go to run_reports/feature_selection.json
+# (and .prom), see philly_house_predictor/instrumentation.py. The ranking and the PCA are reused as long as the scaled artifact and
+# their settings are unchanged (see philly_house_predictor/stage_cache.py).
+summary = select_features(TOP_K, REDUNDANCY_ABOVE, n_components=10, out_of_core=OUT_OF_CORE, report_name='feature_selection')
 
-# %%
-# The dataset is already scaled so we can apply PCA
+# Select the TOP_K Positive Features
+print(summary['correlations'].sort_values().tail(TOP_K + 1)) # Includes market_value_capped which is excluded from the selection
+print('Selected features:', summary['selected'])
 
-target_variable = df['market_value_capped']
-df_pca = df.drop(columns='market_value_capped')
-# Showcase explained variance of PCA up to all possible principal components
-pca = PCA(n_components=10)
-pca_all = pca.fit_transform(df_pca)
-print(pca.explained_variance_ratio_)
-sum(pca.explained_variance_ratio_)
-pca_df = pd.DataFrame(pca_all, columns=['PCA_1', 'PCA_2', 'PCA_3', 'PCA_4', 'PCA_5', 'PCA_6', 'PCA_7', 'PCA_8', 'PCA_9', 'PCA_10'])
-pca_df = pca_df.join(target_variable)
-pca_df.to_csv('pca_10component.csv')
\ No newline at end of file
+# %%
+# The dataset is already scaled so we can apply PCA. Showcase explained variance of PCA up to all possible principal components
+print(summary['explained_variance_ratio'])
+print(sum(summary['explained_variance_ratio']))
+read_artifact('pca_10component').drop(columns=TARGET).describe()
@@ -0,0 +1,38 @@
+# %%
+import os
+import sys
+
+# Allow importing the shared philly_house_predictor package from the repository root
+sys.path.append('..')
+from philly_house_predictor.benchmark import compare_benchmarks, load_benchmarks, run_benchmarks, save_benchmarks
+from philly_house_predictor.training_data import load_training_data
+
+# The results of every run are written to BENCHMARK_PATH. Copy a run to BASELINE_PATH to compare the next runs against it.
+BENCHMARK_PATH = 'model_benchmark.json'
+BASELINE_PATH = 'model_benchmark_baseline.json'
+# Every benchmark runs in a fresh process, which imports this script again under spawn / forkserver (e.g. on Windows).
+# The cells are guarded so those processes don't start benchmarks of their own.
+
+# %%
+# Same feature sets and split as model_development.py, the benchmark processes memory-map the shared float32 matrices
+if __name__ == '__main__':
+    feature_sets = {
+        feature_set: load_training_data(artifact, 'market_value_capped', test_size=0.2, random_state=42)
+        for feature_set, artifact in [('high_correlation', 'high_correlations'), ('pca', 'pca_10component')]
+    }
+
+# %%
+if __name__ == '__main__':
+    benchmarks = run_benchmarks(feature_sets)
+    save_benchmarks(benchmarks, BENCHMARK_PATH)
+    print(benchmarks[['estimator', 'feature_set', 'r2', 'rmse', 'fit_seconds', 'peak_memory_mb', 'model_bytes',
+                      'single_row_p99_ms', 'batch_100000_rows_per_second']].to_string(index=False))
+
+# %%
+if __name__ == '__main__' and os.path.exists(BASELINE_PATH):
+    regressions = compare_benchmarks(load_benchmarks(BASELINE_PATH), benchmarks)
+    if len(regressions):
+        print("REGRESSIONS AGAINST THE BASELINE:")
+        print(regressions.to_string(index=False))
+    else:
+        print("No regressions against the baseline")
@@ -1,224 +1,319 @@
 # %%
-from sklearn.model_selection import train_test_split
 from sklearn.metrics import root_mean_squared_error
-from sklearn.linear_model import LinearRegression
-from sklearn.tree import DecisionTreeRegressor
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.ensemble import RandomForestRegressor
-from itertools import combinations
-import xgboost
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-import logging
-
-high_correlations = pd.read_csv('high_correlations.csv')
-target_variable = high_correlations['market_value_capped']
-high_correlations = high_correlations.drop(columns=['market_value_capped'])
-X_train, X_test, y_train, y_test = train_test_split(high_correlations, target_variable, test_size=0.2, random_state=42)
-
-
-pca_10principal = pd.read_csv('pca_10component.csv')
-target_variable = pca_10principal['market_value_capped'] # The target_variable column has the same values despite being re-assigned btwn both datasets.
-pca_10principal = pca_10principal.drop(columns=['market_value_capped'])
-PCA_X_train, PCA_X_test, PCA_y_train, PCA_y_test = train_test_split(pca_10principal, target_variable, test_size=0.2, random_state=42)
+import sys
+
+# Allow importing the shared philly_house_predictor package from the repository root
+sys.path.append('..')
+from philly_house_predictor.artifacts import read_artifact, write_object
+from philly_house_predictor.comparables import COMPARABLES_OBJECT, ComparablesIndex
+from philly_house_predictor.ingest import COORDINATE_COLUMNS
+from philly_house_predictor.instrumentation import RunInstrumentation
+from philly_house_predictor.model_bundle import ModelBundle
+from philly_house_predictor.model_export import benchmark_export, check_equivalence, compile_model, export_model
+from philly_house_predictor.partitioned import KEYS_ARTIFACT, PartitionedRegressor
+from philly_house_predictor.subset_search import FeatureSubsetSearch
+from philly_house_predictor.training_data import load_training_data
+from philly_house_predictor.tuning import HyperparameterSearch
+
+# Under spawn / forkserver (e.g. on Windows) every worker of the process pools below imports this script again, as __mp_main__.
+# Everything but the imports and constants is therefore guarded, so the workers never refit the models or rewrite the artifacts.
+# The model libraries and matplotlib are only imported by the cells that use them, which the workers skip as well.
+# Per stage (model) metrics written to run_reports/model_development.json (and .prom), see philly_house_predictor/instrumentation.py
+# Artifacts written by feature_selection/feature_selection.py, as C-contiguous float32 matrices memory-mapped from disk with the
+# rows in the order of the train / test split (see philly_house_predictor/training_data.py). The splits and the cross-validation
+# folds of the tuning cell are slices of the same file, which every model and worker process reads without a copy.
+if __name__ == '__main__':
+    run = RunInstrumentation('model_development')
+    run.begin('load')
+    high_correlations = load_training_data('high_correlations', 'market_value_capped', test_size=0.2, random_state=42)
+    X_train, X_test, y_train, y_test = high_correlations.split()
+
+    pca_10principal = load_training_data('pca_10component', 'market_value_capped', test_size=0.2, random_state=42)
+    PCA_X_train, PCA_X_test, PCA_y_train, PCA_y_test = pca_10principal.split()
+    run.end(rows_out=len(high_correlations))
 
 # %% [markdown]
 # # Naively Applying Regression Models
 
 # %%
-lin_model = LinearRegression()
-lin_model.fit(X_train, y_train)
-lin_model_score = lin_model.score(X_test, y_test)
-lin_model_rmse = root_mean_squared_error(lin_model.predict(X_test), y_test)
-print("HIGH_CORR_LIN_MODEL:", lin_model_score)
-print("HIGH_CORR_LIN_MODEL RMSE:", lin_model_rmse)
-
-pca_lin_model = LinearRegression()
-pca_lin_model.fit(PCA_X_train, PCA_y_train)
-pca_lin_model_score = pca_lin_model.score(PCA_X_test, PCA_y_test)
-pca_lin_model_rmse = root_mean_squared_error(pca_lin_model.predict(PCA_X_test), PCA_y_test)
-print("PCA_LIN_MODEL:", pca_lin_model_score)
-print("PCA_LIN_MODEL RMSE:", pca_lin_model_rmse)
-
-# %%
-decision_model = DecisionTreeRegressor()
-decision_model.fit(X_train, y_train)
-decision_model_score = decision_model.score(X_test, y_test)
-decision_model_rmse = root_mean_squared_error(decision_model.predict(X_test), y_test)
-
-print("HIGH_CORR_DEC_MODEL:", decision_model_score)
-print("HIGH_CORR_DEC_MODEL RMSE:", decision_model_rmse)
-
-pca_decision_model = DecisionTreeRegressor()
-pca_decision_model.fit(PCA_X_train, PCA_y_train)
-pca_decision_model_score = pca_decision_model.score(PCA_X_test, PCA_y_test)
-pca_decision_model_rmse = root_mean_squared_error(pca_decision_model.predict(PCA_X_test), PCA_y_test)
-print("PCA_DEC_MODEL:", pca_decision_model_score)
-print("PCA_DEC_MODEL RMSE:", pca_decision_model_rmse)
+if __name__ == '__main__':
+    from sklearn.linear_model import LinearRegression
+
+    run.begin('linear_regression', rows_in=len(X_train) + len(PCA_X_train))
+    lin_model = LinearRegression()
+    lin_model.fit(X_train, y_train)
+    lin_model_score = lin_model.score(X_test, y_test)
+    lin_model_rmse = root_mean_squared_error(lin_model.predict(X_test), y_test)
+    print("HIGH_CORR_LIN_MODEL:", lin_model_score)
+    print("HIGH_CORR_LIN_MODEL RMSE:", lin_model_rmse)
+
+    pca_lin_model = LinearRegression()
+    pca_lin_model.fit(PCA_X_train, PCA_y_train)
+    pca_lin_model_score = pca_lin_model.score(PCA_X_test, PCA_y_test)
+    pca_lin_model_rmse = root_mean_squared_error(pca_lin_model.predict(PCA_X_test), PCA_y_test)
+    print("PCA_LIN_MODEL:", pca_lin_model_score)
+    print("PCA_LIN_MODEL RMSE:", pca_lin_model_rmse)
+    run.end(rows_out=len(X_test) + len(PCA_X_test))
 
 # %%
-forest_model = RandomForestRegressor()
-forest_model.fit(X_train, y_train)
-forest_model_score = forest_model.score(X_test, y_test)
-forest_model_rmse = root_mean_squared_error(forest_model.predict(X_test), y_test)
-print("HIGH_CORR_FOREST_MODEL:", forest_model_score)
-print("HIGH_CORR_FOREST_MODEL RMSE:", forest_model_rmse)
-
-pca_forest_model = RandomForestRegressor()
-pca_forest_model.fit(PCA_X_train, PCA_y_train)
-pca_forest_model_score = pca_forest_model.score(PCA_X_test, PCA_y_test)
-pca_forest_model_rmse = root_mean_squared_error(pca_forest_model.predict(PCA_X_test), PCA_y_test)
-print("PCA_FOREST_MODEL:", pca_forest_model_score)
-print("PCA_FOREST_MODEL RMSE:", pca_forest_model_rmse)
+if __name__ == '__main__':
+    from sklearn.tree import DecisionTreeRegressor
+
+    run.begin('decision_tree', rows_in=len(X_train) + len(PCA_X_train))
+    decision_model = DecisionTreeRegressor()
+    decision_model.fit(X_train, y_train)
+    decision_model_score = decision_model.score(X_test, y_test)
+    decision_model_rmse = root_mean_squared_error(decision_model.predict(X_test), y_test)
+
+    print("HIGH_CORR_DEC_MODEL:", decision_model_score)
+    print("HIGH_CORR_DEC_MODEL RMSE:", decision_model_rmse)
+
+    pca_decision_model = DecisionTreeRegressor()
+    pca_decision_model.fit(PCA_X_train, PCA_y_train)
+    pca_decision_model_score = pca_decision_model.score(PCA_X_test, PCA_y_test)
+    pca_decision_model_rmse = root_mean_squared_error(pca_decision_model.predict(PCA_X_test), PCA_y_test)
+    print("PCA_DEC_MODEL:", pca_decision_model_score)
+    print("PCA_DEC_MODEL RMSE:", pca_decision_model_rmse)
+    run.end(rows_out=len(X_test) + len(PCA_X_test))
 
 # %%
-from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.metrics import root_mean_squared_error
+if __name__ == '__main__':
+    from sklearn.ensemble import RandomForestRegressor
 
-grad_boost_model = GradientBoostingRegressor()
-grad_boost_model.fit(X_train, y_train)
-grad_boost_model_score = grad_boost_model.score(X_test, y_test)
-grad_boost_model_rmse = root_mean_squared_error(grad_boost_model.predict(X_test), y_test)
-print("HIGH_CORR_GRAD_BOOST_MODEL:", grad_boost_model_score)
-print("HIGH_CORR_GRAD_BOOST_MODEL RMSE:", grad_boost_model_rmse)
+    run.begin('random_forest', rows_in=len(X_train) + len(PCA_X_train))
+    forest_model = RandomForestRegressor()
+    forest_model.fit(X_train, y_train)
+    forest_model_score = forest_model.score(X_test, y_test)
+    forest_model_rmse = root_mean_squared_error(forest_model.predict(X_test), y_test)
+    print("HIGH_CORR_FOREST_MODEL:", forest_model_score)
+    print("HIGH_CORR_FOREST_MODEL RMSE:", forest_model_rmse)
+
+    pca_forest_model = RandomForestRegressor()
+    pca_forest_model.fit(PCA_X_train, PCA_y_train)
+    pca_forest_model_score = pca_forest_model.score(PCA_X_test, PCA_y_test)
+    pca_forest_model_rmse = root_mean_squared_error(pca_forest_model.predict(PCA_X_test), PCA_y_test)
+    print("PCA_FOREST_MODEL:", pca_forest_model_score)
+    print("PCA_FOREST_MODEL RMSE:", pca_forest_model_rmse)
+    run.end(rows_out=len(X_test) + len(PCA_X_test))
 
-pca_grad_boost_model = GradientBoostingRegressor()
-pca_grad_boost_model.fit(PCA_X_train, PCA_y_train)
-pca_grad_boost_model_score = pca_grad_boost_model.score(PCA_X_test, PCA_y_test)
-pca_grad_boost_model_rmse = root_mean_squared_error(pca_grad_boost_model.predict(PCA_X_test), PCA_y_test)
-print("PCA_GRAD_BOOST_MODEL:", pca_grad_boost_model_score)
-print("PCA_GRAD_BOOST_MODEL RMSE:", pca_grad_boost_model_rmse)
+# %%
+if __name__ == '__main__':
+    from sklearn.ensemble import GradientBoostingRegressor
+
+    run.begin('gradient_boosting', rows_in=len(X_train) + len(PCA_X_train))
+    grad_boost_model = GradientBoostingRegressor()
+    grad_boost_model.fit(X_train, y_train)
+    grad_boost_model_score = grad_boost_model.score(X_test, y_test)
+    grad_boost_model_rmse = root_mean_squared_error(grad_boost_model.predict(X_test), y_test)
+    print("HIGH_CORR_GRAD_BOOST_MODEL:", grad_boost_model_score)
+    print("HIGH_CORR_GRAD_BOOST_MODEL RMSE:", grad_boost_model_rmse)
+
+    pca_grad_boost_model = GradientBoostingRegressor()
+    pca_grad_boost_model.fit(PCA_X_train, PCA_y_train)
+    pca_grad_boost_model_score = pca_grad_boost_model.score(PCA_X_test, PCA_y_test)
+    pca_grad_boost_model_rmse = root_mean_squared_error(pca_grad_boost_model.predict(PCA_X_test), PCA_y_test)
+    print("PCA_GRAD_BOOST_MODEL:", pca_grad_boost_model_score)
+    print("PCA_GRAD_BOOST_MODEL RMSE:", pca_grad_boost_model_rmse)
+    run.end(rows_out=len(X_test) + len(PCA_X_test))
 
 # %%
-xgb_model = xgboost.XGBRegressor()
-xgb_model.fit(X_train, y_train)
-xgb_model_score = xgb_model.score(X_test, y_test)
-xgb_model_rmse = root_mean_squared_error(xgb_model.predict(X_test), y_test)
-print("HIGH_CORR_XGB_MODEL:", xgb_model_score)
-print("HIGH_CORR_XGB_MODEL RMSE:", )
-
-pca_xgb_model = xgboost.XGBRegressor()
-pca_xgb_model.fit(PCA_X_train, PCA_y_train)
-pca_xgb_model_score = pca_xgb_model.score(PCA_X_test, PCA_y_test)
-pca_xgb_model_rmse = root_mean_squared_error(pca_xgb_model.predict(PCA_X_test), PCA_y_test)
-print("PCA_XGB_MODEL:", pca_xgb_model_score)
-print("PCA_XGB_MODEL RMSE:", pca_xgb_model_rmse)
+if __name__ == '__main__':
+    import xgboost
+
+    run.begin('xgboost', rows_in=len(X_train) + len(PCA_X_train))
+    xgb_model = xgboost.XGBRegressor()
+    xgb_model.fit(X_train, y_train)
+    xgb_model_score = xgb_model.score(X_test, y_test)
+    xgb_model_rmse = root_mean_squared_error(xgb_model.predict(X_test), y_test)
+    print("HIGH_CORR_XGB_MODEL:", xgb_model_score)
+    print("HIGH_CORR_XGB_MODEL RMSE:", xgb_model_rmse)
+
+    pca_xgb_model = xgboost.XGBRegressor()
+    pca_xgb_model.fit(PCA_X_train, PCA_y_train)
+    pca_xgb_model_score = pca_xgb_model.score(PCA_X_test, PCA_y_test)
+    pca_xgb_model_rmse = root_mean_squared_error(pca_xgb_model.predict(PCA_X_test), PCA_y_test)
+    print("PCA_XGB_MODEL:", pca_xgb_model_score)
+    print("PCA_XGB_MODEL RMSE:", pca_xgb_model_rmse)
+    run.end(rows_out=len(X_test) + len(PCA_X_test))
 
 # %% [markdown]
 # ## Generate Graph Showcasing Model's Score (PCA / High Correlation)
 
 # %%
 # Scores from my models
-linear_regression_scores = [pca_lin_model_score, lin_model_score]  # Scores for PCA and HighCorrelation
-decision_tree_scores = [pca_decision_model_score, decision_model_score]
-random_forest_scores = [pca_forest_model_score, forest_model_score]
-gradient_boosting_scores = [pca_grad_boost_model_score, grad_boost_model_score]
-xgboost_scores = [pca_xgb_model_score, xgb_model_score]
-
-# Bar positions
-bar_width = 0.15
-index = np.arange(len(linear_regression_scores))
-
-# Creating the bar graph
-fig, ax = plt.subplots()
-bar1 = ax.bar(index, linear_regression_scores, bar_width, label='LinearRegression')
-bar2 = ax.bar(index + bar_width, decision_tree_scores, bar_width, label='DecisionTree')
-bar3 = ax.bar(index + 2 * bar_width, random_forest_scores, bar_width, label='RandomForest')
-bar4 = ax.bar(index + 3 * bar_width, gradient_boosting_scores, bar_width, label='GradientBoosting')
-bar5 = ax.bar(index + 4 * bar_width, xgboost_scores, bar_width, label='XGBoost')
-
-# Adding labels and title
-ax.set_xlabel('Models')
-ax.set_ylabel('R^2 Scores')
-ax.set_title('Naive Approach: R^2 for PCA and HighCorrelation applied on various regression models')
-ax.set_xticks(index + 2 * bar_width)
-ax.set_xticklabels(['PCA', 'HighCorrelation'])
-ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
-
-plt.ylim(0.91, 1.0)
-
-# Show the bar graph
-plt.show()
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    linear_regression_scores = [pca_lin_model_score, lin_model_score]  # Scores for PCA and HighCorrelation
+    decision_tree_scores = [pca_decision_model_score, decision_model_score]
+    random_forest_scores = [pca_forest_model_score, forest_model_score]
+    gradient_boosting_scores = [pca_grad_boost_model_score, grad_boost_model_score]
+    xgboost_scores = [pca_xgb_model_score, xgb_model_score]
+
+    # Bar positions
+    bar_width = 0.15
+    index = np.arange(len(linear_regression_scores))
+
+    # Creating the bar graph
+    fig, ax = plt.subplots()
+    bar1 = ax.bar(index, linear_regression_scores, bar_width, label='LinearRegression')
+    bar2 = ax.bar(index + bar_width, decision_tree_scores, bar_width, label='DecisionTree')
+    bar3 = ax.bar(index + 2 * bar_width, random_forest_scores, bar_width, label='RandomForest')
+    bar4 = ax.bar(index + 3 * bar_width, gradient_boosting_scores, bar_width, label='GradientBoosting')
+    bar5 = ax.bar(index + 4 * bar_width, xgboost_scores, bar_width, label='XGBoost')
+
+    # Adding labels and title
+    ax.set_xlabel('Models')
+    ax.set_ylabel('R^2 Scores')
+    ax.set_title('Naive Approach: R^2 for PCA and HighCorrelation applied on various regression models')
+    ax.set_xticks(index + 2 * bar_width)
+    ax.set_xticklabels(['PCA', 'HighCorrelation'])
+    ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    plt.ylim(0.91, 1.0)
+
+    # Show the bar graph
+    plt.show()
 
 # %% [markdown]
 # ## Generate Graph Showcasing Model's RMSE (PCA / High Correlation)
 
 # %%
-import matplotlib.pyplot as plt
-import numpy as np
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    linear_regression_rmses = [pca_lin_model_rmse, lin_model_rmse]  # Scores for PCA and HighCorrelation
+    decision_tree_rmses = [pca_decision_model_rmse, decision_model_rmse]
+    random_forest_rmses = [pca_forest_model_rmse, forest_model_rmse]
+    gradient_boosting_rmses = [pca_grad_boost_model_rmse, grad_boost_model_rmse]
+    xgboost_rmses = [pca_xgb_model_rmse, xgb_model_rmse]
+
+    # Bar positions
+    bar_width = 0.15
+    index = np.arange(len(linear_regression_rmses))
+
+    # Creating the bar graph
+    fig, ax = plt.subplots()
+    bar1 = ax.bar(index, linear_regression_rmses, bar_width, label='LinearRegression')
+    bar2 = ax.bar(index + bar_width, decision_tree_rmses, bar_width, label='DecisionTree')
+    bar3 = ax.bar(index + 2 * bar_width, random_forest_rmses, bar_width, label='RandomForest')
+    bar4 = ax.bar(index + 3 * bar_width, gradient_boosting_rmses, bar_width, label='GradientBoosting')
+    bar5 = ax.bar(index + 4 * bar_width, xgboost_rmses, bar_width, label='XGBoost')
+
+    # Adding labels and title
+    ax.set_xlabel('Models')
+    ax.set_ylabel('RMSE (Root Mean-Squared Error)')
+    ax.set_title('Naive Approach: RMSE from applying various regression models for PCA and HighCorrelation')
+    ax.set_xticks(index + 2 * bar_width)
+    ax.set_xticklabels(['PCA', 'HighCorrelation'])
+    ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    # Show the bar graph
+    plt.show()
 
-linear_regression_rmses = [pca_lin_model_rmse, lin_model_rmse]  # Scores for PCA and HighCorrelation
-decision_tree_rmses = [pca_decision_model_rmse, decision_model_rmse]
-random_forest_rmses = [pca_forest_model_rmse, forest_model_rmse]
-gradient_boosting_rmses = [pca_grad_boost_model_rmse, grad_boost_model_rmse]
-xgboost_rmses = [pca_xgb_model_rmse, xgb_model_rmse]
-
-# Bar positions
-bar_width = 0.15
-index = np.arange(len(linear_regression_rmses))
-
-# Creating the bar graph
-fig, ax = plt.subplots()
-bar1 = ax.bar(index, linear_regression_rmses, bar_width, label='LinearRegression')
-bar2 = ax.bar(index + bar_width, decision_tree_rmses, bar_width, label='DecisionTree')
-bar3 = ax.bar(index + 2 * bar_width, random_forest_rmses, bar_width, label='RandomForest')
-bar4 = ax.bar(index + 3 * bar_width, gradient_boosting_rmses, bar_width, label='GradientBoosting')
-bar5 = ax.bar(index + 4 * bar_width, xgboost_rmses, bar_width, label='XGBoost')
-
-# Adding labels and title
-ax.set_xlabel('Models')
-ax.set_ylabel('RMSE (Root Mean-Squared Error)')
-ax.set_title('Naive Approach: RMSE from applying various regression models for PCA and HighCorrelation')
-ax.set_xticks(index + 2 * bar_width)
-ax.set_xticklabels(['PCA', 'HighCorrelation'])
-ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
-
-# Show the bar graph
-plt.show()
+# %% [markdown]
+# ## Persist the Model for Scoring New Parcels
 
 # %%
-pca_10principal_COLS = pca_10principal.drop(columns=['Unnamed: 0'])
-high_correlations_COLS = high_correlations.drop(columns=['Unnamed: 0'])
-
-def generate_column_combinations(column_list):
-    all_combinations = []
-    for r in range(1, len(column_list) + 1):
-        column_combinations = combinations(column_list, r)
-        all_combinations.extend(column_combinations)
-    return all_combinations
-
-pca_col_combinations_list = generate_column_combinations(pca_10principal_COLS.columns)
-high_corr_combinations_list = generate_column_combinations(high_correlations_COLS.columns)
-
-# Setup logging
-logger = logging.getLogger()
-fhandler = logging.FileHandler(filename='col_combinations_random_forest_test.log', encoding='utf-8')
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-fhandler.setFormatter(formatter)
-logger.addHandler(fhandler)
-logger.setLevel(logging.DEBUG)
-
-logging.info("BEGIN PCA COLUMN COMBINATIONS - RANDOM FOREST MODEL TEST")
-
-for combination in pca_col_combinations_list:
-    pca_combination_col = pca_10principal_COLS[list(combination)]
-    X_train, X_test, y_train, y_test = train_test_split(pca_combination_col, target_variable, test_size=0.2, random_state=42)
-    forest_model = RandomForestRegressor()
-    forest_model.fit(X_train, y_train)
-    pca_combination_col_score = forest_model.score(X_test, y_test)
-    pca_combination_col_rmse = root_mean_squared_error(forest_model.predict(X_test), y_test)
-    logging.debug(f"{list(combination)}, {pca_combination_col_score}, {pca_combination_col_rmse}")
-  
-logging.info("BEGIN HIGH CORRELATION COLUMN COMBINATIONS - RANDOM FOREST MODEL TEST")
-
-for combination in high_corr_combinations_list:
-    high_corr_combination_col = high_correlations_COLS[list(combination)]
-    X_train, X_test, y_train, y_test = train_test_split(high_corr_combination_col, target_variable, test_size=0.2, random_state=42)
-    forest_model = RandomForestRegressor()
-    forest_model.fit(X_train, y_train)
-    high_corr_combination_col_score = forest_model.score(X_test, y_test)
-    high_corr_combination_col_rmse = root_mean_squared_error(forest_model.predict(X_test), y_test)
-    logging.debug(f"{list(combination)}, {high_corr_combination_col_score}, {high_corr_combination_col_rmse}")
+# Random Forest on the highly correlated features performed best, it is bundled with the fitted encoder / winsorize caps / scaler
+# of data_preprocessing/preprocessing.py so raw OPA records can be scored (see philly_house_predictor/serving.py)
+if __name__ == '__main__':
+    run.begin('persist')
+    market_value_model = ModelBundle.from_artifacts(forest_model, high_correlations.features)
+    write_object(market_value_model, 'market_value_model')
+    run.end()
 
+# %%
+# The same Random Forest flattened into NumPy arrays (see philly_house_predictor/model_export.py), loaded and evaluated with NumPy
+# only by philly_house_predictor/compact_predictor.py. The export is checked against the predictions of the original model, then
+# both are compared on file size, cold start in a new process and predict throughput.
+if __name__ == '__main__':
+    run.begin('export', rows_in=len(X_test))
+    compact_forest_model = compile_model(forest_model, high_correlations.features)
+    print("COMPACT_FOREST_MODEL MAX RELATIVE DIFFERENCE:", check_equivalence(forest_model, compact_forest_model, X_test))
+    export_model(forest_model, 'market_value_model_compact', high_correlations.features)
+    print(pd.DataFrame(benchmark_export(forest_model, compact_forest_model, X_test)).set_index('model').T)
+    run.end(rows_out=len(X_test))
 
+# %%
+# One Random Forest per zip code with at least MIN_PARTITION_ROWS training rows, fitted in a process pool, with the Random Forest
+# on every row as the fallback for the sparse ones (see philly_house_predictor/partitioned.py). 'census_tract' and
+# 'geographic_ward' give smaller areas. The raw keys come from the parcel_keys artifact, joined on parcel_number.
+PARTITION_COLUMN = 'zip_code'
+MIN_PARTITION_ROWS = 500
+if __name__ == '__main__':
+    from sklearn.ensemble import RandomForestRegressor
+
+    run.begin('partitioned_forest', rows_in=len(X_train))
+    partitions = read_artifact(KEYS_ARTIFACT, columns=[PARTITION_COLUMN])[PARTITION_COLUMN]
+    partitioned_model = PartitionedRegressor(RandomForestRegressor(), partition_column=PARTITION_COLUMN, min_rows=MIN_PARTITION_ROWS)
+    partitioned_model.fit(X_train, y_train, partitions.reindex(high_correlations.train_index))
+    partitioned_predictions = partitioned_model.predict(X_test, partitions.reindex(high_correlations.test_index))
+    print(f"PARTITIONED_FOREST_MODEL ({len(partitioned_model.models_)} {PARTITION_COLUMN} models):",
+          partitioned_model.score(X_test, y_test, partitions.reindex(high_correlations.test_index)))
+    print("PARTITIONED_FOREST_MODEL RMSE:", root_mean_squared_error(partitioned_predictions, y_test))
+    run.end(rows_out=len(X_test), partitions=len(partitioned_model.models_))
+
+# %%
+# Comparable sales: the N_COMPARABLES most similar homes among the 3 * N_COMPARABLES nearest training parcels of every parcel,
+# found with a KD-tree over lat / lng (see philly_house_predictor/comparables.py), and aggregates of their market values as extra
+# features. A training parcel never counts itself and test parcels only see training parcels.
+N_COMPARABLES = 10
+if __name__ == '__main__':
+    from sklearn.ensemble import RandomForestRegressor
+
+    run.begin('comparables', rows_in=len(X_train))
+    coordinates = read_artifact(KEYS_ARTIFACT, columns=COORDINATE_COLUMNS)
+    train_coordinates = coordinates.reindex(high_correlations.train_index)
+    test_coordinates = coordinates.reindex(high_correlations.test_index)
+    comparables_index = ComparablesIndex(k=N_COMPARABLES, candidates=3).fit(train_coordinates, y_train, X_train)
+    X_train_comparables = np.hstack([X_train, comparables_index.neighbour_features(train_coordinates, X_train, exclude_self=True)])
+    X_test_comparables = np.hstack([X_test, comparables_index.neighbour_features(test_coordinates, X_test)])
+
+    comparables_forest_model = RandomForestRegressor()
+    comparables_forest_model.fit(X_train_comparables, y_train)
+    print("COMPARABLES_FOREST_MODEL:", comparables_forest_model.score(X_test_comparables, y_test))
+    print("COMPARABLES_FOREST_MODEL RMSE:", root_mean_squared_error(comparables_forest_model.predict(X_test_comparables), y_test))
+
+    # Looks up the comparables of any parcel by its coordinates, e.g. comparables_index.comparables(39.95, -75.16)
+    write_object(comparables_index, COMPARABLES_OBJECT)
+    run.end(rows_out=len(X_test))
+
+# %%
+# Feature subset search with Random Forest: the split is made once, the fits run in a process pool and every result is appended to
+# feature_subset_search.jsonl, so re-running this cell after an interruption only fits the subsets that are missing.
+# strategy='exhaustive' tests all 2^10 - 1 combinations, 'forward' / 'backward' select greedily and 'halving' prunes the combinations
+# with successive halving on a growing number of training rows.
+if __name__ == '__main__':
+    from sklearn.ensemble import RandomForestRegressor
+
+    run.begin('subset_search', rows_in=len(high_correlations))
+    for feature_set, training_data in [('pca', pca_10principal), ('high_correlation', high_correlations)]:
+        subset_search = FeatureSubsetSearch(RandomForestRegressor(), strategy='halving', results_path='feature_subset_search.jsonl')
+        subset_results = subset_search.search(training_data, feature_set=feature_set)
+        print(f"{feature_set.upper()} BEST SUBSET:", subset_search.best_features_)
+        print(pd.DataFrame(subset_results)[['features', 'r2', 'rmse', 'fit_seconds']].head(10))
+    run.end()
+
+# %%
+# Hyperparameter tuning of the tree ensembles with the 5 cross-validation folds of the training split (see philly_house_predictor/tuning.py).
+# Hyperband samples configurations from SEARCH_SPACES and grows the trees of the best ones from 25 to 400, warm-starting every
+# model from its previous rung. Evaluations are appended to tuning_history.jsonl, re-running this cell resumes the search.
+if __name__ == '__main__':
+    run.begin('tuning', rows_in=len(X_train))
+    tuned_models = {}
+    for estimator_name in ['RandomForest', 'GradientBoosting', 'XGBoost']:
+        tuning_search = HyperparameterSearch(estimator_name, strategy='hyperband', history_path='tuning_history.jsonl')
+        tuning_search.search(high_correlations)
+        tuned_models[estimator_name] = tuning_search.best_estimator_
+        print(f"TUNED_{estimator_name.upper()} PARAMS:", tuning_search.best_params_)
+        print(f"TUNED_{estimator_name.upper()} CV RMSE:", tuning_search.best_score_)
+        print(f"TUNED_{estimator_name.upper()} TEST RMSE:", root_mean_squared_error(tuning_search.best_estimator_.predict(X_test), y_test))
+    run.end(rows_out=len(X_test))
+
+# %%
+# The workers of the process pools re-run this script without the __main__ guarded cells, only the main process writes the report
+if __name__ == '__main__':
+    run.write()
@@ -0,0 +1 @@
+# Shared building blocks for the preprocessing / feature selection / model development scripts.
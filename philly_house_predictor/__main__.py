@@ -0,0 +1,8 @@
+# python -m philly_house_predictor <command>, see philly_house_predictor/cli.py
+import sys
+
+from .cli import main
+
+# Process pools started with spawn re-import the main module of their parent, which must not run the command again
+if __name__ == '__main__':
+    sys.exit(main())
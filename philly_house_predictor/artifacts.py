@@ -0,0 +1,163 @@
+# Typed, columnar hand-off between the pipeline stages.
+# Frames are written as zstd compressed Parquet files into one artifact directory and recorded in a manifest (rows, column dtypes,
+# size), so downstream stages read only the columns they need with identical dtypes and no text parsing.
+# Fitted objects (encoders, scalers, models) are stored next to them with joblib.
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# <repository>/artifacts by default, shared by the scripts of every stage regardless of their working directory
+ARTIFACT_DIR = os.environ.get(
+    'PHILLY_ARTIFACT_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'artifacts'),
+)
+MANIFEST_NAME = 'manifest.json'
+
+
+def _directory(directory):
+    directory = directory or ARTIFACT_DIR
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def read_manifest(directory=None):
+    path = os.path.join(_directory(directory), MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _record(name, entry, directory):
+    manifest = read_manifest(directory)
+    manifest[name] = {**entry, 'written_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    # Write to a temporary file first so a crashed stage never leaves a half written manifest behind
+    path = os.path.join(_directory(directory), MANIFEST_NAME)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def artifact_path(name, directory=None):
+    entry = read_manifest(directory).get(name)
+    if entry is None:
+        raise FileNotFoundError(f"No artifact named '{name}' in {_directory(directory)}, run the stage that produces it first")
+    return os.path.join(_directory(directory), entry['file'])
+
+
+def _record_table(name, path, schema, rows, index, directory):
+    _record(name, {
+        'file': os.path.basename(path),
+        'format': 'parquet',
+        'rows': rows,
+        'index': index,
+        'columns': {field.name: str(field.type) for field in schema if field.name != index},
+        'bytes': os.path.getsize(path),
+    }, directory)
+    return path
+
+
+def _write_table(table, name, index, directory, compression):
+    path = os.path.join(_directory(directory), f'{name}.parquet')
+    pq.write_table(table, path, compression=compression)
+    return _record_table(name, path, table.schema, table.num_rows, index, directory)
+
+
+def write_artifact(df, name, directory=None, compression='zstd'):
+    # Only a named index (the parcel_number key of the records) is stored, an unnamed positional index is not, which also
+    # gets rid of the accidental 'Unnamed: 0' column of the csv hand-offs
+    index = df.index.name
+    table = pa.Table.from_pandas(df, preserve_index=index is not None)
+    return _write_table(table, name, index, directory, compression)
+
+
+def write_artifact_batches(frames, name, directory=None, compression='zstd'):
+    # Writes an iterable of frames with the same columns as one artifact, one row group at a time, so an artifact larger
+    # than memory can be produced batch by batch (see philly_house_predictor/out_of_core.py)
+    path = os.path.join(_directory(directory), f'{name}.parquet')
+    writer, rows, index = None, 0, None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, preserve_index=df.index.name is not None)
+            if writer is None:
+                index = df.index.name
+                writer = pq.ParquetWriter(f'{path}.tmp', table.schema, compression=compression)
+            writer.write_table(table.cast(writer.schema))
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"No batches to write for artifact '{name}'")
+    os.replace(f'{path}.tmp', path)
+    return _record_table(name, path, writer.schema, rows, index, directory)
+
+
+def read_artifact(name, columns=None, directory=None):
+    # Only the requested columns are read (plus the index), and the file is memory-mapped instead of copied into Python buffers
+    table = pq.read_table(artifact_path(name, directory), columns=columns, memory_map=True, use_pandas_metadata=True)
+    return table.to_pandas()
+
+
+def upsert_artifact(df, name, delete=(), directory=None, compression='zstd'):
+    # Removes the rows whose index is in delete and appends the rows of df, without converting the stored rows to pandas.
+    # The artifact must have been written with a named index, which identifies the rows.
+    index = read_manifest(directory)[name].get('index') if name in read_manifest(directory) else None
+    if index is None or df.index.name != index:
+        raise ValueError(f"Artifact '{name}' and the new rows must share a named index to be updated in place")
+    stored = pq.read_table(artifact_path(name, directory), memory_map=True)
+    keys = pa.array(list(delete), type=stored.schema.field(index).type)
+    if len(keys):
+        stored = stored.filter(pc.invert(pc.is_in(stored[index], value_set=keys)))
+    rows = pa.Table.from_pandas(df, preserve_index=True).select(stored.schema.names).cast(stored.schema)
+    return _write_table(pa.concat_tables([stored, rows]), name, index, directory, compression)
+
+
+def remove_artifact(name, directory=None):
+    # Drops an artifact that no longer matches the others from the manifest and deletes its file
+    manifest = read_manifest(directory)
+    entry = manifest.pop(name, None)
+    if entry is None:
+        return
+    path = os.path.join(_directory(directory), MANIFEST_NAME)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f'{path}.tmp', path)
+    try:
+        os.remove(os.path.join(_directory(directory), entry['file']))
+    except FileNotFoundError:
+        pass
+
+
+def artifact_columns(name, directory=None):
+    # The columns without the index
+    artifact_path(name, directory)
+    return list(read_manifest(directory)[name]['columns'])
+
+
+def write_object(obj, name, directory=None):
+    file = f'{name}.joblib'
+    path = os.path.join(_directory(directory), file)
+    joblib.dump(obj, path)
+    _record(name, {'file': file, 'format': 'joblib', 'bytes': os.path.getsize(path)}, directory)
+    return path
+
+
+def read_object(name, directory=None):
+    return joblib.load(artifact_path(name, directory))
+
+
+def write_arrays(arrays, name, directory=None):
+    # NumPy arrays as one uncompressed .npz file, which np.load reads without any other dependency (e.g. an exported model,
+    # see philly_house_predictor/model_export.py)
+    file = f'{name}.npz'
+    path = os.path.join(_directory(directory), file)
+    np.savez(path, **arrays)
+    _record(name, {'file': file, 'format': 'npz', 'bytes': os.path.getsize(path)}, directory)
+    return path
@@ -0,0 +1,180 @@
+# Benchmark harness for the regression models.
+# Every estimator x feature set is fitted once and measured on accuracy (R^2 / RMSE) as well as on what matters for deploying it:
+# fit wall time, peak memory while fitting, serialized model size, single-row predict latency and batch (1k / 100k rows) predict
+# throughput. Results are written as a JSON table, and a run can be compared against a stored baseline to catch regressions.
+import io
+import json
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+import psutil
+import sklearn
+from sklearn.base import clone
+from sklearn.metrics import r2_score, root_mean_squared_error
+
+from .instrumentation import PeakMemory
+from .training_data import TrainingData
+
+
+def _xgboost_regressor():
+    # Imported lazily so the harness works for the sklearn models without xgboost installed
+    import xgboost
+    return xgboost.XGBRegressor()
+
+
+def default_estimators():
+    from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+    from sklearn.linear_model import LinearRegression
+    from sklearn.tree import DecisionTreeRegressor
+
+    # Same (default) configurations as the naive models of model_development.py
+    return {
+        'LinearRegression': LinearRegression(),
+        'DecisionTree': DecisionTreeRegressor(),
+        'RandomForest': RandomForestRegressor(),
+        'GradientBoosting': GradientBoostingRegressor(),
+        'XGBoost': _xgboost_regressor(),
+    }
+
+
+BATCH_SIZES = (1_000, 100_000)
+SINGLE_ROW_REPEATS = 200
+BATCH_REPEATS = 3
+
+# Growth over the baseline that is reported as a regression as {metric: (relative, absolute)}, for metrics that are better when lower.
+# A metric regresses when it grew by more than both, so the jitter of sub-millisecond timings is not reported.
+REGRESSION_TOLERANCES = {
+    'rmse': (0.02, 0),
+    'model_bytes': (0.1, 0),
+    'peak_memory_mb': (0.25, 8),
+    'fit_seconds': (0.25, 0.05),
+    'single_row_p50_ms': (0.25, 0.2),
+    'single_row_p99_ms': (0.5, 1),
+    **{f'batch_{size}_seconds': (0.25, 0.005) for size in BATCH_SIZES},
+}
+
+
+def _model_bytes(model):
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def benchmark_estimator(estimator, X_train, y_train, X_test, y_test, batch_sizes=BATCH_SIZES):
+    X_train = np.ascontiguousarray(X_train, dtype=np.float32)
+    X_test = np.ascontiguousarray(X_test, dtype=np.float32)
+    y_train = np.asarray(y_train, dtype=np.float64)
+    y_test = np.asarray(y_test, dtype=np.float64)
+
+    model = clone(estimator)
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+
+    predictions = model.predict(X_test)
+    record = {
+        'r2': float(r2_score(y_test, predictions)),
+        'rmse': float(root_mean_squared_error(y_test, predictions)),
+        'fit_seconds': fit_seconds,
+        'peak_memory_mb': memory.peak_mb,
+        'model_bytes': _model_bytes(model),
+    }
+
+    # Single-row latency as a scoring service would see it: one predict call per parcel
+    latencies = np.empty(SINGLE_ROW_REPEATS)
+    for repeat in range(SINGLE_ROW_REPEATS):
+        row = X_test[repeat % len(X_test)][None, :]
+        start = time.perf_counter()
+        model.predict(row)
+        latencies[repeat] = time.perf_counter() - start
+    record['single_row_p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+    record['single_row_p99_ms'] = float(np.percentile(latencies, 99) * 1000)
+
+    # Batches larger than the test set repeat its rows, the best of a few repeats filters out scheduler noise
+    for size in batch_sizes:
+        batch = np.ascontiguousarray(X_test[np.arange(size) % len(X_test)])
+        timings = []
+        for _ in range(BATCH_REPEATS):
+            start = time.perf_counter()
+            model.predict(batch)
+            timings.append(time.perf_counter() - start)
+        record[f'batch_{size}_seconds'] = min(timings)
+        record[f'batch_{size}_rows_per_second'] = size / min(timings)
+    return record
+
+
+def _benchmark_training_data(estimator, data, batch_sizes):
+    # Runs in the benchmark process, which memory-maps the TrainingData instead of receiving its rows
+    return benchmark_estimator(estimator, data.X_train, data.y_train, data.X_test, data.y_test, batch_sizes)
+
+
+def run_benchmarks(feature_sets, estimators=None, batch_sizes=BATCH_SIZES, isolate=True):
+    # feature_sets is {name: (X_train, y_train, X_test, y_test)} or {name: TrainingData}, returns one row per estimator x feature set.
+    # With isolate every benchmark runs in a fresh process, so the memory the allocator kept from the previous fits
+    # does not hide the peak of the next one and a crash in one estimator doesn't take the others down.
+    estimators = default_estimators() if estimators is None else estimators
+    rows = []
+    for feature_set, data in feature_sets.items():
+        if isinstance(data, TrainingData):
+            function, arguments = _benchmark_training_data, (data, batch_sizes)
+            X_train = data.X_train
+        else:
+            X_train, y_train, X_test, y_test = data
+            X_train, X_test = np.asarray(X_train, dtype=np.float32), np.asarray(X_test, dtype=np.float32)
+            function, arguments = benchmark_estimator, (X_train, y_train, X_test, y_test, batch_sizes)
+        for name, estimator in estimators.items():
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    record = executor.submit(function, estimator, *arguments).result()
+            else:
+                record = function(estimator, *arguments)
+            rows.append({'estimator': name, 'feature_set': feature_set, 'n_train': len(X_train), 'n_features': np.shape(X_train)[1], **record})
+    return pd.DataFrame(rows)
+
+
+def environment():
+    versions = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__}
+    try:
+        import xgboost
+        versions['xgboost'] = xgboost.__version__
+    except ImportError:
+        pass
+    return {'machine': platform.platform(), 'processor': platform.processor(), 'cpu_count': psutil.cpu_count(), 'versions': versions}
+
+
+def save_benchmarks(results, path):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'environment': environment(),
+            'results': results.to_dict(orient='records'),
+        }, file, indent=2)
+
+
+def load_benchmarks(path):
+    with open(path, encoding='utf-8') as file:
+        return pd.DataFrame(json.load(file)['results'])
+
+
+def compare_benchmarks(baseline, current, tolerances=None):
+    # Rows of every metric that got worse than the baseline by more than its tolerance for the same estimator x feature set
+    tolerances = REGRESSION_TOLERANCES if tolerances is None else tolerances
+    merged = baseline.merge(current, on=['estimator', 'feature_set'], suffixes=('_baseline', '_current'))
+    regressions = []
+    for metric, (relative, absolute) in tolerances.items():
+        if f'{metric}_baseline' not in merged or f'{metric}_current' not in merged:
+            continue
+        growth = merged[f'{metric}_current'] - merged[f'{metric}_baseline']
+        change = growth / merged[f'{metric}_baseline']
+        for position in np.flatnonzero(((change > relative) & (growth > absolute)).to_numpy()):
+            row = merged.iloc[position]
+            regressions.append({
+                'estimator': row['estimator'], 'feature_set': row['feature_set'], 'metric': metric,
+                'baseline': row[f'{metric}_baseline'], 'current': row[f'{metric}_current'], 'change': change.iloc[position],
+            })
+    return pd.DataFrame(regressions, columns=['estimator', 'feature_set', 'metric', 'baseline', 'current', 'change'])
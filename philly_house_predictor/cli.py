@@ -0,0 +1,203 @@
+# Command line interface of the pipeline.
+#
+#   python -m philly_house_predictor preprocess --input data_collection/opa_properties_public.csv --n-jobs 0
+#   python -m philly_house_predictor select-features --top-k 10
+#   python -m philly_house_predictor train --estimator XGBoost --params '{"max_depth": 6}' --export
+#   python -m philly_house_predictor evaluate
+#   python -m philly_house_predictor predict new_parcels.csv predictions.csv --check-drift
+#   python -m philly_house_predictor serve --port 8000
+#   python -m philly_house_predictor monitor new_snapshot.csv
+#   python -m philly_house_predictor refresh new_snapshot.csv --check-drift
+#
+# monitor and the --check-drift gates exit with status 2 when the records drifted from the training snapshot.
+# Only argparse and the constants of workflow.py are imported up front. A subcommand imports the modules it runs when it is dispatched, so --help answers right away
+# and `predict` never loads matplotlib, xgboost or the models it doesn't use. Artifacts go to PHILLY_ARTIFACT_DIR like the scripts'.
+import argparse
+import json
+import sys
+
+# workflow.py only imports os at the top
+from .workflow import BUNDLE_NAME, ESTIMATORS, FEATURE_SETS, TRAIN_SALE_WINDOW
+
+
+def _sale_year(value):
+    return None if value.lower() in ('', 'none') else int(value)
+
+
+def _print(summary):
+    print(json.dumps(summary, indent=2, default=str))
+
+
+def _print_report(report, file=None):
+    print(report.round(4).to_string(), file=file)
+
+
+def _preprocess(args):
+    from .workflow import DEFAULT_INPUT, preprocess
+    summary = preprocess(args.input or DEFAULT_INPUT, (args.start_year, args.end_year), streaming=not args.no_streaming,
+                         engine=args.engine, out_of_core=args.out_of_core, n_jobs=args.n_jobs or None)
+    _print({'rows': summary['rows']})
+
+
+def _select_features(args):
+    from .workflow import select_features
+    summary = select_features(args.top_k, args.redundancy_above, out_of_core=args.out_of_core)
+    _print({key: value for key, value in summary.items() if key not in ('correlations', 'stages')})
+
+
+def _train(args):
+    from .workflow import train
+    summary = train(args.estimator, args.feature_set, json.loads(args.params) if args.params else None, args.test_size,
+                    args.random_state, args.n_jobs, args.name, args.export)
+    _print({key: value for key, value in summary.items() if key != 'stages'})
+
+
+def _evaluate(args):
+    from .workflow import evaluate
+    _print(evaluate(args.name, args.compact))
+
+
+def _load_bundle(args):
+    if args.bundle is not None:
+        from .model_bundle import ModelBundle
+        return ModelBundle.load(args.bundle)
+    from .artifacts import read_object
+    return read_object(args.name)
+
+
+def _predict(args):
+    from .drift import DRIFT_OBJECT, DriftError
+    from .serving import predict_file
+    monitor = None
+    if args.check_drift:
+        from .artifacts import read_object
+        monitor = read_object(DRIFT_OBJECT)
+    try:
+        predict_file(_load_bundle(args), args.input, args.output, args.batch_rows, monitor)
+    except DriftError as error:
+        print(f'predict: {error}', file=sys.stderr)
+        _print_report(error.report[error.report['drifted']], file=sys.stderr)
+        return 2
+
+
+def _serve(args):
+    from .serving import serve
+    batching = {}
+    if args.max_batch_rows is not None:
+        batching['max_batch_rows'] = args.max_batch_rows
+    if args.max_batch_delay_ms is not None:
+        batching['max_batch_delay'] = args.max_batch_delay_ms / 1000
+    serve(_load_bundle(args), args.host, args.port, **batching)
+
+
+def _monitor(args):
+    from .artifacts import read_object
+    from .drift import DRIFT_OBJECT, drifted_columns
+    monitor = read_object(DRIFT_OBJECT)
+    if args.input.endswith('.csv'):
+        # Streamed in chunks, only the monitored columns are parsed
+        report = monitor.compare(args.input)
+    else:
+        from .serving import _read_records
+        report = monitor.compare(_read_records(args.input))
+    drifted = drifted_columns(report)
+    if args.all or drifted:
+        _print_report(report if args.all else report.loc[drifted])
+    print(f'drifted: {drifted}' if drifted else 'no drift')
+    return 2 if drifted else 0
+
+
+def _refresh(args):
+    from .drift import DriftError
+    from .incremental import refresh
+    try:
+        summary = refresh(args.snapshot, check_drift=args.check_drift)
+    except DriftError as error:
+        print(f'refresh: {error}, nothing was written', file=sys.stderr)
+        _print_report(error.report[error.report['drifted']], file=sys.stderr)
+        return 2
+    _print({key: value for key, value in summary.items() if key != 'drift_report'})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='philly_house_predictor', description='Philadelphia market_value pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = commands.add_parser('preprocess', help='clean, encode, winsorize and scale a raw OPA csv into artifacts')
+    preprocess.add_argument('--input', help='raw OPA csv, data_preprocessing/original_dataset.csv by default')
+    preprocess.add_argument('--start-year', type=_sale_year, default=TRAIN_SALE_WINDOW[0],
+                            help='first sale year kept (inclusive), open by default')
+    preprocess.add_argument('--end-year', type=_sale_year, default=TRAIN_SALE_WINDOW[1],
+                            help=f"last sale year kept (inclusive), {TRAIN_SALE_WINDOW[1]} by default, 'none' leaves it open")
+    preprocess.add_argument('--engine', choices=('pandas', 'polars'), default='pandas')
+    preprocess.add_argument('--no-streaming', action='store_true', help='load the whole csv at once instead of in chunks')
+    preprocess.add_argument('--out-of-core', action='store_true', help='fit the scaler batch by batch over the filtered artifact')
+    preprocess.add_argument('--n-jobs', type=int, default=1,
+                            help='processes preprocessing shards of the rows in parallel, 0 for every core')
+    preprocess.set_defaults(handler=_preprocess)
+
+    select = commands.add_parser('select-features', help='rank the scaled features and write the top k and PCA artifacts')
+    select.add_argument('--top-k', type=int, default=10)
+    select.add_argument('--redundancy-above', type=float, default=None,
+                        help='skip features correlated above this with an already selected one')
+    select.add_argument('--out-of-core', action='store_true', help='fit an IncrementalPCA batch by batch over the scaled artifact')
+    select.set_defaults(handler=_select_features)
+
+    train = commands.add_parser('train', help='fit a model on the training split of a feature set')
+    train.add_argument('--estimator', choices=ESTIMATORS, default='RandomForest')
+    train.add_argument('--feature-set', choices=FEATURE_SETS, default='high_correlations')
+    train.add_argument('--params', help='estimator parameters as a JSON object, e.g. the best_params_ of a tuning search')
+    train.add_argument('--test-size', type=float, default=0.2)
+    train.add_argument('--random-state', type=int, default=42)
+    train.add_argument('--n-jobs', type=int, default=None)
+    train.add_argument('--name', help=f'artifact name of the model, {BUNDLE_NAME} for the high_correlations features')
+    train.add_argument('--export', action='store_true', help='also export the trees to the compact NumPy format')
+    train.set_defaults(handler=_train)
+
+    evaluate = commands.add_parser('evaluate', help='R^2 and RMSE of a trained model on the rows it held out')
+    evaluate.add_argument('--name', default=BUNDLE_NAME)
+    evaluate.add_argument('--compact', action='store_true', help='evaluate the compact NumPy export of the model')
+    evaluate.set_defaults(handler=_evaluate)
+
+    for command, help_text in (('predict', 'score a csv / json lines / parquet file of raw records'),
+                               ('serve', 'serve predictions over HTTP')):
+        subparser = commands.add_parser(command, help=help_text)
+        subparser.add_argument('--name', default=BUNDLE_NAME, help='artifact name of the model bundle')
+        subparser.add_argument('--bundle', help='path of a saved model bundle, overrides --name')
+        if command == 'predict':
+            subparser.add_argument('input', help="input file, '-' reads json lines from stdin")
+            subparser.add_argument('output', nargs='?', help='output csv, stdout by default')
+            subparser.add_argument('--batch-rows', type=int, default=100_000)
+            subparser.add_argument('--check-drift', action='store_true',
+                                   help='refuse to score records that drifted from the training snapshot')
+            subparser.set_defaults(handler=_predict)
+        else:
+            subparser.add_argument('--host', default='127.0.0.1')
+            subparser.add_argument('--port', type=int, default=8000)
+            # Defaults of philly_house_predictor/serving.py when not given
+            subparser.add_argument('--max-batch-rows', type=int)
+            subparser.add_argument('--max-batch-delay-ms', type=float)
+            subparser.set_defaults(handler=_serve)
+
+    monitor = commands.add_parser('monitor', help='compare a snapshot or a batch of records against the training snapshot')
+    monitor.add_argument('input', help="csv / json lines / parquet file of raw records, '-' reads json lines from stdin")
+    monitor.add_argument('--all', action='store_true', help='report every monitored column, not only the drifted ones')
+    monitor.set_defaults(handler=_monitor)
+
+    refresh = commands.add_parser('refresh', help='apply a new OPA snapshot to the artifacts of the last preprocess run')
+    refresh.add_argument('snapshot', help='new OPA csv')
+    refresh.add_argument('--check-drift', action='store_true',
+                         help='stop without writing anything when the snapshot drifted from the training snapshot')
+    refresh.set_defaults(handler=_refresh)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        # Handlers return a status only when it isn't 0 (2 for drift)
+        return args.handler(args) or 0
+    except FileNotFoundError as error:
+        # A missing input or artifact (a stage run before the one it depends on), without a traceback
+        print(f'{args.command}: {error}', file=sys.stderr)
+        return 1
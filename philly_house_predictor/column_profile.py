@@ -0,0 +1,242 @@
+# Single pass column profiler with cached statistics.
+# Null counts, approximate distinct counts (HyperLogLog) and quantiles of every column are computed in one streaming pass over
+# the csv and persisted to a sidecar file keyed by the hash of the input. The file is split into content defined blocks, so when a
+# new monthly OPA drop arrives only the blocks whose content changed are parsed again, the rest of the statistics are reused.
+import base64
+import hashlib
+import io
+import json
+import os
+import zlib
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+PROFILE_VERSION = 1
+# HyperLogLog with 2^11 registers, about 2.3% standard error on the distinct counts
+HLL_PRECISION = 11
+# Quantiles kept per block (every percentile), merged across blocks by weight
+QUANTILE_PROBABILITIES = np.linspace(0, 1, 101)
+# Block boundaries are chosen from the content of the lines themselves, so inserting or removing rows only changes the blocks
+# around the edit instead of shifting every block after it.
+MIN_BLOCK_ROWS = 16_384
+MAX_BLOCK_ROWS = 262_144
+BOUNDARY_MASK = (1 << 15) - 1
+# Blocks handed to the process pool of profile_csv(executor=...) at once, per core, bounds the raw bytes held by the queue
+PENDING_BLOCKS_PER_CORE = 2
+
+
+def _bit_length(values):
+    # Exact bit length of uint64 values by binary search over the shift widths
+    length = np.zeros(values.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        large = values >= (np.uint64(1) << np.uint64(shift))
+        length += large * shift
+        values = np.where(large, values >> np.uint64(shift), values)
+    return length + (values > 0)
+
+
+def hll_update(registers, hashes):
+    precision = HLL_PRECISION
+    index = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+    remainder = hashes << np.uint64(precision)
+    # Position of the leftmost set bit of the remaining 64 - precision bits
+    rank = np.minimum(65 - _bit_length(remainder), 64 - precision + 1).astype(np.uint8)
+    np.maximum.at(registers, index, rank)
+    return registers
+
+
+def hll_estimate(registers):
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        # Linear counting is more accurate for small cardinalities
+        estimate = m * np.log(m / zeros)
+    return float(estimate)
+
+
+def _encode_registers(registers):
+    return base64.b64encode(zlib.compress(registers.tobytes())).decode('ascii')
+
+
+def _decode_registers(text):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype=np.uint8).copy()
+
+
+def _iter_blocks(file):
+    # Yields the raw bytes of consecutive blocks of records. A boundary is only placed between records,
+    # never inside a quoted field spanning several lines.
+    lines = []
+    in_quotes = False
+    for line in file:
+        lines.append(line)
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        if in_quotes or len(lines) < MIN_BLOCK_ROWS:
+            continue
+        if len(lines) >= MAX_BLOCK_ROWS or (zlib.crc32(line) & BOUNDARY_MASK) == 0:
+            yield b''.join(lines)
+            lines = []
+    if lines:
+        yield b''.join(lines)
+
+
+def profile_block(header, block):
+    # Every value is read as text so that null detection and hashing are identical across blocks
+    df = pd.read_csv(io.BytesIO(header + block), dtype=str)
+    stats = {'rows': len(df), 'columns': {}}
+    for col in df.columns:
+        values = df[col].dropna()
+        registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+        if len(values):
+            hll_update(registers, pd.util.hash_array(values.to_numpy(dtype=object)))
+        numbers = pd.to_numeric(values, errors='coerce').dropna()
+        # Only columns where every value is numerical get quantiles
+        numeric = len(numbers) == len(values) and len(values) > 0
+        stats['columns'][col] = {
+            'nulls': int(len(df) - len(values)),
+            'hll': _encode_registers(registers),
+            'quantiles': np.quantile(numbers.to_numpy(dtype=np.float64), QUANTILE_PROBABILITIES).tolist() if numeric else None,
+        }
+    return stats
+
+
+class ColumnProfile:
+    def __init__(self, file_sha256, columns, blocks):
+        self.file_sha256 = file_sha256
+        self.columns = columns
+        # [{'sha1': ..., 'rows': ..., 'columns': {col: {'nulls', 'hll', 'quantiles'}}}] in file order
+        self.blocks = blocks
+        self.rows = sum(block['rows'] for block in blocks)
+        self._distinct_count = None
+
+    def null_count(self):
+        return pd.Series({col: sum(block['columns'][col]['nulls'] for block in self.blocks) for col in self.columns}, dtype=float)
+
+    def null_fraction(self):
+        return self.null_count() / max(self.rows, 1)
+
+    def distinct_count(self):
+        if self._distinct_count is None:
+            counts = {}
+            for col in self.columns:
+                registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+                for block in self.blocks:
+                    # Merging HyperLogLog sketches is an element wise maximum of the registers
+                    np.maximum(registers, _decode_registers(block['columns'][col]['hll']), out=registers)
+                counts[col] = hll_estimate(registers)
+            self._distinct_count = pd.Series(counts, dtype=float)
+        return self._distinct_count
+
+    def distinct_fraction(self):
+        return self.distinct_count() / max(self.rows, 1)
+
+    def quantiles(self, col, probabilities):
+        # Weighted merge of the per block percentiles, each point stands for an equal share of its block's non-null values
+        points, weights = [], []
+        for block in self.blocks:
+            stats = block['columns'][col]
+            if stats['quantiles'] is None:
+                if block['rows'] > stats['nulls']:
+                    # At least one block has text values, so the column has no quantiles
+                    return None
+                continue
+            count = block['rows'] - stats['nulls']
+            points.append(np.asarray(stats['quantiles']))
+            weights.append(np.full(len(stats['quantiles']), count / len(stats['quantiles'])))
+        if not points:
+            return None
+        points, weights = np.concatenate(points), np.concatenate(weights)
+        order = np.argsort(points)
+        cumulative = np.cumsum(weights[order])
+        targets = np.asarray(probabilities) * cumulative[-1]
+        positions = np.minimum(np.searchsorted(cumulative, targets), len(points) - 1)
+        return points[order][positions]
+
+    def summary(self):
+        summary = pd.DataFrame({
+            'null_fraction': self.null_fraction(),
+            'distinct_count': self.distinct_count(),
+        })
+        summary['distinct_fraction'] = summary['distinct_count'] / max(self.rows, 1)
+        for probability in (0.05, 0.25, 0.5, 0.75, 0.95):
+            values = []
+            for col in self.columns:
+                quantile = self.quantiles(col, [probability])
+                values.append(np.nan if quantile is None else quantile[0])
+            summary[f'q{int(probability * 100)}'] = values
+        return summary
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'version': PROFILE_VERSION, 'file_sha256': self.file_sha256,
+                       'columns': self.columns, 'blocks': self.blocks}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != PROFILE_VERSION:
+            raise ValueError(f"{path} was written by an incompatible profile version {data.get('version')}")
+        return cls(data['file_sha256'], data['columns'], data['blocks'])
+
+
+def default_sidecar_path(path):
+    return f'{path}.profile.json'
+
+
+def profile_csv(path, sidecar_path=None, previous_sidecar_paths=(), executor=None):
+    # Returns the ColumnProfile of the csv at path. Blocks already profiled in the sidecar (or in the sidecars of previous
+    # snapshots) are reused, only new or changed blocks are parsed. The sidecar is rewritten when anything changed.
+    # With a concurrent.futures executor the new blocks are parsed by its workers while the file is still being read.
+    sidecar_path = sidecar_path or default_sidecar_path(path)
+    known_blocks = {}
+    cached = None
+    for candidate in [sidecar_path, *previous_sidecar_paths]:
+        if os.path.exists(candidate):
+            try:
+                profile = ColumnProfile.load(candidate)
+            except ValueError:
+                continue
+            cached = cached or (profile if candidate == sidecar_path else None)
+            known_blocks.update({block['sha1']: block for block in profile.blocks})
+
+    file_hash = hashlib.sha256()
+    order, pending = [], {}
+    max_pending = PENDING_BLOCKS_PER_CORE * (os.cpu_count() or 1)
+    with open(path, 'rb') as file:
+        header = file.readline()
+        file_hash.update(header)
+        for block in _iter_blocks(file):
+            file_hash.update(block)
+            block_hash = hashlib.sha1(header + block).hexdigest()
+            order.append(block_hash)
+            if block_hash in known_blocks or block_hash in pending:
+                continue
+            if executor is None:
+                known_blocks[block_hash] = {'sha1': block_hash, **profile_block(header, block)}
+                continue
+            pending[block_hash] = executor.submit(profile_block, header, block)
+            running = [future for future in pending.values() if not future.done()]
+            if len(running) >= max_pending:
+                wait(running, return_when=FIRST_COMPLETED)
+    for block_hash, future in pending.items():
+        known_blocks[block_hash] = {'sha1': block_hash, **future.result()}
+    blocks = [known_blocks[block_hash] for block_hash in order]
+
+    if cached is not None and cached.file_sha256 == file_hash.hexdigest():
+        return cached
+
+    columns = list(blocks[0]['columns']) if blocks else []
+    profile = ColumnProfile(file_hash.hexdigest(), columns, blocks)
+    profile.save(sidecar_path)
+    return profile
+
+
+def reused_block_count(profile, previous):
+    # Number of blocks of profile that were reused from a previous profile, useful to report how incremental a refresh was
+    previous_hashes = {block['sha1'] for block in previous.blocks}
+    return sum(block['sha1'] in previous_hashes for block in profile.blocks)
@@ -0,0 +1,103 @@
+# Compact tree ensemble predictor.
+# The trees of an exported model (see philly_house_predictor/model_export.py) are flattened into a handful of NumPy arrays
+# (split feature, threshold, children and value of every node, trees laid out one after the other) in a single .npz file.
+# Prediction walks every tree for a block of rows at once: each step gathers the current node of all (tree, row) pairs and moves
+# them to a child, so a batch costs depth vectorized steps instead of a Python call per tree. Only NumPy is imported, which keeps
+# the cold start of a scoring process to loading the arrays.
+import json
+
+import numpy as np
+
+# (tree, row) pairs walked at once, bounds the memory of the node / feature value blocks
+BLOCK_PAIRS = 1 << 20
+# Steps between removing the pairs that reached their leaf from the walk
+COMPACT_EVERY = 3
+
+
+class CompactForest:
+    # strict: a row goes left when its value is < the threshold (XGBoost) instead of <= (scikit-learn)
+    # average: the prediction is the mean of the trees (forests) instead of their sum (boosting), plus base_score either way
+    def __init__(self, feature, threshold, left, right, missing_left, value, roots, depth, base_score=0.0, average=False,
+                 strict=False, features=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.missing_left = missing_left
+        self.value = value
+        self.roots = roots
+        self.depth = int(depth)
+        self.base_score = float(base_score)
+        self.average = bool(average)
+        self.strict = bool(strict)
+        self.features = None if features is None else list(features)
+        # The (left, right) pair of every node next to each other, so moving to a child is a single gather
+        self._children = np.column_stack([left, right]).ravel()
+        self._leaf = left == np.arange(len(left))
+
+    def predict(self, X):
+        # X is a (rows, features) array in the column order of features, with NaN for missing values
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[None, :]
+        predictions = np.empty(len(X))
+        block_rows = max(1, BLOCK_PAIRS // len(self.roots))
+        for start in range(0, len(X), block_rows):
+            predictions[start:start + block_rows] = self._predict_block(X[start:start + block_rows])
+        return predictions
+
+    def _predict_block(self, X):
+        values = X.ravel()
+        has_missing = bool(np.isnan(values).any())
+        # Flat (tree, row) pairs still walking: their node, the offset of their row in values and their position in the output.
+        # Pairs of the same tree are next to each other, so consecutive gathers hit the nodes of one tree instead of all of them.
+        node = np.repeat(self.roots.astype(np.int64), len(X))
+        offsets = np.tile(np.arange(len(X), dtype=np.int64) * X.shape[1], len(self.roots))
+        pairs = np.arange(len(node))
+        leaves = np.empty(len(node), dtype=np.int64)
+        for step in range(self.depth):
+            x = values[offsets + self.feature[node]]
+            threshold = self.threshold[node]
+            # NaN fails the comparison and goes right, unless the tree sends missing values left
+            go_right = ~(x < threshold) if self.strict else ~(x <= threshold)
+            if has_missing:
+                go_right &= ~(np.isnan(x) & self.missing_left[node])
+            node = self._children[2 * node + go_right]
+            if step % COMPACT_EVERY == COMPACT_EVERY - 1:
+                # Pairs that reached a leaf stop walking
+                done = self._leaf[node]
+                leaves[pairs[done]] = node[done]
+                walking = ~done
+                node, offsets, pairs = node[walking], offsets[walking], pairs[walking]
+        # Leaves point to themselves, so the pairs left after the last step are on their leaf as well
+        leaves[pairs] = node
+        # Summed tree by tree in order, like scikit-learn accumulates its trees
+        total = self.value[leaves].reshape(len(self.roots), len(X)).sum(axis=0)
+        if self.average:
+            total /= len(self.roots)
+        return total + self.base_score
+
+    def to_arrays(self):
+        meta = {'depth': self.depth, 'base_score': self.base_score, 'average': self.average, 'strict': self.strict,
+                'features': self.features}
+        return {
+            'feature': self.feature, 'threshold': self.threshold, 'left': self.left, 'right': self.right,
+            'missing_left': self.missing_left, 'value': self.value, 'roots': self.roots,
+            'meta': np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8),
+        }
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        meta = json.loads(bytes(arrays['meta']).decode('utf-8'))
+        return cls(
+            arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'], arrays['missing_left'].astype(bool),
+            arrays['value'], arrays['roots'], **meta,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls.from_arrays({name: arrays[name] for name in arrays.files})
@@ -0,0 +1,127 @@
+# Comparable sales lookup.
+# The training parcels are indexed by location in a KD-tree over their lat / lng projected to meters, so the k nearest homes of a
+# parcel are found in O(log n) (tens of microseconds for a single parcel) instead of scanning every parcel, and the neighbours of
+# the whole dataset in O(n log n) instead of O(n^2). With candidates > 1 the k * candidates nearest parcels are re-ranked by the
+# distance of their (standardized) features, which keeps the k most similar homes of the neighbourhood.
+# Aggregates of the neighbours' values are also available as features, see neighbour_features.
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from .ingest import COORDINATE_COLUMNS
+
+COMPARABLES_OBJECT = 'comparables_index'
+N_COMPARABLES = 10
+# Rows queried at once, bounds the (rows, k * candidates, features) block of the re-ranking
+QUERY_BATCH_ROWS = 65_536
+# Length of a degree of latitude, a degree of longitude is shorter by cos(latitude)
+METERS_PER_DEGREE = 111_320.0
+NEIGHBOUR_FEATURES = ['comparables_mean', 'comparables_median', 'comparables_weighted_mean', 'comparables_distance']
+
+
+def _array(values):
+    return values.to_numpy(dtype=np.float64) if isinstance(values, (pd.DataFrame, pd.Series)) else np.asarray(values, dtype=np.float64)
+
+
+def _coordinates(coordinates):
+    # (rows, 2) array of lat, lng out of a DataFrame with COORDINATE_COLUMNS or an array like
+    if isinstance(coordinates, pd.DataFrame):
+        coordinates = coordinates[COORDINATE_COLUMNS]
+    return _array(coordinates).reshape(-1, 2)
+
+
+class ComparablesIndex:
+    def __init__(self, k=N_COMPARABLES, candidates=1, leaf_size=40):
+        self.k = k
+        self.candidates = candidates
+        self.leaf_size = leaf_size
+
+    def _project(self, coordinates):
+        # (lat, lng) in degrees to (x, y) in meters, exact enough over the extent of a city
+        return np.column_stack([
+            coordinates[:, 1] * self.meters_per_longitude_,
+            coordinates[:, 0] * METERS_PER_DEGREE,
+        ])
+
+    def fit(self, coordinates, values, features=None):
+        # coordinates holds the lat and lng of every training parcel (a DataFrame with COORDINATE_COLUMNS keeps its index as the
+        # parcel keys), values their market value. Parcels without coordinates are left out.
+        keys = coordinates.index.to_numpy() if isinstance(coordinates, pd.DataFrame) else np.arange(len(coordinates))
+        coordinates = _coordinates(coordinates)
+        located = ~np.isnan(coordinates).any(axis=1)
+        if located.sum() <= self.k:
+            raise ValueError(f"Only {located.sum()} parcels have coordinates, at least {self.k + 1} are needed")
+
+        self.meters_per_longitude_ = METERS_PER_DEGREE * np.cos(np.radians(np.mean(coordinates[located, 0])))
+        self.tree_ = KDTree(self._project(coordinates[located]), leaf_size=self.leaf_size)
+        self.keys_ = keys[located]
+        self.values_ = _array(values)[located]
+        self.features_ = None if features is None else np.ascontiguousarray(_array(features)[located], dtype=np.float32)
+        # Position of every fitted row in the tree, -1 for the rows without coordinates (used to exclude a parcel from its own
+        # comparables)
+        self.positions_ = np.where(located, np.cumsum(located) - 1, -1)
+        return self
+
+    def _query(self, points, features, k, own):
+        # Positions (rows, k) of the comparables of every point and their distances in meters
+        wanted = k * self.candidates if features is not None and self.features_ is not None else k
+        wanted = max(k, min(wanted, len(self.values_) - 1))
+        # One more than needed when the point may be one of the fitted parcels
+        distances, positions = self.tree_.query(points, k=wanted + (own is not None), sort_results=True)
+        if own is not None:
+            keep = positions != own[:, None]
+            # A parcel that wasn't found among its own neighbours (coordinates shared with more parcels) drops its farthest one
+            keep[keep.all(axis=1), -1] = False
+            distances = distances[keep].reshape(len(points), wanted)
+            positions = positions[keep].reshape(len(points), wanted)
+        if wanted > k:
+            dissimilarity = np.square(self.features_[positions] - features[:, None, :]).sum(axis=2)
+            order = np.argsort(dissimilarity, axis=1, kind='stable')[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            positions = np.take_along_axis(positions, order, axis=1)
+        return positions, distances
+
+    def query(self, coordinates, features=None, k=None, exclude_self=False):
+        # Positions and distances of the k comparables of every parcel, NaN distances / -1 positions for the parcels without
+        # coordinates. With exclude_self, coordinates (and features) must be the rows the index was fitted on.
+        coordinates = _coordinates(coordinates)
+        k = self.k if k is None else k
+        features = None if features is None else np.asarray(_array(features), dtype=np.float32).reshape(len(coordinates), -1)
+        if exclude_self and len(coordinates) != len(self.positions_):
+            raise ValueError("exclude_self needs the coordinates of the parcels the index was fitted on")
+
+        positions = np.full((len(coordinates), k), -1, dtype=np.int64)
+        distances = np.full((len(coordinates), k), np.nan)
+        rows = np.flatnonzero(~np.isnan(coordinates).any(axis=1))
+        for start in range(0, len(rows), QUERY_BATCH_ROWS):
+            batch = rows[start:start + QUERY_BATCH_ROWS]
+            own = self.positions_[batch] if exclude_self else None
+            positions[batch], distances[batch] = self._query(
+                self._project(coordinates[batch]), None if features is None else features[batch], k, own)
+        return positions, distances
+
+    def comparables(self, lat, lng, features=None, k=None):
+        # The k comparable homes of a single parcel, nearest first
+        positions, distances = self.query([[lat, lng]], None if features is None else [features], k)
+        return pd.DataFrame({
+            'parcel': self.keys_[positions[0]],
+            'distance_m': distances[0],
+            'value': self.values_[positions[0]],
+        })
+
+    def neighbour_features(self, coordinates, features=None, exclude_self=False):
+        # Aggregates of the values of every parcel's comparables: mean, median, inverse distance weighted mean and the mean distance
+        # to them in meters. Use exclude_self=True for the fitted parcels so none of them sees its own value.
+        positions, distances = self.query(coordinates, features, exclude_self=exclude_self)
+        values = np.where(positions >= 0, self.values_[positions], np.nan)
+        # Comparables at the same point as the parcel count as 1 meter away
+        weights = 1 / np.maximum(distances, 1.0)
+        aggregates = pd.DataFrame({
+            'comparables_mean': values.mean(axis=1),
+            'comparables_median': np.median(values, axis=1),
+            'comparables_weighted_mean': (values * weights).sum(axis=1) / weights.sum(axis=1),
+            'comparables_distance': distances.mean(axis=1),
+        }, columns=NEIGHBOUR_FEATURES)
+        if isinstance(coordinates, pd.DataFrame):
+            aggregates.index = coordinates.index
+        return aggregates.astype(np.float32)
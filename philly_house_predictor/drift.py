@@ -0,0 +1,309 @@
+# Drift and data quality monitor of the OPA snapshots.
+# Compact sketches of the single family records of the training snapshot are kept with the artifacts: the percentiles of every
+# chunk of every numerical column (merged by weight, like philly_house_predictor/column_profile.py), a frequency table of every
+# categorical column, the null rates, and the share of records the valid category lists of the preprocessing stages filter out.
+# A new snapshot or a batch of records to score is compared against them in one streaming pass. Numerical values are counted
+# against the reference percentiles, which gives a Kolmogorov-Smirnov distance and the population stability index (PSI) over the
+# reference deciles. Categories are counted against the frequency table, which gives the PSI over the categories and the share of
+# values the training snapshot never had. Columns past the thresholds are flagged as drifted, so a refresh or a scoring run can be
+# stopped before a shifted data drop is silently filtered out or changes the model.
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype, is_numeric_dtype
+
+from .column_profile import QUANTILE_PROBABILITIES
+from .ingest import CATEGORICAL_COLUMNS, FLOAT32_COLUMNS, INGEST_CHUNKSIZE, KNOWN_DROPPED_COLUMNS
+from .stages import build_preprocessing_pipeline
+
+DRIFT_OBJECT = 'drift_monitor'
+# Only the records the model is trained on and scores are compared, the other property categories are distributed differently
+POPULATION_FILTER = ('category_code_description', 'SINGLE FAMILY')
+# Categories kept per frequency table, the rarest ones beyond that only count towards 'other' (and as unseen in new records)
+MAX_CATEGORIES = 10_000
+# Bins of the PSI of a numerical column: the reference deciles
+PSI_QUANTILES = np.linspace(0.1, 0.9, 9)
+# Empty bins count as this fraction, a bin that is empty on one side only would have an infinite PSI
+MIN_BIN_FRACTION = 1e-4
+# A PSI above 0.2 is the usual rule of thumb for a significant shift
+PSI_THRESHOLD = 0.2
+KS_THRESHOLD = 0.1
+# Shares of the values / records, as an increase over the reference for the null and filtered shares
+UNSEEN_THRESHOLD = 0.01
+NULL_THRESHOLD = 0.05
+FILTERED_THRESHOLD = 0.02
+# Columns with fewer values in the new records are reported but never flagged, the statistics of a handful of records are noise
+MIN_ROWS = 500
+REPORT_COLUMNS = ['kind', 'rows', 'null_fraction_reference', 'null_fraction', 'psi', 'ks', 'unseen_fraction',
+                  'filtered_fraction_reference', 'filtered_fraction', 'drifted']
+# Positions of the PSI bin edges among the reference percentiles
+_PSI_POSITIONS = np.rint(PSI_QUANTILES * (len(QUANTILE_PROBABILITIES) - 1)).astype(int)
+
+
+class DriftError(ValueError):
+    # Raised by the gates (incremental.refresh, serving.predict_file) when columns drifted, report holds the comparison
+    def __init__(self, report):
+        self.report = report
+        super().__init__(f"The records drifted from the training snapshot in {drifted_columns(report)}")
+
+
+def drifted_columns(report):
+    return list(report.index[report['drifted'].to_numpy(dtype=bool)])
+
+
+def _psi(reference, current):
+    reference = np.maximum(reference, MIN_BIN_FRACTION)
+    current = np.maximum(current, MIN_BIN_FRACTION)
+    return float(np.sum((current - reference) * np.log(current / reference)))
+
+
+def _numbers(series):
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+
+
+def _text(series):
+    # Categories as the csv publishes them, numbers of json / parquet records (19143 or 19143.0) as '19143'
+    if is_numeric_dtype(series):
+        numbers = series.astype(np.float64)
+        integral = numbers.notna() & (numbers % 1 == 0)
+        text = numbers.astype(str).where(~integral, numbers.where(integral, 0).astype(np.int64).astype(str))
+        return text.where(series.notna())
+    if infer_dtype(series, skipna=True) in ('string', 'empty'):
+        return series
+    return series.astype(str).where(series.notna())
+
+
+def _population(chunk):
+    column, value = POPULATION_FILTER
+    return chunk[chunk[column] == value] if column in chunk.columns else chunk
+
+
+def _valid_values():
+    # {column: (valid values, imputed value)} of the 'isin' row filters of the preprocessing stages
+    pipeline = build_preprocessing_pipeline()
+    fills = pipeline.fill_values()
+    return {column: (list(values), fills.get(column))
+            for stage in pipeline.stages for column, operator, values in stage.row_filters if operator == 'isin'}
+
+
+def _filtered(chunk, column, valid, fill, numeric):
+    # Records of the chunk the filter removes, missing values take the imputed value first like in the pipeline
+    if numeric:
+        values = _numbers(chunk[column])
+        if fill is not None:
+            values = np.where(np.isnan(values), fill, values)
+        return int(np.count_nonzero(~np.isin(values, np.asarray(valid, dtype=np.float64))))
+    values = _text(chunk[column])
+    if fill is not None:
+        values = values.fillna(fill)
+    return int(np.count_nonzero(~values.isin(valid).to_numpy()))
+
+
+def _reference_quantiles(points, weights):
+    # Reference percentiles out of the weighted percentiles of the chunks, and the share of the values at or below every one of them
+    order = np.argsort(points, kind='stable')
+    points, cumulative = points[order], np.cumsum(weights[order])
+    positions = np.minimum(np.searchsorted(cumulative, QUANTILE_PROBABILITIES * cumulative[-1]), len(points) - 1)
+    quantiles = points[positions]
+    cdf = cumulative[np.searchsorted(points, quantiles, side='right') - 1] / cumulative[-1]
+    return quantiles, cdf
+
+
+def _read_chunks(source, numeric_columns, categorical_columns, chunksize):
+    # Frames out of a csv path (only the needed columns, the numerical ones parsed by the csv reader like the streaming ingest does),
+    # a DataFrame or an iterable of DataFrames
+    if isinstance(source, str):
+        dtypes = {**{col: str for col in categorical_columns}, **{col: np.float64 for col in numeric_columns}, POPULATION_FILTER[0]: str}
+        return pd.read_csv(source, dtype=dtypes, usecols=lambda col: col in dtypes, chunksize=chunksize)
+    if isinstance(source, pd.DataFrame):
+        return [source]
+    return source
+
+
+class DriftMonitor:
+    def __init__(self, numeric_columns=None, categorical_columns=None, exclude=(), psi_threshold=PSI_THRESHOLD,
+                 ks_threshold=KS_THRESHOLD, unseen_threshold=UNSEEN_THRESHOLD, null_threshold=NULL_THRESHOLD,
+                 filtered_threshold=FILTERED_THRESHOLD, min_rows=MIN_ROWS, chunksize=INGEST_CHUNKSIZE):
+        # The columns the pipeline keeps by default, exclude takes the columns a run dropped (preprocess_state['dropped_columns'])
+        skipped = set(exclude) | set(KNOWN_DROPPED_COLUMNS) | {POPULATION_FILTER[0]}
+        self.numeric_columns = [col for col in (FLOAT32_COLUMNS if numeric_columns is None else numeric_columns) if col not in skipped]
+        self.categorical_columns = [col for col in (CATEGORICAL_COLUMNS if categorical_columns is None else categorical_columns)
+                                    if col not in skipped]
+        self.psi_threshold = psi_threshold
+        self.ks_threshold = ks_threshold
+        self.unseen_threshold = unseen_threshold
+        self.null_threshold = null_threshold
+        self.filtered_threshold = filtered_threshold
+        self.min_rows = min_rows
+        self.chunksize = chunksize
+
+    @property
+    def columns(self):
+        return self.numeric_columns + self.categorical_columns
+
+    def fit(self, source):
+        # source is the path of the training snapshot csv, its records as a DataFrame or an iterable of DataFrames
+        self.rows_ = 0
+        self.valid_values_ = {col: rule for col, rule in _valid_values().items() if col in self.columns}
+        self.filtered_ = {col: 0 for col in self.valid_values_}
+        self.numeric_ = {col: {'count': 0, 'nulls': 0, 'points': np.empty(0), 'weights': np.empty(0)} for col in self.numeric_columns}
+        self.categorical_ = {col: {'count': 0, 'nulls': 0, 'counts': pd.Series(dtype=np.int64), 'other': 0}
+                             for col in self.categorical_columns}
+        for chunk in _read_chunks(source, self.numeric_columns, self.categorical_columns, self.chunksize):
+            self._add(_population(chunk))
+        self._finish()
+        return self
+
+    def _add(self, chunk):
+        self.rows_ += len(chunk)
+        for col, sketch in self.numeric_.items():
+            if col not in chunk.columns:
+                continue
+            values = _numbers(chunk[col])
+            values = values[~np.isnan(values)]
+            sketch['nulls'] += len(chunk) - len(values)
+            if len(values):
+                sketch['count'] += len(values)
+                sketch['points'] = np.concatenate([sketch['points'], np.quantile(values, QUANTILE_PROBABILITIES)])
+                sketch['weights'] = np.concatenate([sketch['weights'], np.full(len(QUANTILE_PROBABILITIES), len(values) / len(QUANTILE_PROBABILITIES))])
+        for col, sketch in self.categorical_.items():
+            if col not in chunk.columns:
+                continue
+            counts = _text(chunk[col]).value_counts()
+            sketch['nulls'] += len(chunk) - int(counts.sum())
+            sketch['count'] += int(counts.sum())
+            sketch['counts'] = sketch['counts'].add(counts, fill_value=0).astype(np.int64)
+        for col, (valid, fill) in self.valid_values_.items():
+            if col in chunk.columns:
+                self.filtered_[col] += _filtered(chunk, col, valid, fill, col in self.numeric_)
+
+    def _finish(self):
+        for sketch in self.numeric_.values():
+            if sketch['count']:
+                sketch['quantiles'], sketch['cdf'] = _reference_quantiles(sketch['points'], sketch['weights'])
+            else:
+                sketch['quantiles'] = sketch['cdf'] = None
+        for sketch in self.categorical_.values():
+            counts = sketch['counts'].sort_values(ascending=False, kind='stable')
+            sketch['other'] += int(counts.iloc[MAX_CATEGORIES:].sum())
+            sketch['counts'] = counts.iloc[:MAX_CATEGORIES]
+
+    def merge(self, other):
+        # Adds the records another DriftMonitor (with the same columns) was fitted on, e.g. the shards of
+        # philly_house_predictor/parallel_preprocessing.py
+        self.rows_ += other.rows_
+        for col in self.filtered_:
+            self.filtered_[col] += other.filtered_[col]
+        for col, sketch in self.numeric_.items():
+            added = other.numeric_[col]
+            for key in ('count', 'nulls'):
+                sketch[key] += added[key]
+            sketch['points'] = np.concatenate([sketch['points'], added['points']])
+            sketch['weights'] = np.concatenate([sketch['weights'], added['weights']])
+        for col, sketch in self.categorical_.items():
+            added = other.categorical_[col]
+            for key in ('count', 'nulls', 'other'):
+                sketch[key] += added[key]
+            sketch['counts'] = sketch['counts'].add(added['counts'], fill_value=0).astype(np.int64)
+        self._finish()
+        return self
+
+    def check(self):
+        # A DriftCheck to feed new records chunk by chunk, e.g. while a snapshot is streamed for another purpose
+        return DriftCheck(self)
+
+    def compare(self, source):
+        # Report of new records (a csv path, a DataFrame or an iterable of DataFrames) against the training snapshot
+        check = self.check()
+        for chunk in _read_chunks(source, self.numeric_columns, self.categorical_columns, self.chunksize):
+            check.update(chunk)
+        return check.report()
+
+
+class DriftCheck:
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.rows = 0
+        self.present = set()
+        self.filtered = {col: 0 for col in monitor.valid_values_}
+        # Nulls, values and the number of values at or below every reference percentile
+        self.numeric = {col: [0, 0, np.zeros(len(QUANTILE_PROBABILITIES), dtype=np.int64)]
+                        for col, sketch in monitor.numeric_.items() if sketch['quantiles'] is not None}
+        self.categorical = {col: [0, pd.Series(dtype=np.int64)] for col in monitor.categorical_}
+
+    def update(self, chunk):
+        chunk = _population(chunk)
+        self.rows += len(chunk)
+        self.present.update(col for col in self.monitor.columns if col in chunk.columns)
+        for col, counts in self.numeric.items():
+            if col not in chunk.columns:
+                continue
+            values = _numbers(chunk[col])
+            values = np.sort(values[~np.isnan(values)])
+            counts[0] += len(chunk) - len(values)
+            counts[1] += len(values)
+            counts[2] += np.searchsorted(values, self.monitor.numeric_[col]['quantiles'], side='right')
+        for col, counts in self.categorical.items():
+            if col not in chunk.columns:
+                continue
+            values = _text(chunk[col]).value_counts()
+            counts[0] += len(chunk) - int(values.sum())
+            counts[1] = counts[1].add(values, fill_value=0).astype(np.int64)
+        for col, (valid, fill) in self.monitor.valid_values_.items():
+            if col in chunk.columns:
+                self.filtered[col] += _filtered(chunk, col, valid, fill, col in self.monitor.numeric_)
+        return self
+
+    def _numeric_row(self, col):
+        sketch = self.monitor.numeric_[col]
+        nulls, count, at_or_below = self.numeric[col]
+        row = {'kind': 'numeric', 'rows': count, 'null_fraction': nulls / max(nulls + count, 1)}
+        if count:
+            cdf = at_or_below / count
+            row['ks'] = float(np.max(np.abs(cdf - sketch['cdf'])))
+            row['psi'] = _psi(np.diff(np.r_[0, sketch['cdf'][_PSI_POSITIONS], 1]), np.diff(np.r_[0, cdf[_PSI_POSITIONS], 1]))
+        return row
+
+    def _categorical_row(self, col):
+        sketch = self.monitor.categorical_[col]
+        nulls, counts = self.categorical[col]
+        count = int(counts.sum())
+        row = {'kind': 'categorical', 'rows': count, 'null_fraction': nulls / max(nulls + count, 1)}
+        if count and sketch['count']:
+            reference = sketch['counts'].to_numpy() / sketch['count']
+            current = counts.reindex(sketch['counts'].index, fill_value=0).to_numpy() / count
+            # Values outside of the frequency table, the categories the training snapshot never had (or its rarest ones)
+            row['unseen_fraction'] = float(1 - current.sum())
+            row['psi'] = _psi(np.r_[reference, sketch['other'] / sketch['count']], np.r_[current, row['unseen_fraction']])
+        return row
+
+    def report(self):
+        # One row per monitored column present in the records, indexed by column
+        monitor = self.monitor
+        rows = {}
+        for col in monitor.columns:
+            if col not in self.present:
+                continue
+            if col in self.numeric:
+                row = self._numeric_row(col)
+            elif col in self.categorical:
+                row = self._categorical_row(col)
+            else:
+                continue
+            sketch = monitor.numeric_.get(col) or monitor.categorical_[col]
+            row['null_fraction_reference'] = sketch['nulls'] / max(sketch['nulls'] + sketch['count'], 1)
+            if col in self.filtered:
+                row['filtered_fraction_reference'] = monitor.filtered_[col] / max(monitor.rows_, 1)
+                row['filtered_fraction'] = self.filtered[col] / max(self.rows, 1)
+            rows[col] = row
+        report = pd.DataFrame.from_dict(rows, orient='index').reindex(columns=REPORT_COLUMNS)
+        report.index.name = 'column'
+        enough = report['rows'].fillna(0).to_numpy() >= monitor.min_rows
+        drifted = (
+            (report['psi'] > monitor.psi_threshold)
+            | (report['ks'] > monitor.ks_threshold)
+            | (report['unseen_fraction'] > monitor.unseen_threshold)
+            | (report['null_fraction'] - report['null_fraction_reference'] > monitor.null_threshold)
+            | (report['filtered_fraction'] - report['filtered_fraction_reference'] > monitor.filtered_threshold)
+        ).to_numpy()
+        report['drifted'] = drifted & enough
+        return report
@@ -0,0 +1,162 @@
+# Fitted feature encoder for the preprocessed OPA dataset.
+# Replaces the separate OrdinalEncoder / OneHotEncoder / BinaryEncoder blocks: every column is encoded in a single vectorized pass
+# straight into one contiguous float32 matrix, and the fitted encoder can be saved and reused to score new parcels without refitting.
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+from .stages import valid_basement, valid_type_heater
+
+# Ordinal encodings as {column: (encoded column, categories in order)}, None learns the sorted values of the column
+ORDINAL_FEATURES = {
+    # Basements ordinal scale from the OPA's metadata (K is the imputed unknown)
+    'basements': ('basements_encoded', valid_basement),
+    # Exterior / Interior condition are numerical labels where the order represents the condition
+    'exterior_condition': ('exterior_encoded', None),
+    'interior_condition': ('interior_encoded', None),
+    'type_heater': ('type_heater_encoded', valid_type_heater),
+}
+
+# One hot encoded as there is no order and we don't want to influence priority
+ONE_HOT_FEATURES = ('view_type', 'topography', 'parcel_shape')
+
+# Most of the homestead exemptions are either 0 or 80,000, so it is reduced to whether the taxable portion was reduced or not
+INDICATOR_FEATURES = {'homestead_exemption': 'homestead_exemption_encoded'}
+
+# Nominal attributes with too many values for one hot encoding. Like category_encoders' BinaryEncoder, every value gets an ordinal
+# in order of appearance starting at 1 (0 is kept for unseen values) written as bits, most significant bit first in {column}_0.
+BINARY_FEATURES = ('zoning', 'zip_code', 'year_built', 'geographic_ward', 'census_tract', 'street_name', 'street_designation')
+
+
+def _is_numeric(series):
+    values = series.dropna()
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return True
+    return len(values) > 0 and pd.to_numeric(values.astype(object), errors='coerce').notna().all()
+
+
+def _keys(series, numeric):
+    # Values are compared either as numbers or as text, decided at fit time, so 1925, 1925.0 and '1925'
+    # are the same year_built whether they come from the training csv or from a json record at scoring time.
+    if numeric:
+        return pd.to_numeric(series.astype(object), errors='coerce').astype(np.float64)
+    return series.astype(object).where(series.notna(), None).map(lambda value: value if value is None else str(value))
+
+
+def _codes(keys, categories):
+    # Position of every value in categories, -1 for missing or unseen values
+    return pd.Categorical(keys, categories=categories).codes.astype(np.int64)
+
+
+class FeatureEncoder(BaseEstimator, TransformerMixin):
+    def __init__(self, ordinal=None, one_hot=ONE_HOT_FEATURES, indicator=None, binary=BINARY_FEATURES, dtype=np.float32):
+        self.ordinal = ordinal
+        self.one_hot = one_hot
+        self.indicator = indicator
+        self.binary = binary
+        self.dtype = dtype
+
+    def _ordinal_spec(self):
+        return ORDINAL_FEATURES if self.ordinal is None else self.ordinal
+
+    def _indicator_spec(self):
+        return INDICATOR_FEATURES if self.indicator is None else self.indicator
+
+    def fit(self, df, y=None):
+        encoded = set(self._ordinal_spec()) | set(self.one_hot) | set(self._indicator_spec()) | set(self.binary)
+        missing = sorted(col for col in encoded if col not in df.columns)
+        if missing:
+            raise ValueError(f"Columns {missing} to encode are not in the frame")
+
+        self.numeric_ = {col: _is_numeric(df[col]) for col in encoded}
+        self.categories_ = {}
+        # Output layout as (kind, column, first output position, width)
+        self.layout_ = []
+        names = []
+
+        # Remaining columns pass through in their original order, binary encoded bits take the place of their column
+        for col in df.columns:
+            if col in self.binary:
+                keys = _keys(df[col], self.numeric_[col]).dropna()
+                self.categories_[col] = pd.unique(keys.to_numpy())
+                width = max(1, int(np.ceil(np.log2(len(self.categories_[col]) + 1))))
+                self.layout_.append(('binary', col, len(names), width))
+                names += [f'{col}_{bit}' for bit in range(width)]
+            elif col not in encoded:
+                self.layout_.append(('passthrough', col, len(names), 1))
+                names.append(col)
+
+        for col, (name, categories) in self._ordinal_spec().items():
+            if categories is None:
+                categories = np.sort(_keys(df[col], self.numeric_[col]).dropna().unique())
+            elif not self.numeric_[col]:
+                categories = [str(category) for category in categories]
+            self.categories_[col] = np.asarray(categories, dtype=np.float64 if self.numeric_[col] else object)
+            self.layout_.append(('ordinal', col, len(names), 1))
+            names.append(name)
+
+        for col in self.one_hot:
+            self.categories_[col] = np.sort(_keys(df[col], self.numeric_[col]).dropna().unique())
+            self.layout_.append(('one_hot', col, len(names), len(self.categories_[col])))
+            names += [f'{col}_{category}' for category in self.categories_[col]]
+
+        for col, name in self._indicator_spec().items():
+            self.layout_.append(('indicator', col, len(names), 1))
+            names.append(name)
+
+        self.feature_names_out_ = np.asarray(names, dtype=object)
+        return self
+
+    def transform(self, df, features=None):
+        # features restricts the output to these feature names (in that order), only the columns they come from are encoded
+        check_is_fitted(self, 'feature_names_out_')
+        out = np.empty((len(df), len(self.feature_names_out_)), dtype=self.dtype, order='C')
+        layout = self.layout_
+        if features is not None:
+            positions = self._positions(features)
+            layout = [entry for entry in layout if np.any((positions >= entry[2]) & (positions < entry[2] + entry[3]))]
+
+        for kind, col, start, width in layout:
+            if kind == 'passthrough':
+                out[:, start] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=self.dtype, na_value=np.nan)
+            elif kind == 'indicator':
+                out[:, start] = np.clip(pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=self.dtype, na_value=np.nan), 0, 1)
+            else:
+                codes = _codes(_keys(df[col], self.numeric_[col]), self.categories_[col])
+                if kind == 'ordinal':
+                    out[:, start] = np.where(codes >= 0, codes, np.nan)
+                elif kind == 'one_hot':
+                    block = out[:, start:start + width]
+                    block[:] = 0
+                    rows = np.flatnonzero(codes >= 0)
+                    block[rows, codes[rows]] = 1
+                else:
+                    # Unseen values get the reserved ordinal 0, i.e. all bits off
+                    shifts = np.arange(width - 1, -1, -1, dtype=np.int64)
+                    out[:, start:start + width] = ((codes[:, None] + 1) >> shifts) & 1
+        return out if features is None else np.ascontiguousarray(out[:, positions])
+
+    def _positions(self, features):
+        if not hasattr(self, '_position_index'):
+            self._position_index = {name: position for position, name in enumerate(self.feature_names_out_)}
+        unknown = [feature for feature in features if feature not in self._position_index]
+        if unknown:
+            raise ValueError(f"Features {unknown} are not produced by the encoder")
+        return np.asarray([self._position_index[feature] for feature in features], dtype=np.int64)
+
+    def get_feature_names_out(self, input_features=None):
+        check_is_fitted(self, 'feature_names_out_')
+        return self.feature_names_out_.copy()
+
+    def to_frame(self, df):
+        # The frame wraps the float32 matrix without copying it
+        return pd.DataFrame(self.transform(df), columns=self.get_feature_names_out(), index=df.index)
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
@@ -0,0 +1,75 @@
+# Feature ranking by correlation with the target.
+# The sufficient statistics of the full feature-feature correlation matrix (pairwise counts, sums, sums of squares and cross
+# products) are accumulated in one streaming pass over the artifact with float32 matrix products (BLAS), on values shifted by the
+# means of the first batch and summed into float64. Missing values are handled pairwise like DataFrame.corr. The target column
+# of that matrix gives the ranking, the rest of it allows pruning features that are redundant with a better ranked one.
+import numpy as np
+import pandas as pd
+
+from .out_of_core import BATCH_ROWS, iter_artifact_frames
+
+
+class CorrelationStatistics:
+    def __init__(self):
+        self.columns = None
+
+    def update(self, frame):
+        values = frame.to_numpy(dtype=np.float32)
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            self.shift = np.nan_to_num(np.nanmean(values, axis=0, dtype=np.float64)).astype(np.float32)
+            width = len(self.columns)
+            self.count, self.sums, self.squares, self.products = np.zeros((4, width, width))
+
+        x = values - self.shift
+        missing = np.isnan(x)
+        if missing.any():
+            # sums[i, j] is the sum of column i over the rows where both i and j are present
+            valid = (~missing).astype(np.float32)
+            x[missing] = 0
+            self.count += valid.T @ valid
+            self.sums += x.T @ valid
+            self.squares += (x * x).T @ valid
+        else:
+            self.count += len(x)
+            self.sums += x.sum(axis=0, dtype=np.float64)[:, None]
+            self.squares += (x * x).sum(axis=0, dtype=np.float64)[:, None]
+        self.products += x.T @ x
+        return self
+
+    def correlation_matrix(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = self.products - self.sums * self.sums.T / self.count
+            variance = self.squares - self.sums * self.sums / self.count
+            correlation = covariance / np.sqrt(variance * variance.T)
+        return pd.DataFrame(np.clip(correlation, -1, 1), index=self.columns, columns=self.columns)
+
+
+def correlation_matrix(name, columns=None, batch_rows=BATCH_ROWS, directory=None):
+    # Correlation matrix of the columns of an artifact, in one streaming pass
+    statistics = CorrelationStatistics()
+    for frame in iter_artifact_frames(name, columns, batch_rows, directory):
+        statistics.update(frame)
+    return statistics.correlation_matrix()
+
+
+def select_top_k(matrix, target, k=10, redundancy_above=None):
+    # The k features with the highest (positive) correlation with the target. With redundancy_above, a feature whose absolute
+    # correlation with an already selected feature is above it is skipped in favour of the next one.
+    correlations = matrix[target].drop(target).dropna().sort_values(ascending=False, kind='stable')
+    selected = []
+    for feature in correlations.index:
+        if len(selected) == k:
+            break
+        if redundancy_above is not None and selected and matrix.loc[feature, selected].abs().max() > redundancy_above:
+            continue
+        selected.append(feature)
+    return selected
+
+
+def rank_features(name, target, k=10, redundancy_above=None, batch_rows=BATCH_ROWS, directory=None):
+    matrix = correlation_matrix(name, batch_rows=batch_rows, directory=directory)
+    return {
+        'matrix': matrix,
+        'selected': select_top_k(matrix, target, k, redundancy_above),
+    }
@@ -0,0 +1,143 @@
+# Incremental refresh for new OPA snapshots.
+# Every row of a snapshot is summarized by a 64-bit hash of the columns the pipeline reads, keyed by parcel_number. A new snapshot
+# is diffed against the hashes of the previous one while it is streamed, and only the added and changed parcels are kept in memory.
+# Those few records go through the preprocessing stages (with the columns dropped by the full run), the fitted encoder, the
+# winsorize caps and the scaler of the full run, then replace their old rows in the stored training artifacts.
+# The same pass compares the snapshot against the drift sketches of the full run (philly_house_predictor/drift.py), so a shifted
+# data drop can be stopped before it touches the artifacts.
+import time
+
+import numpy as np
+import pandas as pd
+
+from .artifacts import (
+    artifact_columns, read_artifact, read_manifest, read_object, remove_artifact, upsert_artifact, write_artifact,
+)
+from .drift import DRIFT_OBJECT, DriftError, drifted_columns
+from .ingest import INGEST_CHUNKSIZE, KEY_COLUMN, KNOWN_DROPPED_COLUMNS, apply_compact_dtypes
+from .partitioned import KEYS_ARTIFACT, parcel_keys
+from .sale_dates import add_sale_year, select_sale_window
+from .stages import build_preprocessing_pipeline
+
+SNAPSHOT_ARTIFACT = 'snapshot_rows'
+STATE_OBJECT = 'preprocess_state'
+
+
+def _read_text(path, key, **kwargs):
+    # Every value as published (text), so a change is detected even where the compact dtypes would round it away
+    return pd.read_csv(path, dtype=str, usecols=lambda col: col == key or col not in KNOWN_DROPPED_COLUMNS, **kwargs)
+
+
+def _row_hashes(chunk):
+    return pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+
+
+def snapshot_hashes(path, key=KEY_COLUMN, chunksize=INGEST_CHUNKSIZE):
+    # (key, row_hash) of every row of a snapshot
+    parts = []
+    for chunk in _read_text(path, key, chunksize=chunksize):
+        parts.append(pd.DataFrame({key: chunk[key].to_numpy(), 'row_hash': _row_hashes(chunk)}))
+    return pd.concat(parts, ignore_index=True)
+
+
+def diff_snapshot(path, previous, key=KEY_COLUMN, chunksize=INGEST_CHUNKSIZE, drift_check=None):
+    # Streams the new snapshot once. Returns the added / changed records (compact dtypes, indexed by key), the hashes of the
+    # new snapshot and the keys of the removed parcels. drift_check (a drift.DriftCheck) is updated with every chunk.
+    previous_keys = pd.Index(previous[key].to_numpy())
+    previous_hashes = previous['row_hash'].to_numpy()
+    seen = np.zeros(len(previous_keys), dtype=bool)
+    parts, changed = [], []
+
+    for chunk in _read_text(path, key, chunksize=chunksize):
+        hashes = _row_hashes(chunk)
+        if drift_check is not None:
+            drift_check.update(chunk)
+        positions = previous_keys.get_indexer(chunk[key])
+        known = positions >= 0
+        seen[positions[known]] = True
+        modified = ~known
+        modified[known] = previous_hashes[positions[known]] != hashes[known]
+        parts.append(pd.DataFrame({key: chunk[key].to_numpy(), 'row_hash': hashes}))
+        if modified.any():
+            changed.append(chunk[modified])
+
+    hashes = pd.concat(parts, ignore_index=True)
+    records = pd.concat(changed) if changed else _read_text(path, key, nrows=0)
+    records = apply_compact_dtypes(records.set_index(key))
+    removed = previous_keys[~seen]
+    return records, hashes, removed
+
+
+def refresh(path, directory=None, chunksize=INGEST_CHUNKSIZE, check_drift=False):
+    # Applies a new snapshot to the artifacts of a previous full run of data_preprocessing/preprocessing.py.
+    # Returns the counts of the refresh and the drift report of the snapshot. With check_drift a drifted snapshot raises a
+    # drift.DriftError instead, before any artifact is written.
+    timings = {}
+    start = time.perf_counter()
+    state = read_object(STATE_OBJECT, directory)
+    key = state['key']
+    previous = read_artifact(SNAPSHOT_ARTIFACT, directory=directory)
+    # Runs of an older version have no drift sketches
+    drift_check = read_object(DRIFT_OBJECT, directory).check() if DRIFT_OBJECT in read_manifest(directory) else None
+    records, hashes, removed = diff_snapshot(path, previous, key, chunksize, drift_check)
+    drift_report = drift_check.report() if drift_check is not None else None
+    timings['diff'] = time.perf_counter() - start
+    if check_drift and drift_report is not None and drift_report['drifted'].any():
+        raise DriftError(drift_report)
+
+    start = time.perf_counter()
+    pipeline = build_preprocessing_pipeline()
+    # Only single family homes are kept by the pipeline as well as by the streaming loader of the full run
+    df = pipeline.run(records, dropped_columns=state['dropped_columns'])
+    df = select_sale_window(add_sale_year(df), *state['train_sale_window'])
+    encoded = read_object('feature_encoder', directory).to_frame(df)
+    filtered = read_object('outlier_filter', directory).filter(encoded)
+    # Same column order as the scaled artifact of the full run (scaled columns first)
+    scaled_columns = artifact_columns('scaled', directory)
+    if len(filtered):
+        scaled = pd.DataFrame(read_object('scaler', directory).transform(filtered), columns=scaled_columns, index=filtered.index)
+    else:
+        scaled = pd.DataFrame(np.empty((0, len(scaled_columns)), dtype=np.float32), columns=scaled_columns, index=filtered.index)
+    timings['transform'] = time.perf_counter() - start
+
+    # The old rows of changed and removed parcels are replaced, changed parcels that no longer pass the filters just disappear
+    start = time.perf_counter()
+    delete = records.index.union(removed)
+    manifest = read_manifest(directory)
+    upsert_artifact(filtered, 'filtered', delete, directory)
+    upsert_artifact(scaled, 'scaled', delete, directory)
+    if 'high_correlations' in manifest:
+        upsert_artifact(scaled[artifact_columns('high_correlations', directory)], 'high_correlations', delete, directory)
+    stale = []
+    if 'pca_10component' in manifest:
+        if 'pca' in manifest:
+            # The new rows projected onto the components of the feature selection run, the target is carried over
+            pca_columns = artifact_columns('pca_10component', directory)
+            passthrough = [col for col in pca_columns if col in scaled_columns]
+            features = [col for col in scaled_columns if col not in passthrough]
+            components = [col for col in pca_columns if col not in passthrough]
+            values = read_object('pca', directory).transform(scaled[features]) if len(scaled) else np.empty((0, len(components)))
+            projected = pd.DataFrame(values, columns=components, index=scaled.index).join(scaled[passthrough])
+            upsert_artifact(projected[pca_columns], 'pca_10component', delete, directory)
+        else:
+            # Written by a feature selection run that didn't keep its PCA, the changed rows can't be projected
+            remove_artifact('pca_10component', directory)
+            stale.append('pca_10component')
+    if KEYS_ARTIFACT in manifest:
+        upsert_artifact(parcel_keys(df), KEYS_ARTIFACT, delete, directory)
+    write_artifact(hashes, SNAPSHOT_ARTIFACT, directory)
+    timings['write'] = time.perf_counter() - start
+
+    return {
+        'snapshot_rows': len(hashes),
+        'added_or_changed': len(records),
+        'removed': len(removed),
+        'kept_after_filters': len(filtered),
+        # Partition models of these parcels' areas can be refitted on their own (see philly_house_predictor/partitioned.py)
+        'changed_parcels': delete.tolist(),
+        # Removed because they could not be updated, the stage that writes them has to run again
+        'removed_artifacts': stale,
+        'drifted_columns': drifted_columns(drift_report) if drift_report is not None else None,
+        'drift_report': drift_report,
+        'seconds': timings,
+    }
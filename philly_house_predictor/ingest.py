@@ -0,0 +1,83 @@
+# Streaming ingest of the Office of Property Assessments dump (opa_properties_public.csv)
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+
+# Peak memory of the streaming loader is bounded by the chunk size rather than by the size of the file.
+INGEST_CHUNKSIZE = 100_000
+
+# Columns that are always removed by the missing value / cardinality stages (see README), so there is no reason to ever parse them.
+KNOWN_DROPPED_COLUMNS = [
+    # More than 25% missing values
+    'cross_reference', 'date_exterior_condition', 'fuel', 'garage_type', 'house_extension',
+    'mailing_address_1', 'mailing_address_2', 'mailing_care_of', 'market_value_date', 'number_of_rooms',
+    'other_building', 'separate_utilities', 'sewer', 'site_type', 'suffix', 'unfinished', 'unit', 'utility',
+    # High cardinality identifiers
+    'the_geom', 'the_geom_webmercator', 'beginning_point', 'book_and_page', 'location', 'mailing_street',
+    'owner_1', 'owner_2', 'parcel_number', 'registry_number', 'pin', 'objectid',
+]
+
+# Compact dtypes for the columns that survive the pruning. Low cardinality text columns are read as categoricals
+# and numerical columns as float32 (most of them contain missing values, so they can't be int32).
+# sale_date is kept as text since it is only used for its year.
+CATEGORICAL_COLUMNS = [
+    'basements', 'building_code', 'building_code_description', 'building_code_description_new', 'building_code_new',
+    'category_code', 'category_code_description', 'central_air', 'general_construction', 'mailing_city_state',
+    'mailing_zip', 'parcel_shape', 'quality_grade', 'state_code', 'street_designation', 'street_direction',
+    'street_name', 'topography', 'type_heater', 'view_type', 'year_built', 'year_built_estimate', 'zip_code', 'zoning',
+]
+FLOAT32_COLUMNS = [
+    'census_tract', 'depth', 'exempt_building', 'exempt_land', 'exterior_condition', 'fireplaces', 'frontage',
+    'garage_spaces', 'geographic_ward', 'homestead_exemption', 'house_number', 'interior_condition', 'market_value',
+    'number_of_bathrooms', 'number_of_bedrooms', 'number_stories', 'off_street_open', 'sale_price', 'street_code',
+    'taxable_building', 'taxable_land', 'total_area', 'total_livable_area',
+]
+# Coordinates of the parcel, float32 would round them to about a meter
+COORDINATE_COLUMNS = ['lat', 'lng']
+COMPACT_DTYPES = {col: 'category' for col in CATEGORICAL_COLUMNS}
+COMPACT_DTYPES.update({col: np.float32 for col in FLOAT32_COLUMNS})
+COMPACT_DTYPES.update({col: np.float64 for col in COORDINATE_COLUMNS})
+COMPACT_DTYPES.update({'assessment_date': str, 'recording_date': str, 'sale_date': str})
+
+# Identifies a property across snapshots. It is dropped as a feature (high cardinality) but kept as the index of the records.
+KEY_COLUMN = 'parcel_number'
+
+
+def apply_compact_dtypes(df):
+    # Same dtypes as the streaming loader, for records that were read as text
+    columns = {}
+    for col in df.columns:
+        if col in FLOAT32_COLUMNS:
+            columns[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float32)
+        elif col in COORDINATE_COLUMNS:
+            columns[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+        elif col in CATEGORICAL_COLUMNS:
+            columns[col] = df[col].astype('category')
+        else:
+            columns[col] = df[col]
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def concat_categorical_chunks(chunks):
+    # Each chunk infers its own categories, so align them before concatenating, otherwise pandas falls back to object columns
+    categorical_columns = [col for col in chunks[0].columns if isinstance(chunks[0][col].dtype, pd.CategoricalDtype)]
+    for col in categorical_columns:
+        categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+
+    # A named index (the key of the records) is kept, a positional one is renumbered
+    return pd.concat(chunks, ignore_index=chunks[0].index.name is None)
+
+
+def load_single_family_homes_streaming(path, chunksize=INGEST_CHUNKSIZE, key=None):
+    # Read the dataset chunk by chunk, skipping the known dropped columns and only keeping single family homes,
+    # so the full unfiltered dump is never resident in memory.
+    # With key (e.g. KEY_COLUMN) that column is read as text and becomes the index, so the records can be traced back to their parcel.
+    chunks = []
+    reader = pd.read_csv(path, chunksize=chunksize, dtype={**COMPACT_DTYPES, **({key: str} if key else {})},
+                         usecols=lambda col: col == key or col not in KNOWN_DROPPED_COLUMNS, index_col=key)
+    for chunk in reader:
+        chunks.append(chunk[chunk['category_code_description'] == "SINGLE FAMILY"].copy())
+
+    return concat_categorical_chunks(chunks)
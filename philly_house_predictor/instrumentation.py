@@ -0,0 +1,203 @@
+# Stage instrumentation for the preprocessing / feature selection / model development scripts.
+# Every stage of a run records its wall time, CPU time (including the worker processes it waited for), peak resident memory,
+# rows in and out and the bytes the process read and wrote. At the end of a script the run is written as a JSON report and as a
+# Prometheus text exposition file into the run report directory. Setting PHILLY_PROFILE (to 1 for every stage, or to a comma
+# separated list of stage names) also runs the stages under cProfile, their .prof files and top functions go into the report.
+#
+#   run = RunInstrumentation('preprocessing')
+#   run.begin('encode', rows_in=len(df))
+#   ...
+#   run.end(rows_out=len(df_encode))
+#   run.write()
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+import psutil
+
+# <repository>/run_reports by default, shared by the scripts of every stage regardless of their working directory
+REPORT_DIR = os.environ.get(
+    'PHILLY_REPORT_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_reports'),
+)
+METRIC_PREFIX = 'philly_stage'
+# Functions of a profiled stage listed in the report, by cumulative time
+PROFILE_TOP_FUNCTIONS = 20
+
+
+class PeakMemory:
+    # Samples the resident set size of the process in a background thread, so memory allocated outside of Python
+    # (XGBoost, the BLAS libraries) is measured as well. peak_mb is the growth over the RSS when entering the block,
+    # peak_rss_mb the highest RSS seen.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._process = psutil.Process()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self._peak = max(self._peak, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._baseline = self._peak = self._process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._peak = max(self._peak, self._process.memory_info().rss)
+        self.peak_mb = (self._peak - self._baseline) / 1024 ** 2
+        self.peak_rss_mb = self._peak / 1024 ** 2
+
+
+def _cpu_seconds(process):
+    times = process.cpu_times()
+    # children_* count the worker processes (process pools) that exited, only reported on POSIX
+    return times.user + times.system + getattr(times, 'children_user', 0.0) + getattr(times, 'children_system', 0.0)
+
+
+def _io_bytes(process):
+    # Bytes passed to read / write calls (read_chars also counts reads served by the page cache), None where unsupported (macOS)
+    try:
+        counters = process.io_counters()
+    except (AttributeError, psutil.Error):
+        return None, None
+    return getattr(counters, 'read_chars', counters.read_bytes), getattr(counters, 'write_chars', counters.write_bytes)
+
+
+def _profiled_stages():
+    setting = os.environ.get('PHILLY_PROFILE', '').strip()
+    if setting.lower() in ('', '0', 'false', 'no'):
+        return set()
+    if setting.lower() in ('1', 'true', 'yes', 'all'):
+        return None
+    return {name.strip() for name in setting.split(',')}
+
+
+class RunInstrumentation:
+    def __init__(self, script, report_dir=None, profile=None):
+        self.script = script
+        self.report_dir = report_dir or REPORT_DIR
+        # Stage names to profile, None for every stage, an empty set for none (defaults to PHILLY_PROFILE)
+        self.profile = _profiled_stages() if profile is None else profile
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.stages = []
+        self._process = psutil.Process()
+        self._current = None
+
+    def _profiling(self, name):
+        return self.profile is None or name in self.profile
+
+    def begin(self, name, rows_in=None):
+        # Starts measuring a stage, the stage that is still open (if any) ends first
+        if self._current is not None:
+            self.end()
+        read, written = _io_bytes(self._process)
+        memory = PeakMemory().__enter__()
+        profiler = None
+        if self._profiling(name):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self._current = {
+            'name': name, 'rows_in': rows_in, 'memory': memory, 'profiler': profiler, 'read': read, 'written': written,
+            'cpu': _cpu_seconds(self._process), 'wall': time.perf_counter(),
+        }
+        return self
+
+    def end(self, rows_out=None, rows_in=None, **extra):
+        # Ends the open stage, extra values (e.g. whether the stage cache was hit) are stored with its metrics.
+        # rows_in overrides the one given to begin, for stages that only know their input size once they have read it.
+        current, self._current = self._current, None
+        if current is None:
+            raise RuntimeError('No stage to end, call begin first')
+        wall_seconds = time.perf_counter() - current['wall']
+        cpu_seconds = _cpu_seconds(self._process) - current['cpu']
+        if current['profiler'] is not None:
+            current['profiler'].disable()
+        current['memory'].__exit__(None, None, None)
+        read, written = _io_bytes(self._process)
+
+        record = {
+            'stage': current['name'],
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'peak_rss_mb': current['memory'].peak_rss_mb,
+            'rss_growth_mb': current['memory'].peak_mb,
+            'rows_in': current['rows_in'] if rows_in is None else rows_in,
+            'rows_out': rows_out,
+            'bytes_read': None if read is None else read - current['read'],
+            'bytes_written': None if written is None else written - current['written'],
+            **extra,
+        }
+        if current['profiler'] is not None:
+            record.update(self._write_profile(current['name'], current['profiler']))
+        self.stages.append(record)
+        # On stderr, stdout is left to the output of the stage (e.g. the JSON summary of a CLI command)
+        print(self._summary(record), file=sys.stderr)
+        return record
+
+    def _write_profile(self, name, profiler):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.script}.{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}.prof")
+        profiler.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        return {'profile_path': path, 'profile_top': text.getvalue()}
+
+    @staticmethod
+    def _summary(record):
+        rows = '' if record['rows_out'] is None else f", {record['rows_in']} -> {record['rows_out']} rows"
+        return (f"[{record['stage']}] {record['wall_seconds']:.2f}s wall, {record['cpu_seconds']:.2f}s cpu, "
+                f"{record['peak_rss_mb']:.0f} MB peak rss{rows}")
+
+    def report(self):
+        return {'script': self.script, 'started_at': self.started_at, 'pid': self._process.pid, 'stages': self.stages}
+
+    def prometheus(self):
+        # Prometheus text exposition format, one gauge per metric with the script and stage as labels
+        metrics = {
+            'wall_seconds': 'Wall clock time of the stage',
+            'cpu_seconds': 'CPU time of the stage, including the worker processes it waited for',
+            'peak_rss_mb': 'Highest resident set size during the stage',
+            'rss_growth_mb': 'Growth of the resident set size during the stage',
+            'rows_in': 'Rows going into the stage',
+            'rows_out': 'Rows coming out of the stage',
+            'bytes_read': 'Bytes read by the process during the stage',
+            'bytes_written': 'Bytes written by the process during the stage',
+        }
+        lines = []
+        for metric, description in metrics.items():
+            samples = [(record['stage'], record[metric]) for record in self.stages if record.get(metric) is not None]
+            if not samples:
+                continue
+            lines += [f'# HELP {METRIC_PREFIX}_{metric} {description}', f'# TYPE {METRIC_PREFIX}_{metric} gauge']
+            for stage, value in samples:
+                lines.append(f'{METRIC_PREFIX}_{metric}{{script="{self.script}",stage="{stage}"}} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # Ends the open stage and writes {script}.json (with the previous runs kept as {script}-{started_at}.json) and {script}.prom
+        if self._current is not None:
+            self.end()
+        os.makedirs(self.report_dir, exist_ok=True)
+        report = json.dumps(self.report(), indent=2, default=str)
+        stamp = self.started_at.replace(':', '')
+        paths = {
+            'json': os.path.join(self.report_dir, f'{self.script}.json'),
+            'history': os.path.join(self.report_dir, f'{self.script}-{stamp}.json'),
+            'prometheus': os.path.join(self.report_dir, f'{self.script}.prom'),
+        }
+        for kind, content in (('json', report), ('history', report), ('prometheus', self.prometheus())):
+            with open(f'{paths[kind]}.tmp', 'w', encoding='utf-8') as file:
+                file.write(content)
+            os.replace(f'{paths[kind]}.tmp', paths[kind])
+        return paths
@@ -0,0 +1,111 @@
+# Everything needed to turn raw OPA records into market_value predictions, in one object that is loaded once.
+# The fitted encoder, the winsorize caps and the standard scaler of the training run are compiled down to the features the model
+# uses: the encoder only encodes the columns those features come from, and capping / scaling become two vectorized NumPy
+# operations over the whole batch.
+import joblib
+import numpy as np
+import pandas as pd
+
+from .artifacts import read_object
+from .stages import build_preprocessing_pipeline
+
+
+def _scaler_columns(scaler):
+    # The StandardScaler and its columns out of the ColumnScaler of preprocessing.py, or out of the ColumnTransformer
+    # (or Pipeline around it) that earlier runs persisted
+    if hasattr(scaler, 'scaler_'):
+        return scaler.scaler_, list(scaler.columns)
+    if hasattr(scaler, 'named_steps'):
+        scaler = scaler.named_steps['preprocessor']
+    for name, transformer, columns in scaler.transformers_:
+        if name == 'scaled_features':
+            return transformer, list(columns)
+    raise ValueError("The scaler has no 'scaled_features' transformer")
+
+
+class ModelBundle:
+    def __init__(self, model, features, encoder, outlier_filter, scaler, fill_values=None):
+        self.model = model
+        self.features = list(features)
+        self.encoder = encoder
+        self.fill_values = build_preprocessing_pipeline().fill_values() if fill_values is None else fill_values
+
+        # Every model feature is an encoder output, optionally capped ({column}_capped) and optionally standardized
+        caps = dict(zip(outlier_filter.columns_, zip(outlier_filter.lower_cap_, outlier_filter.upper_cap_)))
+        standard_scaler, scaled_columns = _scaler_columns(scaler)
+        scaling = dict(zip(scaled_columns, zip(standard_scaler.mean_, standard_scaler.scale_)))
+
+        self.encoder_features = []
+        self.lower = np.full(len(self.features), -np.inf, dtype=encoder.dtype)
+        self.upper = np.full(len(self.features), np.inf, dtype=encoder.dtype)
+        self.mean = np.zeros(len(self.features))
+        self.scale = np.ones(len(self.features))
+        for position, feature in enumerate(self.features):
+            column = feature[:-len('_capped')] if feature.endswith('_capped') and feature[:-len('_capped')] in caps else feature
+            self.encoder_features.append(column)
+            if column != feature:
+                self.lower[position], self.upper[position] = caps[column]
+            if feature in scaling:
+                self.mean[position], self.scale[position] = scaling[feature]
+        # Raw columns a record needs, checked once here instead of failing on the first request
+        positions = encoder._positions(self.encoder_features)
+        self.columns = [col for _, col, start, width in encoder.layout_ if np.any((positions >= start) & (positions < start + width))]
+        # A partitioned model (see philly_house_predictor/partitioned.py) also routes every record by its raw zip code / tract
+        self.partition_column = getattr(model, 'partition_column', None)
+        if self.partition_column is not None and self.partition_column not in self.columns:
+            self.columns.append(self.partition_column)
+
+    @classmethod
+    def from_artifacts(cls, model, features, directory=None):
+        # Uses the transforms persisted by data_preprocessing/preprocessing.py
+        return cls(
+            model, features,
+            encoder=read_object('feature_encoder', directory),
+            outlier_filter=read_object('outlier_filter', directory),
+            scaler=read_object('scaler', directory),
+        )
+
+    def _frame(self, records):
+        # records is a DataFrame, a list of dicts or a single dict in the format of the OPA csv
+        if isinstance(records, dict):
+            records = [records]
+        if isinstance(records, pd.DataFrame):
+            missing = [col for col in self.columns if col not in records.columns]
+            # An explicit copy of the few columns, the missing values are filled in below
+            df = records[[col for col in self.columns if col not in missing]].copy()
+        else:
+            # Only the columns the features come from are pulled out of the records, a full OPA record has over 70
+            missing = [col for col in self.columns if not any(col in record for record in records)]
+            df = pd.DataFrame({col: [record.get(col) for record in records] for col in self.columns if col not in missing})
+        if missing:
+            raise ValueError(f"Records are missing the columns {missing}")
+        for col, value in self.fill_values.items():
+            if col in self.columns:
+                df[col] = df[col].where(df[col].notna(), value)
+        return df
+
+    def _matrix(self, df):
+        # Capped and standardized in place in the encoder's float32, the same arithmetic as the training frame went through
+        X = self.encoder.transform(df, features=self.encoder_features)
+        np.clip(X, self.lower, self.upper, out=X)
+        X -= self.mean
+        X /= self.scale
+        if hasattr(self.model, 'feature_names_in_'):
+            return pd.DataFrame(X, columns=self.features, copy=False)
+        return X
+
+    def transform(self, records):
+        return self._matrix(self._frame(records))
+
+    def predict(self, records):
+        df = self._frame(records)
+        if self.partition_column is not None:
+            return self.model.predict(self._matrix(df), df[self.partition_column].to_numpy())
+        return self.model.predict(self._matrix(df))
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
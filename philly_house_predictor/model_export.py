@@ -0,0 +1,222 @@
+# Export of the tree ensembles of model_development.py to the compact format of philly_house_predictor/compact_predictor.py.
+# RandomForest / DecisionTree, GradientBoosting and XGBoost regressors are flattened into node arrays: scikit-learn trees straight from
+# their tree_ structures (the learning rate and the initial estimate of gradient boosting are folded into the values), XGBoost trees
+# from the JSON dump of the booster. An export is checked against the predictions of the original model and can be benchmarked for
+# predict throughput, file size and the cold start of a fresh process.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import joblib
+import numpy as np
+
+from .artifacts import artifact_path, write_arrays
+from .benchmark import BATCH_REPEATS, BATCH_SIZES, SINGLE_ROW_REPEATS
+from .compact_predictor import CompactForest
+
+# Largest difference to the original predictions accepted by check_equivalence, relative to the largest of them. scikit-learn sums
+# the trees in float64 (only the order of the additions differs), XGBoost in float32. The rounding of a sum is proportional to the
+# magnitude of the leaf values it adds up, i.e. to the scale of the target, so a prediction near 0 is held to the same absolute
+# tolerance as the others instead of one relative to itself.
+EQUIVALENCE_RTOL = {'sklearn': 1e-9, 'xgboost': 1e-5}
+
+
+def _flatten(trees):
+    # trees is a list of (feature, threshold, left, right, missing_left, value) per tree, with -1 children for the leaves.
+    # Node indices become global, leaves point to themselves so a finished walk stays on its leaf.
+    parts, roots, offset, depth = [], [], 0, 0
+    for feature, threshold, left, right, missing_left, value in trees:
+        leaf = left < 0
+        nodes = np.arange(len(left)) + offset
+        parts.append((
+            np.where(leaf, 0, feature).astype(np.int32),
+            _float32_threshold(threshold),
+            np.where(leaf, nodes, left + offset).astype(np.int32),
+            np.where(leaf, nodes, right + offset).astype(np.int32),
+            np.asarray(missing_left, dtype=bool),
+            np.asarray(value, dtype=np.float64),
+        ))
+        roots.append(offset)
+        offset += len(left)
+        depth = max(depth, _depth(left, right))
+    arrays = [np.concatenate(column) for column in zip(*parts)]
+    return (*arrays, np.asarray(roots, dtype=np.int32), depth)
+
+
+def _float32_threshold(threshold):
+    # The largest float32 that is <= the threshold: for a float32 value x, x <= threshold exactly when x <= that float32 (and
+    # x < threshold when x < it for XGBoost, whose thresholds are float32 already), so the comparisons stay exact in float32
+    threshold = np.asarray(threshold, dtype=np.float64)
+    rounded = threshold.astype(np.float32)
+    above = rounded.astype(np.float64) > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def _depth(left, right):
+    depth, level = 0, np.array([0])
+    while True:
+        level = level[left[level] >= 0]
+        if not len(level):
+            return depth
+        level = np.concatenate([left[level], right[level]])
+        depth += 1
+
+
+def _sklearn_tree(tree, scale=1.0):
+    tree = tree.tree_
+    # Trees fitted on data without missing values (or by scikit-learn before 1.3) send NaN to the right
+    missing_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8)).astype(bool)
+    return (tree.feature, tree.threshold, tree.children_left, tree.children_right, missing_left, tree.value[:, 0, 0] * scale)
+
+
+def _xgboost_trees(model):
+    booster = model.get_booster()
+    dump = json.loads(booster.save_raw('json'))
+    learner = dump['learner']
+    if learner['objective']['name'] not in ('reg:squarederror', 'reg:absoluteerror', 'reg:pseudohubererror'):
+        raise ValueError(f"XGBoost objective {learner['objective']['name']} is not supported, only identity link regressions are")
+    trees = learner['gradient_booster']['model']['trees']
+    # Models fitted with early stopping predict with the trees up to the best iteration
+    best_iteration = getattr(model, 'best_iteration', None)
+    if best_iteration is not None:
+        parallel = int(learner['gradient_booster']['model']['gbtree_model_param']['num_parallel_tree'])
+        trees = trees[:(best_iteration + 1) * parallel]
+    flattened = []
+    for tree in trees:
+        left = np.asarray(tree['left_children'], dtype=np.int64)
+        # Leaves keep their value in split_conditions. Thresholds are float32, the values are compared in float32 like XGBoost does.
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+        flattened.append((
+            np.asarray(tree['split_indices'], dtype=np.int64), conditions.astype(np.float64), left,
+            np.asarray(tree['right_children'], dtype=np.int64), np.asarray(tree['default_left'], dtype=bool),
+            np.where(left < 0, conditions, 0),
+        ))
+    base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+    return flattened, base_score
+
+
+def compile_model(model, features=None):
+    # CompactForest with the same predictions as a fitted RandomForestRegressor, DecisionTreeRegressor, GradientBoostingRegressor
+    # or XGBRegressor
+    if features is None and hasattr(model, 'feature_names_in_'):
+        features = list(model.feature_names_in_)
+    name = type(model).__name__
+    if name == 'XGBRegressor':
+        trees, base_score = _xgboost_trees(model)
+        return CompactForest(*_flatten(trees), base_score=base_score, average=False, strict=True, features=features)
+    if name in ('RandomForestRegressor', 'ExtraTreesRegressor'):
+        trees = [_sklearn_tree(tree) for tree in model.estimators_]
+        return CompactForest(*_flatten(trees), average=True, features=features)
+    if name == 'DecisionTreeRegressor':
+        return CompactForest(*_flatten([_sklearn_tree(model)]), average=True, features=features)
+    if name == 'GradientBoostingRegressor':
+        if model.init_ == 'zero':
+            base_score = 0.0
+        elif hasattr(model.init_, 'constant_'):
+            base_score = float(np.ravel(model.init_.constant_)[0])
+        else:
+            raise ValueError("Only a constant (or zero) initial estimator of GradientBoostingRegressor can be exported")
+        if model.loss not in ('squared_error', 'absolute_error', 'huber', 'quantile'):
+            raise ValueError(f"GradientBoostingRegressor loss '{model.loss}' is not supported")
+        trees = [_sklearn_tree(stage[0], model.learning_rate) for stage in model.estimators_]
+        return CompactForest(*_flatten(trees), base_score=base_score, average=False, features=features)
+    raise ValueError(f"Models of type {name} can't be exported, expected a forest, gradient boosting or XGBoost regressor")
+
+
+def export_model(model, name, features=None, directory=None):
+    # Writes the compact model as the {name}.npz artifact, returns its path
+    compact = compile_model(model, features)
+    return write_arrays(compact.to_arrays(), name, directory)
+
+
+def check_equivalence(model, compact, X, rtol=None):
+    # Largest difference between the predictions of the original and the compact model relative to the largest absolute
+    # prediction, raises above rtol
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    with warnings.catch_warnings():
+        # Models fitted on a DataFrame warn about the array without feature names
+        warnings.simplefilter('ignore', UserWarning)
+        original = np.asarray(model.predict(X), dtype=np.float64)
+    exported = compact.predict(X)
+    if rtol is None:
+        rtol = EQUIVALENCE_RTOL['xgboost' if type(model).__name__ == 'XGBRegressor' else 'sklearn']
+    difference = 0.0
+    if len(X):
+        scale = np.max(np.abs(original))
+        difference = float(np.max(np.abs(original - exported)) / (scale if scale > 0 else 1.0))
+    if difference > rtol:
+        raise AssertionError(f"The exported model differs from the original by {difference:.3g} (relative), more than {rtol:.3g}")
+    return difference
+
+
+def _throughput(predict, X, batch_sizes):
+    record = {}
+    latencies = np.empty(SINGLE_ROW_REPEATS)
+    for repeat in range(SINGLE_ROW_REPEATS):
+        row = X[repeat % len(X)][None, :]
+        start = time.perf_counter()
+        predict(row)
+        latencies[repeat] = time.perf_counter() - start
+    record['single_row_p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+    for size in batch_sizes:
+        batch = np.ascontiguousarray(X[np.arange(size) % len(X)])
+        timings = []
+        for _ in range(BATCH_REPEATS):
+            start = time.perf_counter()
+            predict(batch)
+            timings.append(time.perf_counter() - start)
+        record[f'batch_{size}_rows_per_second'] = size / min(timings)
+    return record
+
+
+# Run in a fresh interpreter: imports, loads the model and predicts one row, prints the seconds that took
+_COLD_START = {
+    'original': "import time; start = time.perf_counter(); import joblib, numpy as np; model = joblib.load({path!r}); "
+                "model.predict(np.zeros((1, {n_features}), dtype=np.float32)); print(time.perf_counter() - start)",
+    'compact': "import time; start = time.perf_counter(); import numpy as np; "
+               "from philly_house_predictor.compact_predictor import CompactForest; model = CompactForest.load({path!r}); "
+               "model.predict(np.zeros((1, {n_features}), dtype=np.float32)); print(time.perf_counter() - start)",
+}
+
+
+def _cold_start_seconds(kind, path, n_features, repeats=3):
+    code = _COLD_START[kind].format(path=path, n_features=n_features)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=package_root)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def benchmark_export(model, compact, X, batch_sizes=BATCH_SIZES):
+    # Predict throughput, file size and cold start (import + load + first prediction in a new process) of the original model
+    # (joblib) and of its compact export (npz)
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {'original': os.path.join(directory, 'model.joblib'), 'compact': os.path.join(directory, 'model.npz')}
+        joblib.dump(model, paths['original'])
+        compact.save(paths['compact'])
+        for kind, predict in (('original', model.predict), ('compact', compact.predict)):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                throughput = _throughput(predict, X, batch_sizes)
+            rows.append({
+                'model': kind,
+                'file_bytes': os.path.getsize(paths[kind]),
+                'cold_start_seconds': _cold_start_seconds(kind, paths[kind], X.shape[1]),
+                **throughput,
+            })
+    return rows
+
+
+def load_exported(name, directory=None):
+    # The compact model written by export_model. A scoring process that only needs the model can call CompactForest.load on the
+    # file directly and skip the imports of this module.
+    return CompactForest.load(artifact_path(name, directory))
@@ -0,0 +1,100 @@
+# Out-of-core fitting over Parquet artifacts.
+# The artifacts are read one row group batch at a time, estimators that support partial_fit (StandardScaler, IncrementalPCA) are
+# fitted batch by batch and transformed artifacts are written batch by batch, so memory stays bounded by the batch size instead
+# of growing with the number of properties.
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils.validation import check_is_fitted
+
+from .artifacts import artifact_path, write_artifact_batches
+
+BATCH_ROWS = 65_536
+
+
+def iter_artifact_frames(name, columns=None, batch_rows=BATCH_ROWS, directory=None):
+    # Frames of at most batch_rows rows (with the index of the artifact), read from a memory-mapped file
+    file = pq.ParquetFile(artifact_path(name, directory), memory_map=True)
+    for batch in file.iter_batches(batch_size=batch_rows, columns=columns, use_pandas_metadata=True):
+        yield batch.to_pandas()
+
+
+def partial_fit_artifact(estimator, name, columns=None, batch_rows=BATCH_ROWS, min_batch_rows=1, directory=None):
+    # Calls estimator.partial_fit on every batch of the artifact. A last batch smaller than min_batch_rows (IncrementalPCA
+    # needs at least n_components rows per batch) is merged into the one before it.
+    pending = None
+    for frame in iter_artifact_frames(name, columns, batch_rows, directory):
+        if pending is not None and len(frame) < min_batch_rows:
+            frame = pd.concat([pending, frame])
+        elif pending is not None:
+            estimator.partial_fit(pending)
+        pending = frame
+    if pending is not None:
+        estimator.partial_fit(pending)
+    return estimator
+
+
+def transform_artifact(transform, source, target, columns=None, batch_rows=BATCH_ROWS, directory=None):
+    # Writes transform(frame) of every batch of the source artifact as the target artifact
+    frames = (transform(frame) for frame in iter_artifact_frames(source, columns, batch_rows, directory))
+    return write_artifact_batches(frames, target, directory)
+
+
+class ColumnScaler(BaseEstimator, TransformerMixin):
+    # Standardizes the given columns and passes the others through, with the scaled columns first, like the
+    # ColumnTransformer(StandardScaler, remainder='passthrough') it replaces. Unlike the ColumnTransformer it can be fitted
+    # batch by batch with partial_fit.
+    def __init__(self, columns):
+        self.columns = columns
+
+    def partial_fit(self, df, y=None):
+        if not hasattr(self, 'scaler_'):
+            self.scaler_ = StandardScaler()
+            self.feature_names_in_ = np.asarray(df.columns, dtype=object)
+            self.remainder_ = [col for col in df.columns if col not in self.columns]
+        self.scaler_.partial_fit(df[list(self.columns)].to_numpy())
+        return self
+
+    def merge(self, other):
+        # Adds the rows another ColumnScaler (with the same columns) was fitted on, as if partial_fit had seen them as well. The
+        # means and variances are combined pairwise (Chan et al.), so scalers fitted on shards in parallel reduce to one
+        # (see philly_house_predictor/parallel_preprocessing.py).
+        check_is_fitted(other, 'scaler_')
+        if not hasattr(self, 'scaler_'):
+            self.scaler_ = clone(other.scaler_)
+            for attribute in ('mean_', 'var_', 'scale_', 'n_samples_seen_', 'n_features_in_'):
+                setattr(self.scaler_, attribute, np.copy(getattr(other.scaler_, attribute)))
+            self.feature_names_in_, self.remainder_ = other.feature_names_in_, other.remainder_
+            return self
+        scaler, added = self.scaler_, other.scaler_
+        n, m = scaler.n_samples_seen_, added.n_samples_seen_
+        total = n + m
+        delta = added.mean_ - scaler.mean_
+        mean = scaler.mean_ + delta * (m / total)
+        var = (scaler.var_ * n + added.var_ * m + delta ** 2 * (n * m / total)) / total
+        scaler.mean_, scaler.var_, scaler.n_samples_seen_ = mean, var, total
+        # Columns with a (numerically) constant value keep a scale of 1, the same rule StandardScaler applies
+        eps = np.finfo(np.float64).eps
+        constant = var <= total * eps * var + (total * mean * eps) ** 2
+        scaler.scale_ = np.where(constant, 1.0, np.sqrt(var))
+        return self
+
+    def fit(self, df, y=None):
+        for attribute in ('scaler_', 'feature_names_in_', 'remainder_'):
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        return self.partial_fit(df)
+
+    def transform(self, df):
+        check_is_fitted(self, 'scaler_')
+        scaled = self.scaler_.transform(df[list(self.columns)].to_numpy())
+        return np.hstack([scaled, df[self.remainder_].to_numpy(dtype=scaled.dtype)])
+
+    def get_feature_names_out(self, input_features=None):
+        check_is_fitted(self, 'scaler_')
+        return np.asarray(list(self.columns) + self.remainder_, dtype=object)
+
+    def to_frame(self, df):
+        return pd.DataFrame(self.transform(df), columns=self.get_feature_names_out(), index=df.index)
@@ -0,0 +1,92 @@
+# Vectorized winsorize / IQR outlier stage.
+# Every column is capped to its percentiles (winsorizing) and rows outside of 1.5 IQR of the capped values are removed. All of the
+# percentiles of all of the columns come from a single NumPy pass, and the fitted caps are kept so new data can be capped the same
+# way at scoring time without recomputing percentiles over the training set.
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils.validation import check_is_fitted
+
+# Winsorized columns as {column: (lower percentile, upper percentile)}
+WINSORIZE_PERCENTILES = {
+    'depth': (5, 95),
+    'frontage': (5, 95),
+    'garage_spaces': (5, 95),
+    'total_area': (5, 95),
+    'total_livable_area': (5, 95),
+    'taxable_building': (5, 95),
+    'taxable_land': (5, 95),
+    'exempt_building': (5, 95),
+    # market_value is the target and has a wide spread, so a wider percentile retains as much of it as possible
+    'market_value': (5, 99),
+}
+
+
+class WinsorizeIQRFilter(BaseEstimator, TransformerMixin):
+    def __init__(self, percentiles=None, iqr_multiplier=1.5):
+        self.percentiles = percentiles
+        self.iqr_multiplier = iqr_multiplier
+
+    def _percentiles(self):
+        return WINSORIZE_PERCENTILES if self.percentiles is None else self.percentiles
+
+    def fit(self, df, y=None):
+        self.columns_ = list(self._percentiles())
+        values = df[self.columns_].to_numpy(dtype=np.float64)
+
+        # One pass for every percentile of every column
+        probabilities = sorted({0.25, 0.75} | {percentile / 100 for bounds in self._percentiles().values() for percentile in bounds})
+        quantiles = np.nanquantile(values, probabilities, axis=0)
+        row = {probability: position for position, probability in enumerate(probabilities)}
+        columns = np.arange(len(self.columns_))
+        self.lower_cap_ = quantiles[[row[lower / 100] for lower, _ in self._percentiles().values()], columns]
+        self.upper_cap_ = quantiles[[row[upper / 100] for _, upper in self._percentiles().values()], columns]
+
+        # Capping is monotonic, so the quartiles of the winsorized column are the capped quartiles of the raw column
+        q1 = np.clip(quantiles[row[0.25]], self.lower_cap_, self.upper_cap_)
+        q3 = np.clip(quantiles[row[0.75]], self.lower_cap_, self.upper_cap_)
+        iqr = q3 - q1
+        self.lower_bound_ = q1 - self.iqr_multiplier * iqr
+        self.upper_bound_ = q3 + self.iqr_multiplier * iqr
+        return self
+
+    def _capped(self, df):
+        check_is_fitted(self, 'columns_')
+        return np.clip(df[self.columns_].to_numpy(dtype=np.float64), self.lower_cap_, self.upper_cap_)
+
+    def _frame(self, df, rows, capped):
+        # The raw columns are replaced by {column}_capped columns at the end of the frame
+        dtype = np.result_type(*df[self.columns_].dtypes)
+        remaining = df.iloc[rows, [position for position, col in enumerate(df.columns) if col not in self.columns_]]
+        capped = pd.DataFrame(capped.astype(dtype), columns=[f'{col}_capped' for col in self.columns_], index=remaining.index)
+        return pd.concat([remaining, capped], axis=1)
+
+    def inlier_mask(self, df, capped=None):
+        # Rows whose winsorized values are all within the IQR bounds, rows with missing values are outliers as well
+        capped = self._capped(df) if capped is None else capped
+        return ((capped >= self.lower_bound_) & (capped <= self.upper_bound_)).all(axis=1)
+
+    def transform(self, df):
+        # Only caps the values, used at scoring time where no rows should be removed
+        return self._frame(df, np.arange(len(df)), self._capped(df))
+
+    def filter(self, df):
+        # Caps the values and removes the outlier rows in one go
+        capped = self._capped(df)
+        rows = np.flatnonzero(self.inlier_mask(df, capped))
+        return self._frame(df, rows, capped[rows])
+
+    def bounds(self):
+        check_is_fitted(self, 'columns_')
+        return pd.DataFrame({
+            'lower_cap': self.lower_cap_, 'upper_cap': self.upper_cap_,
+            'lower_bound': self.lower_bound_, 'upper_bound': self.upper_bound_,
+        }, index=self.columns_)
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
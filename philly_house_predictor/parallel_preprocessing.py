@@ -0,0 +1,213 @@
+# Data parallel preprocessing across row shards of the raw OPA csv.
+# The csv is cut into shards of whole records and every row local step runs on the shards in a process pool: parsing, the row
+# filters and imputations of the preprocessing stages, the sale year / window, the snapshot row hashes, the encoding, the winsorize
+# capping and outlier removal, and the scaling. Only the global statistics go through a reduce step in the parent: the column drops
+# (from the column profile, whose blocks are profiled in the same pool), the drift sketches, the vocabularies of the encoder, the
+# winsorize percentiles and the scaler moments. Between the steps the shards are Arrow IPC files that the workers and the parent memory-map, so nothing
+# but statistics is pickled between processes and the parent never holds the whole frame.
+# The artifacts are the same as the ones of data_preprocessing/preprocessing.py (up to the last bits of the scaler moments).
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .artifacts import write_artifact, write_artifact_batches, write_object
+from .column_profile import profile_csv
+from .drift import DRIFT_OBJECT, DriftMonitor
+from .encoding import BINARY_FEATURES, INDICATOR_FEATURES, ONE_HOT_FEATURES, ORDINAL_FEATURES, FeatureEncoder
+from .incremental import SNAPSHOT_ARTIFACT, STATE_OBJECT, _read_text, _row_hashes
+from .ingest import COORDINATE_COLUMNS, KEY_COLUMN, apply_compact_dtypes
+from .out_of_core import ColumnScaler
+from .outliers import WINSORIZE_PERCENTILES, WinsorizeIQRFilter
+from .partitioned import KEYS_ARTIFACT, parcel_keys
+from .sale_dates import add_sale_year, select_sale_window
+from .stages import build_preprocessing_pipeline
+
+# Shards per worker, a few more shards than workers evens out the shards that keep more rows than others
+SHARDS_PER_JOB = 4
+# Bytes of the csv scanned at once for record boundaries
+SCAN_BYTES = 16 << 20
+# Columns whose values the encoder learns (categories / vocabularies)
+ENCODED_COLUMNS = set(ORDINAL_FEATURES) | set(ONE_HOT_FEATURES) | set(INDICATOR_FEATURES) | set(BINARY_FEATURES)
+
+
+def shard_offsets(path, n_shards):
+    # Byte ranges [start, end) of about n_shards equal parts of the records after the header line. A shard only starts after a
+    # newline with an even number of quotes before it, so a quoted field spanning several lines is never cut.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        header = file.readline()
+    targets = np.linspace(len(header), size, n_shards + 1)[1:-1]
+    starts = [len(header)]
+    if len(targets) and size > len(header):
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        position, quotes = len(header), 0
+        while position < size and len(starts) <= len(targets):
+            block = np.asarray(data[position:position + SCAN_BYTES])
+            newlines = np.flatnonzero(block == ord('\n'))
+            quote_positions = np.flatnonzero(block == ord('"'))
+            record_ends = position + newlines[(quotes + np.searchsorted(quote_positions, newlines)) % 2 == 0] + 1
+            for target in targets[len(starts) - 1:]:
+                found = np.searchsorted(record_ends, target)
+                if found == len(record_ends):
+                    break
+                starts.append(int(record_ends[found]))
+            quotes += len(quote_positions)
+            position += len(block)
+        del data
+    bounds = sorted(set(start for start in starts if start < size)) + [size]
+    return header, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _shard_path(work_dir, step, shard):
+    return os.path.join(work_dir, f'{step}-{shard:05d}.arrow')
+
+
+def _write_shard(df, work_dir, step, shard):
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pa.OSFile(_shard_path(work_dir, step, shard), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_shard(work_dir, step, shard, columns=None):
+    # Zero copy: the columns are views of the memory-mapped file
+    with pa.memory_map(_shard_path(work_dir, step, shard)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table if columns is None else table.select(columns)
+
+
+def _ingest_shard(path, header, start, end, shard, work_dir, dropped_columns, train_sale_window):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = _read_text(io.BytesIO(header + file.read(end - start)), KEY_COLUMN)
+    # Hashed as published, like incremental.snapshot_hashes
+    hashes = pd.DataFrame({KEY_COLUMN: text[KEY_COLUMN].to_numpy(), 'row_hash': _row_hashes(text)})
+    monitor = DriftMonitor(exclude=dropped_columns).fit(text)
+    df = build_preprocessing_pipeline().run(apply_compact_dtypes(text.set_index(KEY_COLUMN)), dropped_columns=dropped_columns)
+    preprocessed = len(df)
+    df = select_sale_window(add_sale_year(df), *train_sale_window)
+    keys = parcel_keys(df)
+    df = df.drop(columns=COORDINATE_COLUMNS, errors='ignore')
+    _write_shard(df, work_dir, 'records', shard)
+    # The distinct values of the encoded columns in order of appearance, the encoder is fitted on these of every shard in order
+    vocabulary = pd.DataFrame({
+        col: (df[col].drop_duplicates() if col in ENCODED_COLUMNS else df[col].iloc[:0]).reset_index(drop=True)
+        for col in df.columns
+    })
+    return {'rows': len(text), 'preprocessed': preprocessed, 'hashes': hashes, 'keys': keys, 'vocabulary': vocabulary,
+            'monitor': monitor}
+
+
+def _encode_shard(work_dir, shard, encoder):
+    df = _read_shard(work_dir, 'records', shard).to_pandas()
+    _write_shard(encoder.to_frame(df), work_dir, 'encoded', shard)
+
+
+def _filter_shard(work_dir, shard, outlier_filter, columns_to_scale):
+    # Winsorizes and removes the outliers of the shard, returns the scaler fitted on what is left
+    df = outlier_filter.filter(_read_shard(work_dir, 'encoded', shard).to_pandas())
+    _write_shard(df, work_dir, 'filtered', shard)
+    return len(df), ColumnScaler(columns_to_scale).fit(df) if len(df) else None
+
+
+def _scale_shard(work_dir, shard, scaler):
+    df = _read_shard(work_dir, 'filtered', shard).to_pandas()
+    if len(df):
+        scaled = scaler.to_frame(df)
+    else:
+        # scikit-learn refuses to transform zero rows
+        scaled = pd.DataFrame(np.empty((0, len(scaler.get_feature_names_out()))), columns=scaler.get_feature_names_out(), index=df.index)
+    _write_shard(scaled, work_dir, 'scaled', shard)
+
+
+def _shard_frames(work_dir, step, shards):
+    for shard in shards:
+        yield _read_shard(work_dir, step, shard).to_pandas()
+
+
+def preprocess_parallel(input_path, columns_to_scale, train_sale_window=(None, None), n_jobs=None, n_shards=None,
+                        work_dir=None, run=None):
+    # Writes the artifacts of data_preprocessing/preprocessing.py for the raw csv at input_path with n_jobs processes (all cores
+    # by default). run is an optional RunInstrumentation that gets a stage per step.
+    n_jobs = n_jobs or os.cpu_count() or 1
+    work_dir = tempfile.mkdtemp(prefix='philly_shards_', dir=work_dir)
+
+    def begin(name, rows_in=None):
+        if run is not None:
+            run.begin(name, rows_in=rows_in)
+
+    def end(rows_out=None, **extra):
+        # cpu_seconds only covers the parent, the pool workers are counted by the OS once they exit after the last step
+        if run is not None:
+            run.end(rows_out=rows_out, **extra)
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # Reduce: the column drops are decided on the statistics of the whole file
+            begin('profile')
+            profile = profile_csv(input_path, executor=executor)
+            columns = [col for col in _read_text(input_path, KEY_COLUMN, nrows=0).columns if col != KEY_COLUMN]
+            dropped_columns = build_preprocessing_pipeline().drop_plan(columns, profile)
+            header, offsets = shard_offsets(input_path, n_shards or n_jobs * SHARDS_PER_JOB)
+            end(rows_out=profile.rows, shards=len(offsets))
+
+            begin('ingest', rows_in=profile.rows)
+            shards = list(range(len(offsets)))
+            ingested = list(executor.map(
+                _ingest_shard, [input_path] * len(shards), [header] * len(shards), [start for start, _ in offsets],
+                [stop for _, stop in offsets], shards, [work_dir] * len(shards), [dropped_columns] * len(shards),
+                [train_sale_window] * len(shards),
+            ))
+            write_object({
+                'key': KEY_COLUMN,
+                'dropped_columns': dropped_columns,
+                'train_sale_window': tuple(train_sale_window),
+            }, STATE_OBJECT)
+            write_artifact(pd.concat([part['hashes'] for part in ingested], ignore_index=True), SNAPSHOT_ARTIFACT)
+            write_artifact(pd.concat([part['keys'] for part in ingested]), KEYS_ARTIFACT)
+            # Reduce: the sketches of the shards are merged like the ones of the chunks of a serial run
+            monitor = ingested[0]['monitor']
+            for part in ingested[1:]:
+                monitor.merge(part['monitor'])
+            write_object(monitor, DRIFT_OBJECT)
+            rows = sum(len(part['keys']) for part in ingested)
+            end(rows_out=rows, preprocessed=sum(part['preprocessed'] for part in ingested))
+
+            # Reduce: the first appearances across the shards in file order are the first appearances in the whole file
+            begin('encode', rows_in=rows)
+            encoder = FeatureEncoder().fit(pd.concat([part['vocabulary'] for part in ingested], ignore_index=True))
+            write_object(encoder, 'feature_encoder')
+            list(executor.map(_encode_shard, [work_dir] * len(shards), shards, [encoder] * len(shards)))
+            end(rows_out=rows)
+
+            # Reduce: exact percentiles over the winsorized columns of every shard
+            begin('outliers', rows_in=rows)
+            winsorized = list(WINSORIZE_PERCENTILES)
+            outlier_filter = WinsorizeIQRFilter().fit(
+                pa.concat_tables([_read_shard(work_dir, 'encoded', shard, winsorized) for shard in shards]).to_pandas()
+            )
+            write_object(outlier_filter, 'outlier_filter')
+            filtered = list(executor.map(_filter_shard, [work_dir] * len(shards), shards, [outlier_filter] * len(shards),
+                                         [columns_to_scale] * len(shards)))
+            write_artifact_batches(_shard_frames(work_dir, 'filtered', shards), 'filtered')
+            rows = sum(kept for kept, _ in filtered)
+            end(rows_out=rows)
+
+            # Reduce: the means and variances of the shards are merged
+            begin('scale', rows_in=rows)
+            scaler = ColumnScaler(columns_to_scale)
+            for _, shard_scaler in filtered:
+                if shard_scaler is not None:
+                    scaler.merge(shard_scaler)
+            write_object(scaler, 'scaler')
+            list(executor.map(_scale_shard, [work_dir] * len(shards), shards, [scaler] * len(shards)))
+            write_artifact_batches(_shard_frames(work_dir, 'scaled', shards), 'scaled')
+            end(rows_out=rows)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'rows': rows, 'shards': len(offsets), 'n_jobs': n_jobs}
@@ -0,0 +1,125 @@
+# Spatially partitioned models.
+# The training rows are split by a geographic key of the parcel (zip code, census tract or ward) and a small model is fitted per
+# partition in a process pool, next to one global model fitted on every row. Partitions with fewer than min_rows rows are served
+# by the global model. The partition -> model lookup is a hash index built once after fitting, so a prediction batch is routed with
+# a single get_indexer call and every model predicts its rows in one vectorized call. Partitions whose rows changed (see
+# data_preprocessing/refresh.py) can be refitted on their own with refit.
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.metrics import r2_score
+from sklearn.utils.validation import check_is_fitted
+
+from .ingest import COORDINATE_COLUMNS
+
+# Raw geographic columns of every parcel of the training set, written by data_preprocessing/preprocessing.py as the parcel_keys
+# artifact (the encoder replaces them by their binary encoded bits)
+PARTITION_COLUMNS = ('zip_code', 'census_tract', 'geographic_ward')
+KEYS_ARTIFACT = 'parcel_keys'
+MIN_PARTITION_ROWS = 500
+
+
+def partition_keys(values, column):
+    # Text keys for the raw values of a partition column, None where missing. Zip codes are reduced to their 5 digits (the OPA
+    # publishes some as ZIP+4), tracts and wards to integers so 12, 12.0 and '12' are the same partition.
+    values = pd.Series(np.asarray(values, dtype=object))
+    if column == 'zip_code':
+        keys = values.astype(str).str.strip().str[:5]
+    else:
+        keys = pd.to_numeric(values, errors='coerce').round().astype('Int64').astype(str)
+    return keys.where(values.notna() & (keys != '<NA>'), None).to_numpy(dtype=object)
+
+
+def parcel_keys(df):
+    # Partition keys and coordinates (see philly_house_predictor/comparables.py) of every parcel of a preprocessed frame, stored as
+    # the parcel_keys artifact
+    keys = pd.DataFrame({col: partition_keys(df[col], col) for col in PARTITION_COLUMNS}, index=df.index)
+    for col in COORDINATE_COLUMNS:
+        keys[col] = df[col].to_numpy(dtype=np.float64) if col in df.columns else np.nan
+    return keys
+
+
+def _take(X, rows):
+    return X.iloc[rows] if isinstance(X, pd.DataFrame) else X[rows]
+
+
+def _fit_partition(estimator, X, y):
+    return estimator.fit(X, y)
+
+
+class PartitionedRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, estimator=None, partition_column='zip_code', min_rows=MIN_PARTITION_ROWS, n_jobs=None):
+        self.estimator = estimator
+        self.partition_column = partition_column
+        self.min_rows = min_rows
+        self.n_jobs = n_jobs
+
+    def _estimator(self):
+        if self.estimator is None:
+            from sklearn.ensemble import RandomForestRegressor
+            return RandomForestRegressor()
+        return self.estimator
+
+    def _groups(self, partitions, only=None):
+        # Rows of every partition with at least min_rows rows, largest first so the pool isn't left waiting on one big partition
+        keys = pd.Series(partition_keys(partitions, self.partition_column))
+        groups = {key: rows.to_numpy() for key, rows in keys.groupby(keys, sort=False).groups.items()
+                  if len(rows) >= self.min_rows and (only is None or key in only)}
+        return dict(sorted(groups.items(), key=lambda item: -len(item[1])))
+
+    def _fit_groups(self, X, y, groups):
+        y = np.asarray(y)
+        tasks = [(clone(self._estimator()), _take(X, rows), y[rows]) for rows in groups.values()]
+        if self.n_jobs == 1 or len(tasks) < 2:
+            models = [_fit_partition(*task) for task in tasks]
+        else:
+            workers = min(len(tasks), self.n_jobs or os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                models = list(executor.map(_fit_partition, *zip(*tasks)))
+        return dict(zip(groups, models))
+
+    def _build_lookup(self, models):
+        self.models_ = models
+        self.lookup_ = pd.Index(list(models), dtype=object)
+        self.partition_models_ = list(models.values())
+
+    def fit(self, X, y, partitions):
+        # partitions holds the raw partition_column value of every row of X
+        if isinstance(X, pd.DataFrame):
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        self.global_model_ = clone(self._estimator()).fit(X, y)
+        self._build_lookup(self._fit_groups(X, y, self._groups(partitions)))
+        return self
+
+    def refit(self, X, y, partitions, keys):
+        # Refits only the given partitions on their current rows (X holds the whole training set), the other partition models and
+        # the global model are kept. A partition that fell below min_rows is served by the global model again.
+        check_is_fitted(self, 'models_')
+        keys = set(partition_keys(list(keys), self.partition_column))
+        models = {key: model for key, model in self.models_.items() if key not in keys}
+        models.update(self._fit_groups(X, y, self._groups(partitions, only=keys)))
+        self._build_lookup(models)
+        return self
+
+    def predict(self, X, partitions):
+        check_is_fitted(self, 'models_')
+        # Position of every row's partition model, -1 (unknown or sparse partition) goes to the global model
+        positions = self.lookup_.get_indexer(partition_keys(partitions, self.partition_column))
+        predictions = np.empty(len(positions))
+        if not len(positions):
+            return predictions
+        order = np.argsort(positions, kind='stable')
+        sorted_positions = positions[order]
+        starts = np.flatnonzero(np.r_[True, sorted_positions[1:] != sorted_positions[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            rows = order[start:end]
+            position = sorted_positions[start]
+            model = self.global_model_ if position < 0 else self.partition_models_[position]
+            predictions[rows] = model.predict(_take(X, rows))
+        return predictions
+
+    def score(self, X, y, partitions):
+        return r2_score(y, self.predict(X, partitions))
@@ -0,0 +1,250 @@
+# Composable preprocessing pipeline.
+# Every stage only *declares* the columns it drops, the rows it filters and the values it imputes. The pipeline plans all
+# of them up front and materializes the result once, instead of copying the whole frame after every stage.
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class Stage:
+    name: str
+    # Columns that are always dropped by this stage
+    drop_columns: list = field(default_factory=list)
+    # Data dependent column drops as (rule, threshold), e.g. ('null_fraction_above', 0.75) or ('distinct_fraction_above', 0.2).
+    # They are evaluated on the input of the pipeline before any rows are filtered, or on a cached ColumnProfile of the raw file.
+    drop_rules: list = field(default_factory=list)
+    # Row filters as (column, operator, value), a row is kept only if it satisfies every filter of every stage
+    row_filters: list = field(default_factory=list)
+    # Imputations as {column: value}, row filters on these columns see the imputed values
+    fill_values: dict = field(default_factory=dict)
+    # Columns the drop rules of this stage never drop
+    keep_columns: list = field(default_factory=list)
+
+
+DROP_RULES = ('null_fraction_above', 'distinct_fraction_above')
+ROW_FILTER_OPERATORS = ('eq', 'gt', 'notna', 'isin', 'not_contains')
+
+
+def _pandas_mask(series, operator, value):
+    if operator == 'eq':
+        mask = series == value
+    elif operator == 'gt':
+        mask = series > value
+    elif operator == 'notna':
+        mask = series.notna()
+    elif operator == 'isin':
+        mask = series.isin(value)
+    elif operator == 'not_contains':
+        mask = ~series.str.contains(value, regex=False, na=False)
+    else:
+        raise ValueError(f"Unknown row filter operator '{operator}', expected one of {ROW_FILTER_OPERATORS}")
+    return mask.to_numpy(dtype=bool)
+
+
+def _polars_expression(column, operator, value):
+    import polars as pl
+
+    if operator == 'eq':
+        return pl.col(column) == value
+    if operator == 'gt':
+        return pl.col(column) > value
+    if operator == 'notna':
+        return pl.col(column).is_not_null()
+    if operator == 'isin':
+        # Compared value by value, recent polars releases refuse is_in between e.g. a Float64 column and a list of integers
+        return pl.any_horizontal([pl.col(column) == item for item in value]) if len(value) else pl.lit(False)
+    if operator == 'not_contains':
+        return ~pl.col(column).str.contains(value, literal=True).fill_null(False)
+    raise ValueError(f"Unknown row filter operator '{operator}', expected one of {ROW_FILTER_OPERATORS}")
+
+
+def _fill_series(series, value):
+    # Categorical columns need the imputed value registered as a category before filling
+    if isinstance(series.dtype, pd.CategoricalDtype) and value not in series.cat.categories:
+        series = series.cat.add_categories([value])
+    return series.fillna(value)
+
+
+class PreprocessingPipeline:
+    def __init__(self, stages=None, engine='pandas'):
+        if engine not in ('pandas', 'polars'):
+            raise ValueError(f"Unknown engine '{engine}', expected 'pandas' or 'polars'")
+        self.stages = list(stages or [])
+        self.engine = engine
+        # Seconds spent per stage during the last run (planning masks / column drops, then the single materialization)
+        self.timings = {}
+        self.dropped_columns = []
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+        return self
+
+    def fill_values(self):
+        fills = {}
+        for stage in self.stages:
+            fills.update(stage.fill_values)
+        return fills
+
+    def _rule_drops(self, stage, null_fraction, distinct_fraction):
+        dropped = []
+        for rule, threshold in stage.drop_rules:
+            if rule == 'null_fraction_above':
+                dropped += [col for col in null_fraction.index if null_fraction[col] > threshold]
+            elif rule == 'distinct_fraction_above':
+                dropped += [col for col in distinct_fraction.index if distinct_fraction[col] > threshold]
+            else:
+                raise ValueError(f"Unknown drop rule '{rule}', expected one of {DROP_RULES}")
+        return [col for col in dropped if col not in stage.keep_columns]
+
+    def drop_plan(self, columns, profile):
+        # The columns the stages drop from a frame with these columns, decided from the ColumnProfile of the whole file. Shards of
+        # the file (see philly_house_predictor/parallel_preprocessing.py) are run with it as dropped_columns, so they all drop the
+        # same columns instead of deciding from their own rows.
+        dropped = []
+        for stage in self.stages:
+            if stage.drop_rules:
+                candidates = [col for col in columns if col not in dropped]
+                dropped += self._rule_drops(stage, profile.null_fraction().reindex(candidates).dropna(),
+                                            profile.distinct_fraction().reindex(candidates).dropna())
+            dropped += stage.drop_columns
+        return list(dict.fromkeys(col for col in dropped if col in columns))
+
+    def run(self, source, profile=None, dropped_columns=None, key=None):
+        # source is either a DataFrame or the path of a csv file.
+        # profile is an optional ColumnProfile of the raw file, when given the drop rules use its cached statistics
+        # instead of scanning the columns again.
+        # dropped_columns replaces the drop rules by the columns a previous run dropped, so a handful of new records
+        # (see philly_house_predictor/incremental.py) end up with exactly the same columns as the full dataset.
+        # key (e.g. KEY_COLUMN) is read as text and becomes the index of the result instead of a column the stages could drop,
+        # like the streaming loader does, so the records can be traced back to their parcel.
+        self.timings = {}
+        if self.engine == 'polars':
+            if dropped_columns is not None:
+                raise ValueError("dropped_columns is only supported by the pandas engine")
+            return self._run_polars(source, profile, key)
+        if isinstance(source, str):
+            start = time.perf_counter()
+            source = pd.read_csv(source, dtype={key: str} if key else None, index_col=key)
+            self.timings['read_csv'] = time.perf_counter() - start
+        elif key is not None and key in source.columns:
+            source = source.set_index(key)
+        return self._run_pandas(source, profile, dropped_columns)
+
+    def _run_pandas(self, df, profile=None, dropped_columns=None):
+        fills = self.fill_values()
+        dropped = list(dropped_columns or [])
+        mask = np.ones(len(df), dtype=bool)
+
+        for stage in self.stages:
+            start = time.perf_counter()
+            if stage.drop_rules and dropped_columns is None:
+                # Only the columns that are still candidates need to be looked at
+                candidates = [col for col in df.columns if col not in dropped]
+                if profile is not None:
+                    null_fraction = profile.null_fraction().reindex(candidates).dropna()
+                    distinct_fraction = profile.distinct_fraction().reindex(candidates).dropna()
+                else:
+                    needs_distinct = any(rule == 'distinct_fraction_above' for rule, _ in stage.drop_rules)
+                    null_fraction = pd.Series({col: df[col].isna().mean() for col in candidates}, dtype=float)
+                    distinct_fraction = pd.Series({col: df[col].nunique() / max(len(df), 1) for col in candidates}
+                                                  if needs_distinct else {}, dtype=float)
+                dropped += self._rule_drops(stage, null_fraction, distinct_fraction)
+            dropped += stage.drop_columns
+
+            for column, operator, value in stage.row_filters:
+                series = df[column]
+                column_mask = _pandas_mask(series, operator, value)
+                if column in fills:
+                    # Missing values take the outcome of the imputed value instead
+                    filled_outcome = _pandas_mask(pd.Series([fills[column]]), operator, value)[0]
+                    column_mask = np.where(series.isna().to_numpy(), filled_outcome, column_mask)
+                mask &= column_mask
+            self.timings[stage.name] = time.perf_counter() - start
+
+        # Materialize once: every kept column is gathered a single time
+        start = time.perf_counter()
+        self.dropped_columns = list(dict.fromkeys(col for col in dropped if col in df.columns))
+        rows = np.flatnonzero(mask)
+        columns = {}
+        for col in df.columns:
+            if col in self.dropped_columns:
+                continue
+            series = df[col].take(rows)
+            if col in fills:
+                series = _fill_series(series, fills[col])
+            columns[col] = series
+        result = pd.DataFrame(columns, copy=False)
+        self.timings['materialize'] = time.perf_counter() - start
+        return result
+
+    def _run_polars(self, source, profile=None, key=None):
+        # Lazy engine: the whole plan is pushed down to polars, which only reads the columns that survive
+        # and never materializes an intermediate frame.
+        import polars as pl
+
+        if isinstance(source, str):
+            overrides = {key: pl.Utf8} if key else None
+            try:
+                lazy = pl.scan_csv(source, infer_schema_length=10_000, schema_overrides=overrides)
+            except TypeError:
+                # Older polars releases call it dtypes
+                lazy = pl.scan_csv(source, infer_schema_length=10_000, dtypes=overrides)
+        else:
+            lazy = pl.from_pandas(source, include_index=key is not None and source.index.name == key).lazy()
+        columns = lazy.collect_schema().names() if hasattr(lazy, 'collect_schema') else lazy.columns
+        # The key is carried through the plan but is never a candidate of the drop rules
+        columns = [col for col in columns if col != key]
+
+        # All data dependent drop rules share a single scan over the input (or none with a cached profile)
+        start = time.perf_counter()
+        if profile is not None:
+            null_fraction = profile.null_fraction().reindex(columns).dropna()
+            distinct_fraction = profile.distinct_fraction().reindex(columns).dropna()
+        else:
+            statistics = lazy.select(
+                [pl.len().alias('__rows__')]
+                + [pl.col(col).null_count().alias(f'{col}__nulls') for col in columns]
+                + [pl.col(col).n_unique().alias(f'{col}__distinct') for col in columns]
+            ).collect().row(0, named=True)
+            rows = max(statistics['__rows__'], 1)
+            null_fraction = pd.Series({col: statistics[f'{col}__nulls'] / rows for col in columns}, dtype=float)
+            # polars counts null as a distinct value, pandas' nunique doesn't
+            distinct_fraction = pd.Series({col: (statistics[f'{col}__distinct'] - (statistics[f'{col}__nulls'] > 0)) / rows
+                                           for col in columns}, dtype=float)
+        self.timings['column_statistics'] = time.perf_counter() - start
+
+        fills = self.fill_values()
+        dropped = []
+        filters = []
+        for stage in self.stages:
+            remaining = [col for col in columns if col not in dropped]
+            dropped += self._rule_drops(stage, null_fraction.reindex(remaining).dropna(),
+                                        distinct_fraction.reindex(remaining).dropna())
+            dropped += stage.drop_columns
+            filters += [_polars_expression(*row_filter) for row_filter in stage.row_filters]
+        self.dropped_columns = list(dict.fromkeys(col for col in dropped if col in columns))
+
+        plan = lazy.with_columns([pl.col(col).fill_null(value) for col, value in fills.items() if col in columns])
+        if filters:
+            plan = plan.filter(pl.all_horizontal(filters))
+        plan = plan.drop(self.dropped_columns)
+        if key is not None:
+            plan = plan.select([key] + [col for col in columns if col not in self.dropped_columns])
+
+        # polars profiles every node of the optimized plan, which gives the stage by stage breakdown
+        # (newer releases removed LazyFrame.profile, there only the total materialization time is reported)
+        start = time.perf_counter()
+        try:
+            result, profile = plan.profile()
+            for node, node_start, node_end in profile.iter_rows():
+                self.timings[node] = (node_end - node_start) / 1_000_000
+        except AttributeError:
+            result = plan.collect()
+        self.timings['materialize'] = time.perf_counter() - start
+        return result.to_pandas().set_index(key) if key is not None else result.to_pandas()
+
+    def report(self):
+        return pd.Series(self.timings, name='seconds')
@@ -0,0 +1,33 @@
+# Vectorized sale_date handling.
+# The year is extracted once for the whole column, after which any sale window can be selected with a cheap boolean mask,
+# so training sets for different windows (e.g. train on 2015-2022, hold out 2023) can be regenerated in seconds.
+import numpy as np
+import pandas as pd
+
+
+def sale_year(sale_date):
+    # sale_date is stored as text ('2014-05-07 00:00:00'), the first four characters are the year.
+    # Missing or malformed dates become NaN and therefore fall outside of every window.
+    years = pd.to_numeric(sale_date.astype(str).str.slice(0, 4), errors='coerce')
+    return years.astype(np.float32)
+
+
+def add_sale_year(df, column='sale_date'):
+    # Replace the raw sale_date text by its year
+    df = df.assign(sale_year=sale_year(df[column]))
+    return df.drop(columns=[column])
+
+
+def sale_window_mask(years, start_year=None, end_year=None):
+    # Both ends of the window are inclusive, None leaves that side open
+    mask = years.notna()
+    if start_year is not None:
+        mask &= years >= start_year
+    if end_year is not None:
+        mask &= years <= end_year
+    return mask
+
+
+def select_sale_window(df, start_year=None, end_year=None, column='sale_year'):
+    # Keep the sales within the window and drop the year as we want to avoid recency bias
+    return df[sale_window_mask(df[column], start_year, end_year)].drop(columns=[column])
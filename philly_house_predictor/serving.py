@@ -0,0 +1,162 @@
+# Batch prediction service for market_value estimates.
+# The model bundle is loaded once at startup. Concurrent HTTP requests are queued and a single worker thread drains the queue into
+# micro-batches, so many small requests share one vectorized predict call instead of paying the per-call overhead each.
+#
+#   python -m philly_house_predictor serve --port 8000
+#   curl -X POST localhost:8000/predict -d '{"zip_code": "19143", "total_livable_area": 1200, ...}'
+#   python -m philly_house_predictor predict new_parcels.csv predictions.csv
+#
+# The commands are defined in philly_house_predictor/cli.py, which loads the bundle (the market_value_model artifact by default).
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from .drift import DriftError
+
+MAX_BATCH_ROWS = 4096
+# How long the worker waits for more requests to join a batch once it has one, in seconds. With 0 a single request is predicted
+# right away, and the requests that arrive while the worker is busy predicting form the next batch.
+MAX_BATCH_DELAY = 0.0
+
+
+class MicroBatcher:
+    def __init__(self, bundle, max_batch_rows=MAX_BATCH_ROWS, max_batch_delay=MAX_BATCH_DELAY):
+        self.bundle = bundle
+        self.max_batch_rows = max_batch_rows
+        self.max_batch_delay = max_batch_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, records):
+        # records is a list of dicts, returns a Future of their predictions
+        future = Future()
+        self._queue.put((records, future))
+        return future
+
+    def predict(self, records, timeout=None):
+        return self.submit(records).result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_batch_delay
+            while rows < self.max_batch_rows:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self._predict(batch)
+
+    def _predict(self, batch):
+        try:
+            predictions = self.bundle.predict([record for records, _ in batch for record in records])
+        except Exception:
+            # One bad record shouldn't fail the whole batch, so every request is retried on its own to find the culprit
+            for records, future in batch:
+                try:
+                    future.set_result(self.bundle.predict(records))
+                except Exception as error:
+                    future.set_exception(error)
+            return
+        offsets = np.cumsum([0] + [len(records) for records, _ in batch])
+        for (_, future), start, end in zip(batch, offsets[:-1], offsets[1:]):
+            future.set_result(predictions[start:end])
+
+
+def _handler(batcher):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._respond(200, {'status': 'ok', 'features': batcher.bundle.features})
+            else:
+                self._respond(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._respond(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except json.JSONDecodeError as error:
+                self._respond(400, {'error': f'Invalid JSON: {error}'})
+                return
+            # A single parcel as an object or a batch as a list of objects
+            records = body if isinstance(body, list) else [body]
+            try:
+                predictions = batcher.predict(records)
+            except (KeyError, ValueError, TypeError) as error:
+                self._respond(400, {'error': str(error)})
+                return
+            self._respond(200, {'market_value': [float(prediction) for prediction in predictions]})
+
+        def log_message(self, format, *args):
+            # Logging every request to stderr costs more than the prediction itself
+            pass
+
+    return PredictionHandler
+
+
+def serve(bundle, host='127.0.0.1', port=8000, max_batch_rows=MAX_BATCH_ROWS, max_batch_delay=MAX_BATCH_DELAY):
+    batcher = MicroBatcher(bundle, max_batch_rows, max_batch_delay)
+    server = ThreadingHTTPServer((host, port), _handler(batcher))
+    print(f'Serving market_value predictions on http://{host}:{server.server_address[1]}/predict')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _read_records(path):
+    if path == '-':
+        return pd.read_json(sys.stdin, lines=True)
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        return pd.read_json(path, lines=path.endswith('.jsonl'))
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    # The raw OPA csv has mixed-type columns, strings keep the values as published
+    return pd.read_csv(path, dtype=str)
+
+
+def predict_file(bundle, input_path, output_path=None, batch_rows=100_000, monitor=None):
+    # Scores a whole file in large batches and writes the records' market_value predictions next to their parcel_number.
+    # With monitor (the drift.DriftMonitor of the training snapshot) records that drifted from it raise a DriftError unscored.
+    records = _read_records(input_path)
+    if monitor is not None:
+        drift_report = monitor.compare(records)
+        if drift_report['drifted'].any():
+            raise DriftError(drift_report)
+    predictions = np.concatenate([
+        bundle.predict(records.iloc[start:start + batch_rows]) for start in range(0, len(records), batch_rows)
+    ]) if len(records) else np.empty(0)
+    output = pd.DataFrame({'market_value': predictions})
+    if 'parcel_number' in records.columns:
+        output.insert(0, 'parcel_number', records['parcel_number'].to_numpy())
+    if output_path is None or output_path == '-':
+        output.to_csv(sys.stdout, index=False)
+    else:
+        output.to_csv(output_path, index=False)
+    return output
+
@@ -0,0 +1,162 @@
+# Content addressed cache for pipeline stages.
+# A stage is fingerprinted from its input files (content hash), the source code it runs and its parameters (percentile lists,
+# valid category lists, ...). When none of them changed the stored output is reused instead of recomputing it. Entries are evicted
+# least recently used first once the cache grows past its size limit.
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import uuid
+
+import joblib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CACHE_DIR = os.environ.get(
+    'PHILLY_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.stage_cache'),
+)
+# 5 GiB by default
+CACHE_MAX_BYTES = int(os.environ.get('PHILLY_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+FILE_HASHES_NAME = 'file_hashes.json'
+META_NAME = 'meta.json'
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(obj):
+    # Functions, classes and modules are fingerprinted by their source code, paths by the content of the file
+    if isinstance(obj, str):
+        return _hash_file(obj)
+    return hashlib.sha256(inspect.getsource(obj).encode('utf-8')).hexdigest()
+
+
+def _total_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class StageCache:
+    def __init__(self, directory=None, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory or CACHE_DIR
+        self.max_bytes = max_bytes
+        # Key of every stage resolved during this session, so later stages can depend on earlier ones
+        self.keys = {}
+        # Whether the last get_or_compute of every stage was served from the cache
+        self.hits = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def file_fingerprint(self, path):
+        # Hashing a 300MB csv on every run would defeat the purpose, so hashes are remembered per (path, size, mtime)
+        index_path = os.path.join(self.directory, FILE_HASHES_NAME)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as file:
+                index = json.load(file)
+        stat = os.stat(path)
+        entry = index.get(os.path.abspath(path))
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        digest = _hash_file(path)
+        index[os.path.abspath(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+        with open(f'{index_path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(index, file)
+        os.replace(f'{index_path}.tmp', index_path)
+        return digest
+
+    def key(self, stage, inputs=(), sources=(), params=None, depends_on=()):
+        fingerprint = {
+            'stage': stage,
+            'inputs': [self.file_fingerprint(path) for path in inputs],
+            'sources': [source_fingerprint(source) for source in sources],
+            'params': params,
+            'depends_on': [self.keys[name] for name in depends_on],
+        }
+        text = json.dumps(fingerprint, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+    def _entry_path(self, stage, key):
+        return os.path.join(self.directory, f'{stage}-{key}')
+
+    def get_or_compute(self, stage, compute, inputs=(), sources=(), params=None, depends_on=()):
+        # compute() may return a DataFrame, a dict of named outputs or any other picklable object
+        key = self.key(stage, inputs, sources, params, depends_on)
+        self.keys[stage] = key
+        path = self._entry_path(stage, key)
+        if os.path.exists(os.path.join(path, META_NAME)):
+            self.hits[stage] = True
+            # The modification time of the metadata is the last use of the entry
+            os.utime(os.path.join(path, META_NAME))
+            return self._load(path)
+
+        self.hits[stage] = False
+        output = compute()
+        self._store(path, stage, key, output)
+        self.evict(keep=path)
+        return output
+
+    def _store(self, path, stage, key, output):
+        # Written into a temporary directory first, so an interrupted run never leaves a half written entry
+        staging = f'{path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(staging)
+        outputs = output if isinstance(output, dict) else {'output': output}
+        layout = {}
+        for name, value in outputs.items():
+            if isinstance(value, pd.DataFrame):
+                # The index is preserved so the cached frame is identical to the computed one
+                pq.write_table(pa.Table.from_pandas(value), os.path.join(staging, f'{name}.parquet'), compression='zstd')
+                layout[name] = 'parquet'
+            else:
+                joblib.dump(value, os.path.join(staging, f'{name}.joblib'))
+                layout[name] = 'joblib'
+        with open(os.path.join(staging, META_NAME), 'w', encoding='utf-8') as file:
+            json.dump({'stage': stage, 'key': key, 'created': time.time(), 'dict': isinstance(output, dict), 'layout': layout}, file)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(staging, path)
+
+    def _load(self, path):
+        with open(os.path.join(path, META_NAME), encoding='utf-8') as file:
+            meta = json.load(file)
+        outputs = {}
+        for name, kind in meta['layout'].items():
+            if kind == 'parquet':
+                outputs[name] = pq.read_table(os.path.join(path, f'{name}.parquet'), memory_map=True).to_pandas()
+            else:
+                outputs[name] = joblib.load(os.path.join(path, f'{name}.joblib'))
+        return outputs if meta['dict'] else outputs['output']
+
+    def entries(self):
+        # (path, size in bytes, last use) of every complete entry
+        entries = []
+        for name in os.listdir(self.directory):
+            meta = os.path.join(self.directory, name, META_NAME)
+            if not name.endswith('.tmp') and os.path.exists(meta):
+                path = os.path.join(self.directory, name)
+                entries.append((path, _total_size(path), os.path.getmtime(meta)))
+        return entries
+
+    def evict(self, keep=None):
+        # Remove the least recently used entries until the cache fits in max_bytes (the entry just written is always kept)
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,159 @@
+# Preprocessing stages for the Office of Property Assessments dataset, in the order they were originally applied.
+from .pipeline import PreprocessingPipeline, Stage
+
+# Drop columns with more than 75% missing values (a column needs at least 25% of its values to be kept)
+drop_high_missing_percent_columns = Stage(
+    'drop_high_missing_percent_columns',
+    drop_rules=[('null_fraction_above', 0.75)],
+)
+
+# Drop columns with too many distinct values as we want to form clusters within the dataset
+# and create relationships between the features. These distinct values within a single column for
+# every single record blurs the relationships, and as such we are removing it.
+# The original snapshot had about 580k rows, so we are targeting columns with 20% distinct values (116k distinct values).
+# The threshold is relative so it keeps working on newer snapshots of a different size.
+# The high_cardinality columns are: ['the_geom', 'the_geom_webmercator', 'book_and_page', 'location', 'parcel_number', 'registry_number', 'pin', 'objectid']
+# lat and lng are kept even though they are just as distinct: they are not used as features (they are removed before encoding) but
+# locate every parcel for the comparable sales index (see philly_house_predictor/comparables.py).
+drop_high_cardinality_columns = Stage(
+    'drop_high_cardinality_columns',
+    drop_rules=[('distinct_fraction_above', 0.2)],
+    keep_columns=['lat', 'lng'],
+)
+
+# Filter out only homes (single / multi-family homes)
+filter_single_multifamily_homes = Stage(
+    'filter_single_multifamily_homes',
+    row_filters=[('category_code_description', 'eq', "SINGLE FAMILY")],
+)
+
+drop_specific = Stage(
+    'drop_specific',
+    drop_columns=[
+        # Dropped in order to avoid recency bias
+        'assessment_date',
+
+        # There's only a single category: Single Family Home(s) and both of these columns have redundant information of the same single value representing single-family home(s).
+        'category_code',
+        'category_code_description',
+
+        # This column only re-assures us if the year built has been estimated and doesn't really provide us value towards estimating an valuation of the property.
+        # More valuable alternative is the year_built column which also has much less missing values.
+        'year_built_estimate',
+
+        # Dropped in order to avoid recency bias
+        'recording_date',
+        # Drop columns: 'mailing_city_state', 'mailing_zip' b/c the mailing address / state of a property owner doesn't indicate a property's worth.
+        'mailing_city_state', 'mailing_zip',
+
+        # Dropped building_code because it was not possible to find a clear definition of what the codes had represented.
+        # There is no updated code manual nor is it even described within the metadata of the Office of Phildelphia's Assessment
+        'building_code',
+
+        # Dropped b/c water department uses this as some form of identification number that was not clarified by the Office of Philadelphia's metadata.
+        'street_code',
+
+        # Too many missing values and near impossible to impute. It is simply a nominal attribute that is hard to attribute towards our target variable and very susceptible
+        # to forming bad patterns within our model such as north direction could increase market valuation, but the zipcode and lat/lng are better indicators of an area based
+        # valuation.
+        'street_direction',
+
+        # Unknown definition of two-digit numbers, weren't even listed in the OPA's metadata
+        'building_code_new',
+
+        # Have ensured at this point most of the dataset is primarily of single-family homes.
+        'building_code_description',
+        'building_code_description_new',
+
+        # Removed Central Air as it's a binary variable with no other meaningful reference to impute from (38% missing)
+        'central_air',
+
+        # Unclear Meaning from Metadata
+        'off_street_open',
+
+        # Dropping State Code as this information isn't pertinent to relations of the market value within Philadelphia
+        'state_code',
+
+        # Dropping House Number as these are based more on the local neighborhoods within Philadelphia which tends to have very little value in regards to market_value
+        'house_number',
+
+        # Nearly 12k missing values and there's unclear definition on what is an average and what each letter represents for general construction from the metadata
+        'general_construction',
+
+        # Unclear Definitions and too many messy values
+        'quality_grade',
+
+        # Dropped due to low correlation to market value: 0.06
+        'exempt_land',
+
+        # Dropped due to too wide spread when manually analyzing
+        'sale_price',
+    ],
+    row_filters=[
+        # Remove all Vacant Land Properties from the dataset
+        ('building_code_description', 'not_contains', "VACANT"),
+
+        # Remove records with placeholder values for sale_price and market_value
+        ('sale_price', 'gt', 1),
+        ('market_value', 'gt', 1),
+    ],
+)
+
+impute_columns = Stage(
+    'impute_columns',
+    fill_values={
+        # Imputed Missing Values in basement column with new attribute K.
+        'basements': "K",
+
+        # Imputed Missing Values in type_heated column with attribute H (represents missing/unknown heating type for property).
+        'type_heater': "H",
+
+        # Imputed Missing Values in topography column with attribute F (represents street level as most properties in philadelphia are at street level according OPA).
+        'topography': "F",
+    },
+)
+
+drop_missing_vals_records = Stage(
+    'drop_missing_vals_records',
+    row_filters=[(col, 'notna', None) for col in [
+        'census_tract', 'depth', 'exterior_condition', 'fireplaces', 'frontage', 'garage_spaces',
+        'geographic_ward', 'interior_condition', 'market_value', 'number_of_bathrooms', 'number_of_bedrooms',
+        'number_stories', 'parcel_shape', 'taxable_building', 'total_area', 'total_livable_area', 'view_type',
+        'year_built', 'zip_code', 'zoning',
+    ]],
+)
+
+# Constraining the categorical columns to the valid definitions from the OPA's metadata
+valid_basement = ['0', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K']
+valid_type_heater = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
+valid_view_types = ['I', 'H', 'D', 'A', 'C', '0', 'E', 'B']
+valid_topography_types = ['A', 'B', 'C', 'D', 'E', 'F']
+valid_parcel_shape = ['A', 'B', 'C', 'D', 'E']
+# Interior conditions 0 (not applicable), 1 and 8 don't have any definitions within the OPA's metadata
+valid_interior_condition = [2, 3, 4, 5, 6, 7]
+
+filter_specific = Stage(
+    'filter_specific',
+    row_filters=[
+        ('basements', 'isin', valid_basement),
+        ('type_heater', 'isin', valid_type_heater),
+        ('view_type', 'isin', valid_view_types),
+        ('topography', 'isin', valid_topography_types),
+        ('parcel_shape', 'isin', valid_parcel_shape),
+        ('interior_condition', 'isin', valid_interior_condition),
+    ],
+)
+
+OPA_PREPROCESSING_STAGES = [
+    drop_high_missing_percent_columns,
+    drop_high_cardinality_columns,
+    filter_single_multifamily_homes,
+    drop_specific,
+    impute_columns,
+    drop_missing_vals_records,
+    filter_specific,
+]
+
+
+def build_preprocessing_pipeline(engine='pandas'):
+    return PreprocessingPipeline(OPA_PREPROCESSING_STAGES, engine=engine)
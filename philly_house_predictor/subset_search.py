@@ -0,0 +1,217 @@
+# Parallel feature subset search.
+# The data is split once into contiguous float32 train / test matrices that every worker of a process pool receives a single time,
+# so a fit only selects its columns instead of re-slicing a DataFrame and re-running train_test_split. Instead of enumerating all
+# 2^n - 1 subsets, the search can grow (forward) or shrink (backward) the subset greedily, or prune the subsets with successive
+# halving on a growing number of training rows. Every evaluation is appended to a JSON lines results file as soon as it finishes,
+# and evaluations already in that file are reused, so an interrupted search resumes where it stopped. They are keyed by a
+# fingerprint of the data and of the estimator's parameters, a rewritten artifact or another estimator is evaluated again.
+# A TrainingData (see philly_house_predictor/training_data.py) is searched on its own split, the workers memory-map its file.
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import r2_score, root_mean_squared_error
+from sklearn.model_selection import train_test_split
+
+from .training_data import TrainingData
+
+STRATEGIES = ('exhaustive', 'forward', 'backward', 'halving')
+
+# Matrices and estimator of the current process, set once per worker by _init_worker
+_worker_state = {}
+
+
+def generate_column_combinations(column_list):
+    all_combinations = []
+    for r in range(1, len(column_list) + 1):
+        all_combinations.extend(combinations(column_list, r))
+    return all_combinations
+
+
+def _data_fingerprint(arrays, test_size, random_state):
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        digest.update(str(array.shape).encode())
+        digest.update(array.data)
+    digest.update(f'{test_size}-{random_state}'.encode())
+    return digest.hexdigest()
+
+
+def _estimator_key(estimator):
+    params = json.dumps(estimator.get_params(deep=False), sort_keys=True, default=str)
+    return hashlib.blake2b(f'{type(estimator).__name__}{params}'.encode(), digest_size=8).hexdigest()
+
+
+def _init_worker(data, estimator):
+    # data is a TrainingData (pickled as its path) or the (X_train, y_train, X_test, y_test) arrays
+    if isinstance(data, TrainingData):
+        data = (data.X_train, data.y_train, data.X_test, data.y_test)
+    X_train, y_train, X_test, y_test = data
+    _worker_state.update(X_train=X_train, y_train=y_train, X_test=X_test, y_test=y_test, estimator=estimator)
+
+
+def _evaluate(columns, rows):
+    # Fits on the first `rows` training rows (already shuffled by the split, so any prefix is a random sample) and the given columns
+    state = _worker_state
+    start = time.perf_counter()
+    model = clone(state['estimator'])
+    model.fit(state['X_train'][:rows, columns], state['y_train'][:rows])
+    fit_seconds = time.perf_counter() - start
+    predictions = model.predict(state['X_test'][:, columns])
+    return {
+        'r2': float(r2_score(state['y_test'], predictions)),
+        'rmse': float(root_mean_squared_error(state['y_test'], predictions)),
+        'fit_seconds': fit_seconds,
+    }
+
+
+class FeatureSubsetSearch:
+    def __init__(self, estimator=None, strategy='forward', results_path='feature_subset_search.jsonl', n_jobs=None,
+                 test_size=0.2, random_state=42, tolerance=0.0, min_rows=5000, eta=3):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+        self.estimator = estimator
+        self.strategy = strategy
+        self.results_path = results_path
+        self.n_jobs = n_jobs
+        self.test_size = test_size
+        self.random_state = random_state
+        # Greedy searches stop once the best step improves the RMSE by no more than this
+        self.tolerance = tolerance
+        # Successive halving starts every subset on min_rows training rows and keeps the best 1/eta for eta times more rows
+        self.min_rows = min_rows
+        self.eta = eta
+
+    def _load_results(self):
+        done = {}
+        if os.path.exists(self.results_path):
+            with open(self.results_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a search that was killed while writing it
+                        continue
+                    # Records written before the data and estimator were part of the key are never reused
+                    done[(record.get('data'), record.get('estimator'), record['feature_set'], tuple(record['features']),
+                          record['rows'])] = record
+        return done
+
+    def search(self, X, y=None, feature_set='features'):
+        # X is a DataFrame and y the target, or X is a TrainingData (its split replaces test_size / random_state and y is not used).
+        # Returns the evaluations on every training row ordered by RMSE
+        if isinstance(X, TrainingData):
+            features = list(X.features)
+            data = X
+            n_train = X.n_train
+            fingerprint = X.fingerprint
+        else:
+            features = list(X.columns)
+            train, test = train_test_split(np.arange(len(X)), test_size=self.test_size, random_state=self.random_state)
+            values = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+            target = np.asarray(y, dtype=np.float64)
+            data = (values[train], target[train], values[test], target[test])
+            n_train = len(train)
+            fingerprint = _data_fingerprint((values, target), self.test_size, self.random_state)
+        if self.estimator is None:
+            from sklearn.ensemble import RandomForestRegressor
+            estimator = RandomForestRegressor()
+        else:
+            estimator = self.estimator
+
+        self.fingerprint_ = fingerprint
+        self.estimator_key_ = _estimator_key(estimator)
+        self.feature_set_ = feature_set
+        self.features_ = features
+        self.n_train_ = n_train
+        self.results_ = []
+        self._done = self._load_results()
+
+        if self.n_jobs == 1:
+            _init_worker(data, estimator)
+            self._executor = None
+            self._run(features)
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(data, estimator)) as executor:
+                self._executor = executor
+                self._run(features)
+        self._executor = None
+
+        # Only subsets fitted on every training row are comparable
+        complete = sorted((record for record in self.results_ if record['rows'] == self.n_train_), key=lambda record: record['rmse'])
+        self.best_features_ = complete[0]['features']
+        return complete
+
+    def _run(self, features):
+        if self.strategy == 'exhaustive':
+            self._evaluate_all(generate_column_combinations(features), self.n_train_)
+        elif self.strategy == 'forward':
+            self._greedy(features, forward=True)
+        elif self.strategy == 'backward':
+            self._greedy(features, forward=False)
+        else:
+            self._halving(generate_column_combinations(features))
+
+    def _evaluate_all(self, subsets, rows, step=None):
+        # Evaluates the subsets in parallel, reusing the ones found in the results file, and returns their records in order
+        keys = [(self.fingerprint_, self.estimator_key_, self.feature_set_, tuple(subset), rows) for subset in subsets]
+        records = {key: self._done[key] for key in keys if key in self._done}
+        pending = [key for key in dict.fromkeys(keys) if key not in records]
+        positions = {feature: position for position, feature in enumerate(self.features_)}
+
+        with open(self.results_path, 'a', encoding='utf-8') as file:
+            def finish(key, scores):
+                record = {'data': key[0], 'estimator': key[1], 'feature_set': key[2], 'features': list(key[3]), 'rows': rows,
+                          'strategy': self.strategy, 'step': step, **scores}
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                self._done[key] = records[key] = record
+
+            if self._executor is None:
+                for key in pending:
+                    finish(key, _evaluate([positions[feature] for feature in key[3]], rows))
+            else:
+                futures = {self._executor.submit(_evaluate, [positions[feature] for feature in key[3]], rows): key for key in pending}
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
+
+        ordered = [records[key] for key in keys]
+        self.results_ += ordered
+        return ordered
+
+    def _greedy(self, features, forward):
+        current = [] if forward else list(features)
+        best_rmse = np.inf
+        if not forward:
+            best_rmse = self._evaluate_all([current], self.n_train_, step=0)[0]['rmse']
+
+        step = 1
+        while (forward and len(current) < len(features)) or (not forward and len(current) > 1):
+            if forward:
+                candidates = [current + [feature] for feature in features if feature not in current]
+            else:
+                candidates = [[feature for feature in current if feature != removed] for removed in current]
+            records = self._evaluate_all(candidates, self.n_train_, step=step)
+            best = min(range(len(records)), key=lambda position: records[position]['rmse'])
+            if records[best]['rmse'] >= best_rmse - self.tolerance:
+                break
+            current, best_rmse = candidates[best], records[best]['rmse']
+            step += 1
+
+    def _halving(self, subsets):
+        rows = min(self.min_rows, self.n_train_)
+        step = 0
+        while True:
+            records = self._evaluate_all(subsets, rows, step=step)
+            if rows == self.n_train_:
+                break
+            # Keep the best 1/eta of the subsets and give them eta times more rows, the last rung always uses every training row
+            order = np.argsort([record['rmse'] for record in records], kind='stable')
+            subsets = [subsets[position] for position in order[:max(1, len(subsets) // self.eta)]]
+            rows = self.n_train_ if len(subsets) == 1 else min(rows * self.eta, self.n_train_)
+            step += 1
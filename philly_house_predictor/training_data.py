@@ -0,0 +1,165 @@
+# Shared training matrices of the feature set artifacts.
+# The features of an artifact are written once as a C-contiguous float32 matrix (and the target as float64) into .npy files that
+# every model, search and worker process memory-maps, instead of every script reading the artifact into DataFrames and every
+# estimator converting them again on each of its fits. The rows are stored in the order of the train / test split: the training
+# rows as train_test_split shuffles them, then the held out rows. The train and test sets are slices of the memory map, and so are
+# the validation rows of the cross-validation folds, which cut the (already shuffled) training rows into consecutive blocks.
+# The files are named after a digest of the artifact and of the split, a rewritten artifact or another split gets new files.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold, train_test_split
+
+from .artifacts import artifact_path, read_artifact
+
+TARGET = 'market_value_capped'
+# Next to the artifacts, one directory per artifact and split
+TRAINING_DATA_DIR = 'training_data'
+HASH_BLOCK_BYTES = 16 << 20
+
+
+def _digest(path, params):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class TrainingData:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as file:
+            meta = json.load(file)
+        self.fingerprint = meta['fingerprint']
+        self.features = meta['features']
+        self.target = meta['target']
+        self.n_train = meta['n_train']
+        self.n_splits = meta['n_splits']
+        self._index_name = meta['index']
+        self._index = None
+        self.X = np.load(os.path.join(path, 'X.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+        # First validation row of every fold, followed by n_train
+        self.bounds = np.load(os.path.join(path, 'bounds.npy'))
+
+    def __reduce__(self):
+        # Pickled as its path, a worker process memory-maps the same files instead of receiving a copy of the rows
+        return TrainingData, (self.path,)
+
+    def __len__(self):
+        return len(self.X)
+
+    @property
+    def index(self):
+        # Keys of the rows (parcel_number), in the stored order. Only loaded when asked for.
+        if self._index is None:
+            keys = pd.read_parquet(os.path.join(self.path, 'index.parquet'))['key']
+            self._index = pd.Index(keys.to_numpy(), name=self._index_name)
+        return self._index
+
+    @property
+    def X_train(self):
+        return self.X[:self.n_train]
+
+    @property
+    def X_test(self):
+        return self.X[self.n_train:]
+
+    @property
+    def y_train(self):
+        return self.y[:self.n_train]
+
+    @property
+    def y_test(self):
+        return self.y[self.n_train:]
+
+    @property
+    def train_index(self):
+        return self.index[:self.n_train]
+
+    @property
+    def test_index(self):
+        return self.index[self.n_train:]
+
+    def split(self):
+        # Same order as train_test_split(X, y, ...) of the artifact returns
+        return self.X_train, self.X_test, self.y_train, self.y_test
+
+    def fold(self, fold):
+        # (X_fit, y_fit, X_valid, y_valid) of a cross-validation fold. The validation rows are a slice, only the rows the model is
+        # fitted on are gathered from the two blocks around it.
+        start, end = self.bounds[fold], self.bounds[fold + 1]
+        return (
+            np.concatenate([self.X[:start], self.X[end:self.n_train]]),
+            np.concatenate([self.y[:start], self.y[end:self.n_train]]),
+            self.X[start:end],
+            self.y[start:end],
+        )
+
+    def positions(self, features):
+        positions = {feature: position for position, feature in enumerate(self.features)}
+        missing = [feature for feature in features if feature not in positions]
+        if missing:
+            raise KeyError(f"Features {missing} are not in the training data")
+        return [positions[feature] for feature in features]
+
+    def frame(self, rows=slice(None)):
+        # A DataFrame over the rows (a slice keeps it a view of the memory map), for code that needs the feature names or keys
+        return pd.DataFrame(self.X[rows], columns=self.features, index=self.index[rows], copy=False)
+
+
+def _write(df, path, fingerprint, target, test_size, random_state, n_splits):
+    features = [col for col in df.columns if col != target]
+    train, test = train_test_split(np.arange(len(df)), test_size=test_size, random_state=random_state)
+    order = np.concatenate([train, test])
+    # Consecutive blocks of the shuffled training rows, sized like KFold's folds
+    bounds = np.cumsum([0] + [len(valid) for _, valid in KFold(n_splits).split(train)])
+
+    work_dir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        # Filled column by column, only one float64 column at a time is held besides the matrix
+        X = np.lib.format.open_memmap(os.path.join(work_dir, 'X.npy'), mode='w+', dtype=np.float32, shape=(len(df), len(features)))
+        for position, col in enumerate(features):
+            X[:, position] = df[col].to_numpy()[order]
+        X.flush()
+        del X
+        np.save(os.path.join(work_dir, 'y.npy'), df[target].to_numpy(dtype=np.float64)[order])
+        np.save(os.path.join(work_dir, 'bounds.npy'), bounds)
+        pd.DataFrame({'key': df.index.to_numpy()[order]}).to_parquet(os.path.join(work_dir, 'index.parquet'))
+        with open(os.path.join(work_dir, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump({
+                'fingerprint': fingerprint, 'features': features, 'target': target, 'index': df.index.name,
+                'n_train': len(train), 'n_splits': n_splits, 'test_size': test_size, 'random_state': random_state,
+            }, file, indent=2)
+        try:
+            os.replace(work_dir, path)
+        except OSError:
+            # Another process wrote the same data in the meantime, its files are identical
+            if not os.path.exists(path):
+                raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def load_training_data(name, target=TARGET, test_size=0.2, random_state=42, n_splits=5, directory=None):
+    # TrainingData of a feature set artifact (high_correlations, pca_10component), written on the first call for the artifact
+    source = artifact_path(name, directory)
+    params = {'target': target, 'test_size': test_size, 'random_state': random_state, 'n_splits': n_splits}
+    fingerprint = _digest(source, params)
+    root = os.path.join(os.path.dirname(source), TRAINING_DATA_DIR)
+    path = os.path.join(root, f'{name}-{fingerprint}')
+    if not os.path.exists(path):
+        os.makedirs(root, exist_ok=True)
+        _write(read_artifact(name, directory=directory), path, fingerprint, **params)
+        # Only the latest artifact (and split) is kept
+        for entry in os.listdir(root):
+            if entry.startswith(f'{name}-') and entry != os.path.basename(path):
+                shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    return TrainingData(path)
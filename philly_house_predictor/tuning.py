@@ -0,0 +1,274 @@
+# Hyperparameter tuning with successive halving / Hyperband.
+# Configurations sampled from a search space are scored by k-fold cross-validated RMSE while their number of trees grows rung by rung:
+# only the best 1/eta of every rung get eta times more trees, and Hyperband runs several such brackets that trade the number of
+# configurations against the trees they start with. Forests and boosting models are warm-started from the model of the previous rung
+# (stored next to the fold data) instead of being refitted from scratch.
+# The training matrix is written once as float32 .npy files with its rows ordered by fold and every worker of the process pool
+# memory-maps them, so the folds are shared through the page cache instead of being pickled to every worker. A TrainingData (see
+# philly_house_predictor/training_data.py) already is such a file, its folds are used as they are. Every evaluation is appended to
+# a JSON lines history, and evaluations already in it are reused, so an interrupted search resumes where it stopped.
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
+import numpy as np
+from sklearn.metrics import root_mean_squared_error
+from sklearn.model_selection import KFold, ParameterSampler
+
+from .training_data import TrainingData
+
+STRATEGIES = ('halving', 'hyperband')
+
+# Parameters sampled for every estimator, the number of trees is the budget that successive halving grows
+SEARCH_SPACES = {
+    'RandomForest': {
+        'max_features': [1.0, 0.7, 0.5, 0.33, 'sqrt'],
+        'min_samples_leaf': [1, 2, 5, 10, 20],
+        'max_depth': [None, 12, 20, 30],
+    },
+    'GradientBoosting': {
+        'learning_rate': [0.03, 0.05, 0.1, 0.2],
+        'max_depth': [2, 3, 4, 5, 6],
+        'subsample': [0.7, 0.85, 1.0],
+        'min_samples_leaf': [1, 5, 20],
+    },
+    'XGBoost': {
+        'learning_rate': [0.03, 0.05, 0.1, 0.2, 0.3],
+        'max_depth': [3, 4, 6, 8, 10],
+        'subsample': [0.7, 0.85, 1.0],
+        'colsample_bytree': [0.6, 0.8, 1.0],
+        'min_child_weight': [1, 5, 10],
+        'reg_lambda': [0.1, 1.0, 10.0],
+    },
+}
+
+# Fold data and warm-start models of the current process, set once per worker by _init_worker
+_worker_state = {}
+
+
+def make_estimator(name, params, random_state=42, n_jobs=None):
+    if name == 'RandomForest':
+        from sklearn.ensemble import RandomForestRegressor
+        return RandomForestRegressor(random_state=random_state, n_jobs=n_jobs, **params)
+    if name == 'GradientBoosting':
+        from sklearn.ensemble import GradientBoostingRegressor
+        return GradientBoostingRegressor(random_state=random_state, **params)
+    if name == 'XGBoost':
+        # Imported lazily so the sklearn models can be tuned without xgboost installed
+        import xgboost
+        return xgboost.XGBRegressor(random_state=random_state, n_jobs=n_jobs, **params)
+    raise ValueError(f"Unknown estimator '{name}', expected one of {list(SEARCH_SPACES)}")
+
+
+def _grow(model, grown, n_estimators, X, y):
+    # Adds trees to a model fitted with `grown` of them (0 for a new model) until it has n_estimators
+    if hasattr(model, 'get_booster'):
+        # XGBoost continues boosting from the booster of the previous rung
+        booster = model.get_booster() if grown else None
+        model.set_params(n_estimators=n_estimators - grown)
+        return model.fit(X, y, xgb_model=booster, verbose=False)
+    return model.set_params(n_estimators=n_estimators, warm_start=True).fit(X, y)
+
+
+def _init_worker(data_dir, models_dir):
+    _worker_state.update(
+        X=np.load(os.path.join(data_dir, 'X.npy'), mmap_mode='r'),
+        y=np.load(os.path.join(data_dir, 'y.npy'), mmap_mode='r'),
+        bounds=np.load(os.path.join(data_dir, 'bounds.npy')),
+        models_dir=models_dir,
+    )
+
+
+def _evaluate(name, params, fold, n_estimators, model_key, random_state):
+    # Fits (or warm-starts) the configuration on every fold but one, scores it on that fold and stores the model for the next rung
+    state = _worker_state
+    start, end, rows = state['bounds'][fold], state['bounds'][fold + 1], state['bounds'][-1]
+    # Rows are ordered by fold, the held out fold is a zero copy slice of the memory map (the rows of a TrainingData after the
+    # last fold are its test set)
+    X_train = np.concatenate([state['X'][:start], state['X'][end:rows]])
+    y_train = np.concatenate([state['y'][:start], state['y'][end:rows]])
+
+    path = os.path.join(state['models_dir'], f'{model_key}_{fold}.joblib')
+    model, grown = joblib.load(path) if os.path.exists(path) else (None, 0)
+    if model is None or grown > n_estimators:
+        model, grown = make_estimator(name, params, random_state, n_jobs=1), 0
+    fit_start = time.perf_counter()
+    model = _grow(model, grown, n_estimators, X_train, y_train)
+    fit_seconds = time.perf_counter() - fit_start
+    joblib.dump((model, n_estimators), path)
+
+    return {
+        'rmse': float(root_mean_squared_error(state['y'][start:end], model.predict(state['X'][start:end]))),
+        'fit_seconds': fit_seconds,
+        'warm_started_from': grown,
+    }
+
+
+def _config_key(params):
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+class HyperparameterSearch:
+    def __init__(self, estimator='RandomForest', space=None, strategy='hyperband', n_splits=5, min_estimators=25,
+                 max_estimators=400, eta=3, n_candidates=27, n_jobs=None, random_state=42,
+                 history_path='tuning_history.jsonl', work_dir=None, refit=True, keep_models=False):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy '{strategy}', expected one of {STRATEGIES}")
+        self.estimator = estimator
+        self.space = space
+        self.strategy = strategy
+        self.n_splits = n_splits
+        # Trees of the first rung of the most aggressive bracket and of the last rung of every bracket
+        self.min_estimators = min_estimators
+        self.max_estimators = max_estimators
+        self.eta = eta
+        # Configurations of the single bracket of strategy='halving'
+        self.n_candidates = n_candidates
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.history_path = history_path
+        # Fold data and warm-start models, next to the history file by default
+        self.work_dir = work_dir
+        self.refit = refit
+        # The warm-start models are deleted once the search is complete unless this is set
+        self.keep_models = keep_models
+
+    def _load_history(self):
+        done = {}
+        if os.path.exists(self.history_path):
+            with open(self.history_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a search that was killed while writing it
+                        continue
+                    done[(record['data'], record['estimator'], _config_key(record['params']), record['fold'], record['n_estimators'])] = record
+        return done
+
+    def _work_dir(self):
+        return self.work_dir or f'{os.path.splitext(self.history_path)[0]}_work'
+
+    def _write_folds(self, X, y):
+        # Rows grouped by fold into float32 .npy files, named after a fingerprint of the data so a resumed search finds them again
+        X = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+        y = np.ascontiguousarray(np.asarray(y, dtype=np.float32))
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (X, y):
+            digest.update(str(array.shape).encode())
+            digest.update(array.data)
+        digest.update(f'{self.n_splits}-{self.random_state}'.encode())
+        fingerprint = digest.hexdigest()
+
+        data_dir = os.path.join(self._work_dir(), fingerprint)
+        os.makedirs(data_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(data_dir, 'bounds.npy')):
+            folds = [test for _, test in KFold(self.n_splits, shuffle=True, random_state=self.random_state).split(X)]
+            order = np.concatenate(folds)
+            np.save(os.path.join(data_dir, 'X.npy'), X[order])
+            np.save(os.path.join(data_dir, 'y.npy'), y[order])
+            # Written last, it marks the fold data as complete
+            np.save(os.path.join(data_dir, 'bounds.npy'), np.cumsum([0] + [len(test) for test in folds]))
+        return fingerprint, data_dir
+
+    def _brackets(self):
+        # (configurations, trees of the first rung) of every bracket, most aggressive first
+        s_max = max(0, int(math.floor(math.log(self.max_estimators / self.min_estimators, self.eta) + 1e-9)))
+        if self.strategy == 'halving':
+            return [(self.n_candidates, s_max)]
+        return [(int(math.ceil((s_max + 1) / (s + 1) * self.eta ** s)), s) for s in range(s_max, -1, -1)]
+
+    def search(self, X, y=None):
+        # X is the training matrix (or DataFrame) and y the target, or X is a TrainingData whose training rows and folds are searched
+        # (and y is not used). Returns the configurations scored with max_estimators trees, ordered by their mean cross-validated RMSE
+        space = SEARCH_SPACES[self.estimator] if self.space is None else self.space
+        if isinstance(X, TrainingData):
+            if X.n_splits != self.n_splits:
+                raise ValueError(f"The training data has {X.n_splits} folds, the search expects {self.n_splits}")
+            self.fingerprint_, data_dir = X.fingerprint, X.path
+            X, y = X.X_train, X.y_train
+        else:
+            self.fingerprint_, data_dir = self._write_folds(X, y)
+        models_dir = os.path.join(self._work_dir(), self.fingerprint_, 'models')
+        os.makedirs(models_dir, exist_ok=True)
+        self.history_ = []
+        self._done = self._load_history()
+
+        if self.n_jobs == 1:
+            _init_worker(data_dir, models_dir)
+            self._executor = None
+            finished = self._run(space)
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(data_dir, models_dir)) as executor:
+                self._executor = executor
+                finished = self._run(space)
+        self._executor = None
+        if not self.keep_models:
+            shutil.rmtree(models_dir, ignore_errors=True)
+
+        self.results_ = sorted(finished.values(), key=lambda result: result['rmse'])
+        best = self.results_[0]
+        self.best_params_ = {**best['params'], 'n_estimators': best['n_estimators']}
+        self.best_score_ = best['rmse']
+        if self.refit:
+            self.best_estimator_ = make_estimator(self.estimator, self.best_params_, self.random_state).fit(X, y)
+        return self.results_
+
+    def _run(self, space):
+        finished = {}
+        for bracket, (n_configs, s) in enumerate(self._brackets()):
+            configs = list(ParameterSampler(space, n_configs, random_state=self.random_state + bracket))
+            configs = list({_config_key(params): params for params in configs}.values())
+            for rung in range(s + 1):
+                n_estimators = int(round(self.max_estimators * self.eta ** (rung - s)))
+                results = self._evaluate_all(configs, n_estimators, bracket, rung)
+                if rung == s:
+                    finished.update({_config_key(result['params']): result for result in results})
+                    break
+                # Keep the best 1/eta of the configurations for the next rung
+                order = np.argsort([result['rmse'] for result in results], kind='stable')
+                configs = [configs[position] for position in order[:max(1, len(configs) // self.eta)]]
+        return finished
+
+    def _evaluate_all(self, configs, n_estimators, bracket, rung):
+        # Every configuration on every fold with n_estimators trees, reusing the evaluations found in the history file.
+        # Returns the mean / standard deviation of the fold RMSEs of every configuration, in order.
+        keys = [(self.fingerprint_, self.estimator, _config_key(params), fold, n_estimators)
+                for params in configs for fold in range(self.n_splits)]
+        records = {key: self._done[key] for key in keys if key in self._done}
+        pending = [key for key in keys if key not in records]
+        params_of = {_config_key(params): params for params in configs}
+
+        def task(key):
+            model_key = hashlib.blake2b(key[2].encode(), digest_size=8).hexdigest()
+            return self.estimator, params_of[key[2]], key[3], n_estimators, model_key, self.random_state
+
+        with open(self.history_path, 'a', encoding='utf-8') as file:
+            def finish(key, scores):
+                record = {'data': key[0], 'estimator': key[1], 'params': params_of[key[2]], 'fold': key[3], 'n_estimators': key[4],
+                          'strategy': self.strategy, 'bracket': bracket, 'rung': rung, **scores}
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                self._done[key] = records[key] = record
+
+            if self._executor is None:
+                for key in pending:
+                    finish(key, _evaluate(*task(key)))
+            else:
+                futures = {self._executor.submit(_evaluate, *task(key)): key for key in pending}
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
+
+        self.history_ += [records[key] for key in keys]
+        results = []
+        for params in configs:
+            scores = [records[(self.fingerprint_, self.estimator, _config_key(params), fold, n_estimators)]['rmse']
+                      for fold in range(self.n_splits)]
+            results.append({'params': params, 'n_estimators': n_estimators, 'rmse': float(np.mean(scores)),
+                            'rmse_std': float(np.std(scores)), 'bracket': bracket, 'rung': rung})
+        return results
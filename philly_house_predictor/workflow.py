@@ -0,0 +1,347 @@
+# The preprocessing / feature selection / model development stages as functions, for the command line interface
+# (philly_house_predictor/cli.py), a scheduler or another process to call. data_preprocessing/preprocessing.py and
+# feature_selection/feature_selection.py call preprocess / select_features as well, so the scripts and the CLI run the same code and
+# hand off through the same artifacts. Nothing heavy is imported with this module: every stage imports pandas / scikit-learn / xgboost when it runs, and only
+# the model it was asked for.
+import os
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The OPA dump data_preprocessing/preprocessing.py reads
+DEFAULT_INPUT = os.path.join(REPOSITORY_DIR, 'data_preprocessing', 'original_dataset.csv')
+BUNDLE_NAME = 'market_value_model'
+# Sales up to the end of December 2023 are kept, as some of the newer properties haven't even been fully constructed
+TRAIN_SALE_WINDOW = (None, 2023)
+COLUMNS_TO_SCALE = [
+    'fireplaces', 'number_of_bathrooms', 'number_of_bedrooms', 'number_stories',
+    'basements_encoded', 'exterior_encoded', 'interior_encoded',
+    'type_heater_encoded', 'homestead_exemption_encoded',
+    'depth_capped', 'frontage_capped', 'garage_spaces_capped',
+    'total_area_capped', 'total_livable_area_capped',
+    'taxable_building_capped', 'taxable_land_capped',
+    'exempt_building_capped',
+]
+TARGET = 'market_value_capped'
+FEATURE_SETS = ('high_correlations', 'pca_10component')
+ESTIMATORS = ('LinearRegression', 'DecisionTree', 'RandomForest', 'GradientBoosting', 'XGBoost')
+
+
+def _load_and_preprocess(input_path, streaming, engine):
+    from .column_profile import profile_csv
+    from .incremental import snapshot_hashes
+    from .ingest import KEY_COLUMN, load_single_family_homes_streaming
+    from .sale_dates import add_sale_year
+    from .stages import build_preprocessing_pipeline
+
+    # Null counts, distinct counts and quantiles of every column of the raw file, computed in one streaming pass and cached next to
+    # the file (see philly_house_predictor/column_profile.py). The missing value / cardinality stages use them instead of scanning
+    # the columns again.
+    pipeline = build_preprocessing_pipeline(engine=engine)
+    profile = profile_csv(input_path)
+    if streaming and engine == 'pandas':
+        # The known high missing / high cardinality columns and non single-family homes are already removed while streaming,
+        # the column stages are still applied in case a new data drop contains additional offending columns
+        df = pipeline.run(load_single_family_homes_streaming(input_path, key=KEY_COLUMN), profile=profile)
+    else:
+        df = pipeline.run(input_path, profile=profile, key=KEY_COLUMN)
+    # The records keep their parcel_number as index, the dropped columns and a hash of every row of the snapshot are kept for
+    # incremental refreshes (see philly_house_predictor/incremental.py)
+    return {
+        'df_sale_years': add_sale_year(df),
+        'dropped_columns': pipeline.dropped_columns,
+        'snapshot_rows': snapshot_hashes(input_path),
+        'profile_summary': profile.summary(),
+        'pipeline_report': pipeline.report(),
+    }
+
+
+def preprocess(input_path=DEFAULT_INPUT, train_sale_window=TRAIN_SALE_WINDOW, streaming=True, engine='pandas',
+               out_of_core=False, n_jobs=1, holdout_sale_window=None, report_name='preprocess'):
+    # Raw OPA csv -> the filtered and scaled artifacts, the fitted encoder / winsorize caps / scaler and the state an incremental
+    # refresh needs. With n_jobs other than 1 (None for every core) the rows are processed in shards by a process pool instead,
+    # see philly_house_predictor/parallel_preprocessing.py. The preprocessed records of holdout_sale_window (inclusive years) are
+    # returned as 'holdout'. report_name names the run report (see philly_house_predictor/instrumentation.py).
+    from dataclasses import asdict
+
+    from . import column_profile, incremental, ingest, pipeline, sale_dates, stages
+    from .artifacts import write_artifact, write_object
+    from .drift import DRIFT_OBJECT, DriftMonitor
+    from .encoding import FeatureEncoder
+    from .incremental import SNAPSHOT_ARTIFACT, STATE_OBJECT
+    from .ingest import COORDINATE_COLUMNS, KEY_COLUMN
+    from .instrumentation import RunInstrumentation
+    from .out_of_core import ColumnScaler, partial_fit_artifact, transform_artifact
+    from .outliers import WinsorizeIQRFilter
+    from .partitioned import KEYS_ARTIFACT, parcel_keys
+    from .sale_dates import select_sale_window
+    from .stage_cache import StageCache
+
+    run = RunInstrumentation(report_name)
+    if n_jobs != 1:
+        from .parallel_preprocessing import preprocess_parallel
+        if holdout_sale_window is not None:
+            raise ValueError("holdout_sale_window is only supported with n_jobs=1")
+        summary = preprocess_parallel(input_path, COLUMNS_TO_SCALE, train_sale_window, n_jobs=n_jobs, run=run)
+        run.write()
+        return {**summary, 'stages': run.stages}
+
+    # Skipped entirely when the raw file, the code of the stages and their parameters (valid category lists, thresholds, ...)
+    # are unchanged since a previous run, see philly_house_predictor/stage_cache.py
+    stage_cache = StageCache()
+    run.begin('preprocess')
+    outputs = stage_cache.get_or_compute(
+        'preprocess',
+        lambda: _load_and_preprocess(input_path, streaming, engine),
+        inputs=[input_path],
+        sources=[_load_and_preprocess, column_profile, incremental, ingest, pipeline, stages, sale_dates],
+        params={
+            'streaming_ingest': streaming,
+            'engine': engine,
+            'stages': [asdict(stage) for stage in stages.build_preprocessing_pipeline(engine=engine).stages],
+        },
+    )
+    df_sale_years = outputs['df_sale_years']
+    run.end(rows_in=len(outputs['snapshot_rows']), rows_out=len(df_sale_years), cached=stage_cache.hits['preprocess'])
+
+    # The sale year is dropped afterwards as we want to avoid recency bias
+    run.begin('sale_window', rows_in=len(df_sale_years))
+    df = select_sale_window(df_sale_years, *train_sale_window)
+    holdout = select_sale_window(df_sale_years, *holdout_sale_window) if holdout_sale_window is not None else None
+    # Everything an incremental refresh needs to process a new snapshot the same way as this run
+    write_object({
+        'key': KEY_COLUMN,
+        'dropped_columns': list(outputs['dropped_columns']),
+        'train_sale_window': tuple(train_sale_window),
+    }, STATE_OBJECT)
+    write_artifact(outputs['snapshot_rows'], SNAPSHOT_ARTIFACT)
+    # Zip code, census tract and ward of every parcel as plain keys, the encoder turns them into binary encoded bits. Models can be
+    # partitioned by them (see philly_house_predictor/partitioned.py). The coordinates are stored with them for the comparable
+    # sales index (see philly_house_predictor/comparables.py) and are not features.
+    write_artifact(parcel_keys(df), KEYS_ARTIFACT)
+    df = df.drop(columns=COORDINATE_COLUMNS, errors='ignore')
+    run.end(rows_out=len(df))
+
+    # Quantile sketches and category frequency tables of the raw single family records, plus the share of them the valid category
+    # lists of the stages filter out. New snapshots and scoring batches are compared against them, see philly_house_predictor/drift.py
+    run.begin('drift_reference', rows_in=len(outputs['snapshot_rows']))
+    monitor = DriftMonitor(exclude=outputs['dropped_columns']).fit(input_path)
+    write_object(monitor, DRIFT_OBJECT)
+    run.end(rows_out=monitor.rows_)
+
+    # One fitted encoder for the ordinal, one hot, homestead exemption and binary encodings, persisted so new parcels can be scored
+    # without refitting on the whole dataset (see philly_house_predictor/encoding.py)
+    run.begin('encode', rows_in=len(df))
+    encoder = FeatureEncoder().fit(df)
+    write_object(encoder, 'feature_encoder')
+    df = encoder.to_frame(df)
+    run.end(rows_out=len(df))
+
+    # Winsorizes the outliers (capping them to the percentiles of philly_house_predictor/outliers.py), then removes the rows outside
+    # of the IQR of the capped values. The caps are persisted to be applied to new data at scoring time.
+    run.begin('outliers', rows_in=len(df))
+    outlier_filter = WinsorizeIQRFilter().fit(df)
+    write_object(outlier_filter, 'outlier_filter')
+    df = outlier_filter.filter(df)
+    write_artifact(df, 'filtered')
+    run.end(rows_out=len(df))
+
+    # Scaled columns come first followed by the other columns. With out_of_core the scaler is fitted and applied one batch of the
+    # filtered artifact at a time, the scaled dataset is never resident in memory (see philly_house_predictor/out_of_core.py).
+    run.begin('scale', rows_in=len(df))
+    scaler = ColumnScaler(COLUMNS_TO_SCALE)
+    if out_of_core:
+        partial_fit_artifact(scaler, 'filtered')
+        transform_artifact(scaler.to_frame, 'filtered', 'scaled')
+    else:
+        write_artifact(scaler.fit(df).to_frame(df), 'scaled')
+    write_object(scaler, 'scaler')
+    run.end(rows_out=len(df), out_of_core=out_of_core)
+    run.write()
+    summary = {
+        'rows': len(df),
+        'dropped_columns': list(outputs['dropped_columns']),
+        'profile_summary': outputs.get('profile_summary'),
+        'pipeline_report': outputs.get('pipeline_report'),
+        'stages': run.stages,
+    }
+    if holdout is not None:
+        summary['holdout'] = holdout
+    return summary
+
+
+def select_features(top_k=10, redundancy_above=None, n_components=10, out_of_core=False, report_name='select_features'):
+    # Scaled artifact -> the high_correlations (top k features) and pca_10component artifacts. The correlations of every feature
+    # with the target and with each other are computed in one streaming pass (see philly_house_predictor/feature_ranking.py), and
+    # the ranking and the PCA are cached until the scaled artifact changes. With out_of_core an IncrementalPCA is fitted and
+    # applied batch by batch over the scaled artifact instead of the exact PCA on the loaded frame.
+    import pandas as pd
+
+    from . import feature_ranking
+    from . import out_of_core as out_of_core_module
+    from .artifacts import artifact_columns, artifact_path, read_artifact, read_manifest, write_artifact, write_object
+    from .instrumentation import RunInstrumentation
+    from .out_of_core import partial_fit_artifact, transform_artifact
+    from .stage_cache import StageCache
+
+    run = RunInstrumentation(report_name)
+    stage_cache = StageCache()
+    scaled_rows = read_manifest()['scaled']['rows']
+
+    run.begin('feature_ranking', rows_in=scaled_rows)
+    ranking = stage_cache.get_or_compute(
+        'feature_ranking',
+        lambda: feature_ranking.rank_features('scaled', TARGET, k=top_k, redundancy_above=redundancy_above),
+        inputs=[artifact_path('scaled')],
+        sources=[feature_ranking],
+        params={'k': top_k, 'redundancy_above': redundancy_above},
+    )
+    correlations = ranking['matrix'][TARGET]
+    write_artifact(correlations.rename_axis('feature').reset_index(name='correlation'), 'all_corrs')
+    run.end(rows_out=scaled_rows, cached=stage_cache.hits['feature_ranking'])
+
+    run.begin('select_features', rows_in=scaled_rows)
+    write_artifact(read_artifact('scaled', columns=ranking['selected'] + [TARGET]), 'high_correlations')
+    run.end(rows_out=scaled_rows)
+
+    run.begin('pca', rows_in=scaled_rows)
+    feature_columns = [col for col in artifact_columns('scaled') if col != TARGET]
+    pca_columns = [f'PCA_{component + 1}' for component in range(n_components)]
+    df = None if out_of_core else read_artifact('scaled')
+
+    def fit_pca():
+        if out_of_core:
+            from sklearn.decomposition import IncrementalPCA
+            # Fitted one batch at a time, the components are projected batch by batch when the artifact is written below
+            return {'pca': partial_fit_artifact(IncrementalPCA(n_components=n_components), 'scaled', columns=feature_columns,
+                                                min_batch_rows=n_components)}
+        from sklearn.decomposition import PCA
+        # The exact solver, the randomized one would give different components for the same inputs after every cache eviction
+        pca = PCA(n_components=n_components, svd_solver='full')
+        return {'pca': pca, 'components': pca.fit_transform(df[feature_columns])}
+
+    # out_of_core.py holds the batched fit, a change to it refits the cached IncrementalPCA
+    pca_outputs = stage_cache.get_or_compute('pca', fit_pca, inputs=[artifact_path('scaled')],
+                                             sources=[fit_pca, out_of_core_module],
+                                             params={'out_of_core': out_of_core, 'n_components': n_components})
+    pca = pca_outputs['pca']
+    if out_of_core:
+        def project(frame):
+            return pd.DataFrame(pca.transform(frame[feature_columns]), columns=pca_columns, index=frame.index).join(frame[TARGET])
+
+        transform_artifact(project, 'scaled', 'pca_10component')
+    else:
+        components = pd.DataFrame(pca_outputs['components'], columns=pca_columns, index=df.index)
+        write_artifact(components.join(df[TARGET]), 'pca_10component')
+    # An incremental refresh projects the new rows with it
+    write_object(pca, 'pca')
+    run.end(rows_out=scaled_rows, cached=stage_cache.hits['pca'])
+    run.write()
+    return {
+        'selected': ranking['selected'],
+        'explained_variance_ratio': [float(ratio) for ratio in pca.explained_variance_ratio_],
+        'correlations': correlations,
+        'stages': run.stages,
+    }
+
+
+def make_model(name, params=None, random_state=42, n_jobs=None):
+    # Only the library of the requested model is imported
+    params = params or {}
+    if name == 'LinearRegression':
+        from sklearn.linear_model import LinearRegression
+        return LinearRegression(**params)
+    if name == 'DecisionTree':
+        from sklearn.tree import DecisionTreeRegressor
+        return DecisionTreeRegressor(random_state=random_state, **params)
+    from .tuning import make_estimator
+    return make_estimator(name, params, random_state, n_jobs)
+
+
+def _training_data(feature_set, test_size, random_state):
+    # The float32 matrix of the feature set with its split, memory-mapped (see philly_house_predictor/training_data.py)
+    from .training_data import load_training_data
+
+    if feature_set not in FEATURE_SETS:
+        raise ValueError(f"Unknown feature set '{feature_set}', expected one of {FEATURE_SETS}")
+    return load_training_data(feature_set, TARGET, test_size=test_size, random_state=random_state)
+
+
+def _default_name(feature_set):
+    # Only models of the encoded features can be bundled with the transforms and score raw records
+    return BUNDLE_NAME if feature_set == 'high_correlations' else f'{feature_set}_model'
+
+
+def train(estimator='RandomForest', feature_set='high_correlations', params=None, test_size=0.2, random_state=42, n_jobs=None,
+          name=None, export=False):
+    # Fits the model on the training split of a feature set artifact. Models of the high_correlations features are stored as a
+    # ModelBundle (see philly_house_predictor/model_bundle.py) that predict / serve score raw records with, the PCA models as they are.
+    # The split is stored next to the model as {name}_training, evaluate scores the model on the rows it held out.
+    from .artifacts import write_object
+    from .instrumentation import RunInstrumentation
+
+    name = name or _default_name(feature_set)
+    run = RunInstrumentation('train')
+    run.begin('load')
+    data = _training_data(feature_set, test_size, random_state)
+    run.end(rows_out=data.n_train)
+
+    run.begin(estimator, rows_in=data.n_train)
+    model = make_model(estimator, params, random_state, n_jobs).fit(data.X_train, data.y_train)
+    run.end()
+
+    run.begin('persist')
+    if feature_set == 'high_correlations':
+        from .model_bundle import ModelBundle
+        write_object(ModelBundle.from_artifacts(model, data.features), name)
+    else:
+        write_object(model, name)
+    write_object({
+        'estimator': estimator, 'params': params or {}, 'feature_set': feature_set, 'features': data.features,
+        'test_size': test_size, 'random_state': random_state,
+    }, f'{name}_training')
+    if export:
+        from .model_export import export_model
+        export_model(model, f'{name}_compact', data.features)
+    run.end()
+    run.write()
+    return {'name': name, 'train_rows': data.n_train, 'stages': run.stages}
+
+
+def evaluate(name=BUNDLE_NAME, compact=False):
+    # R^2 and RMSE of a model stored by train on the rows it held out. compact scores its NumPy export instead.
+    import warnings
+
+    from sklearn.metrics import r2_score, root_mean_squared_error
+
+    from .artifacts import read_object
+    from .instrumentation import RunInstrumentation
+
+    training = read_object(f'{name}_training')
+    run = RunInstrumentation('evaluate')
+    run.begin('load')
+    data = _training_data(training['feature_set'], training['test_size'], training['random_state'])
+    X_test, y_test = data.X_test, data.y_test
+    if compact:
+        from .model_export import load_exported
+        model = load_exported(f'{name}_compact')
+        features = model.features or training['features']
+    else:
+        model = read_object(name)
+        # A bundle scores raw records, its model takes the features
+        model = getattr(model, 'model', model)
+        features = training['features']
+    if features != data.features:
+        X_test = X_test[:, data.positions(features)]
+    run.end(rows_out=len(X_test))
+
+    run.begin('predict', rows_in=len(X_test))
+    with warnings.catch_warnings():
+        # Models trained on a DataFrame before the training data was shared warn about the array without feature names
+        warnings.simplefilter('ignore', UserWarning)
+        predictions = model.predict(X_test)
+    run.end(rows_out=len(predictions))
+    run.write()
+    return {
+        'name': name, 'estimator': training['estimator'], 'feature_set': training['feature_set'], 'compact': compact,
+        'test_rows': len(y_test), 'r2': float(r2_score(y_test, predictions)),
+        'rmse': float(root_mean_squared_error(y_test, predictions)),
+    }
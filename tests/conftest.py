@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Allow importing the shared philly_house_predictor package from the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,174 @@
+# The data parallel preprocessing (philly_house_predictor/parallel_preprocessing.py) has to write the same artifacts as a serial
+# run, and the statistics it reduces across shards (column profile blocks, scaler moments, drift sketches) have to match the ones
+# of a single pass. Runs on a small synthetic OPA snapshot with the columns the stages look at.
+import numpy as np
+import pandas as pd
+import pytest
+
+from philly_house_predictor import artifacts, column_profile, instrumentation, stage_cache
+from philly_house_predictor.column_profile import profile_csv
+from philly_house_predictor.drift import DriftMonitor, drifted_columns
+from philly_house_predictor.incremental import _read_text
+from philly_house_predictor.ingest import KEY_COLUMN
+from philly_house_predictor.out_of_core import ColumnScaler
+from philly_house_predictor.partitioned import KEYS_ARTIFACT
+from philly_house_predictor.workflow import preprocess
+
+ROWS = 4000
+COMPARED_ARTIFACTS = ('filtered', 'scaled', KEYS_ARTIFACT)
+
+
+def _snapshot(rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def choice(values, missing=0.0):
+        column = rng.choice(np.array(values, dtype=object), rows)
+        column[rng.random(rows) < missing] = None
+        return column
+
+    livable_area = np.round(rng.lognormal(7, 0.4, rows), -1)
+    return pd.DataFrame({
+        KEY_COLUMN: [f'{i:09d}' for i in range(rows)],
+        # Dropped by the missing values / cardinality rules
+        'unit': choice(['A', 'B'], 0.9),
+        'objectid': np.arange(rows),
+        'lat': 39.95 + rng.normal(0, 0.05, rows),
+        'lng': -75.16 + rng.normal(0, 0.05, rows),
+        'basements': choice(['0', 'A', 'B', 'C', 'D', '1'], 0.1),
+        'building_code_description': choice(['ROW 2 STY MASONRY', 'VACANT LAND', 'TWIN'], 0.01),
+        'category_code_description': choice(['SINGLE FAMILY', 'SINGLE FAMILY', 'COMMERCIAL']),
+        'census_tract': rng.integers(1, 200, rows).astype(float),
+        'depth': np.round(rng.lognormal(4, 0.5, rows)),
+        'exempt_building': rng.choice([0, 0, 0, 50000], rows).astype(float),
+        'exterior_condition': rng.integers(1, 8, rows).astype(float),
+        'fireplaces': rng.integers(0, 2, rows).astype(float),
+        'frontage': np.round(rng.lognormal(3, 0.3, rows)),
+        'garage_spaces': rng.integers(0, 3, rows).astype(float),
+        'geographic_ward': rng.integers(1, 66, rows).astype(float),
+        'homestead_exemption': rng.choice([0, 80000], rows).astype(float),
+        'interior_condition': rng.integers(0, 9, rows).astype(float),
+        'total_livable_area': livable_area,
+        'total_area': livable_area * 1.3,
+        'taxable_building': livable_area * 100,
+        'taxable_land': livable_area * 20,
+        'market_value': np.round(livable_area * 120 + rng.normal(0, 5000, rows), -3),
+        'number_of_bathrooms': rng.integers(1, 4, rows).astype(float),
+        'number_of_bedrooms': rng.integers(1, 6, rows).astype(float),
+        'number_stories': rng.integers(1, 4, rows).astype(float),
+        'parcel_shape': choice(['A', 'B', 'C', 'D', 'E', 'Z'], 0.01),
+        'sale_date': choice([f'{year}-06-15 00:00:00' for year in range(2000, 2025)]),
+        'sale_price': rng.choice([1, 100000, 250000], rows).astype(float),
+        'street_designation': choice(['ST', 'AVE', 'RD']),
+        'street_name': choice([f'NAME{i}' for i in range(50)]),
+        'topography': choice(['A', 'F', 'E'], 0.2),
+        'type_heater': choice(['A', 'B', 'H', 'Z'], 0.2),
+        'view_type': choice(['I', 'A', '0', 'B'], 0.01),
+        'year_built': choice([str(year) for year in range(1900, 2020, 5)], 0.01),
+        'zip_code': choice(['19147', '19103', '19148', '19146', '191471234'], 0.01),
+        'zoning': choice(['RSA5', 'RM1', 'CMX2'], 0.01),
+    })
+
+
+@pytest.fixture(scope='module')
+def snapshot(tmp_path_factory):
+    path = tmp_path_factory.mktemp('snapshot') / 'opa_properties_public.csv'
+    _snapshot(ROWS).to_csv(path, index=False)
+    return str(path)
+
+
+def _preprocess(snapshot, directory, **options):
+    # Every run writes to its own artifact / cache / report directories, so nothing is reused between them
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(artifacts, 'ARTIFACT_DIR', str(directory / 'artifacts'))
+        patch.setattr(stage_cache, 'CACHE_DIR', str(directory / 'cache'))
+        patch.setattr(instrumentation, 'REPORT_DIR', str(directory / 'reports'))
+        preprocess(snapshot, **options)
+        return {name: artifacts.read_artifact(name) for name in COMPARED_ARTIFACTS}
+
+
+@pytest.fixture(scope='module')
+def parallel_artifacts(snapshot, tmp_path_factory):
+    return _preprocess(snapshot, tmp_path_factory.mktemp('parallel'), n_jobs=3)
+
+
+@pytest.mark.parametrize('options', [
+    {'streaming': True},
+    {'streaming': False},
+    {'engine': 'polars'},
+], ids=['streaming', 'no_streaming', 'polars'])
+def test_parallel_artifacts_match_serial_run(snapshot, parallel_artifacts, tmp_path, options):
+    if options.get('engine') == 'polars':
+        pytest.importorskip('polars')
+    serial_artifacts = _preprocess(snapshot, tmp_path, **options)
+    assert len(serial_artifacts['filtered'])
+    pd.testing.assert_frame_equal(parallel_artifacts['filtered'], serial_artifacts['filtered'])
+    pd.testing.assert_frame_equal(parallel_artifacts[KEYS_ARTIFACT], serial_artifacts[KEYS_ARTIFACT])
+    # The merged scaler moments may differ from the single pass ones in the last bits
+    pd.testing.assert_frame_equal(parallel_artifacts['scaled'], serial_artifacts['scaled'], check_exact=False, rtol=1e-9)
+
+
+def test_merged_profile_blocks_match_single_pass(snapshot, tmp_path, monkeypatch):
+    single = profile_csv(snapshot, sidecar_path=str(tmp_path / 'single.profile.json'))
+    monkeypatch.setattr(column_profile, 'MIN_BLOCK_ROWS', 256)
+    monkeypatch.setattr(column_profile, 'MAX_BLOCK_ROWS', 512)
+    blocks = profile_csv(snapshot, sidecar_path=str(tmp_path / 'blocks.profile.json'))
+    assert len(single.blocks) == 1 and len(blocks.blocks) > 1
+    assert blocks.rows == single.rows == ROWS
+    pd.testing.assert_series_equal(blocks.null_count(), single.null_count())
+    # The registers of the blocks reduce (element wise maximum) to exactly the registers of a single pass
+    pd.testing.assert_series_equal(blocks.distinct_count(), single.distinct_count())
+
+    values = pd.read_csv(snapshot, dtype={KEY_COLUMN: str})
+    probabilities = np.array([0.05, 0.25, 0.5, 0.75, 0.95])
+    for col in blocks.columns:
+        merged = blocks.quantiles(col, probabilities)
+        if single.quantiles(col, probabilities) is None:
+            assert merged is None
+            continue
+        # The weighted merge of the per block percentiles stays within a percentile of the exact quantile
+        column = values[col].dropna().to_numpy(dtype=np.float64)
+        assert np.all(merged >= np.quantile(column, probabilities - 0.01)), col
+        assert np.all(merged <= np.quantile(column, probabilities + 0.01)), col
+
+
+def test_merged_scaler_matches_single_fit():
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({
+        'large': rng.normal(1e6, 1e3, 1000),
+        'small': rng.normal(0, 1e-3, 1000),
+        'constant': np.full(1000, 7.0),
+        'passthrough': rng.random(1000),
+    })
+    columns = ['large', 'small', 'constant']
+    single = ColumnScaler(columns).fit(df)
+    merged = ColumnScaler(columns)
+    for part in np.array_split(np.arange(len(df)), [10, 400, 401, 750]):
+        merged.merge(ColumnScaler(columns).fit(df.iloc[part]))
+
+    assert merged.scaler_.n_samples_seen_ == single.scaler_.n_samples_seen_
+    for attribute in ('mean_', 'var_', 'scale_'):
+        np.testing.assert_allclose(getattr(merged.scaler_, attribute), getattr(single.scaler_, attribute), rtol=1e-9)
+    assert list(merged.get_feature_names_out()) == list(single.get_feature_names_out())
+    np.testing.assert_allclose(merged.transform(df), single.transform(df), rtol=1e-9, atol=1e-9)
+
+
+def test_merged_drift_monitor_matches_single_pass(snapshot):
+    text = _read_text(snapshot, KEY_COLUMN)
+    single = DriftMonitor().fit(text)
+    shards = np.array_split(np.arange(len(text)), 5)
+    merged = DriftMonitor().fit(text.iloc[shards[0]])
+    for shard in shards[1:]:
+        merged.merge(DriftMonitor().fit(text.iloc[shard]))
+
+    assert merged.rows_ == single.rows_
+    assert merged.filtered_ == single.filtered_
+    for col in single.numeric_columns:
+        for key in ('count', 'nulls'):
+            assert merged.numeric_[col][key] == single.numeric_[col][key], col
+    for col in single.categorical_columns:
+        for key in ('count', 'nulls', 'other'):
+            assert merged.categorical_[col][key] == single.categorical_[col][key], col
+        pd.testing.assert_series_equal(merged.categorical_[col]['counts'].sort_index(),
+                                       single.categorical_[col]['counts'].sort_index(), check_names=False)
+    # The merged quantile sketches describe the same records
+    assert drifted_columns(merged.compare(text)) == []
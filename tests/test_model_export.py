@@ -0,0 +1,33 @@
+# The compact NumPy export (philly_house_predictor/model_export.py) has to predict what the original model predicts, within the
+# float summation noise check_equivalence accepts.
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+
+from philly_house_predictor.model_export import check_equivalence, compile_model
+
+
+def _regression(rows=2000, features=8, seed=0):
+    # Zero centred target with a wide spread, so many predictions are near 0 while the leaf values are large
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(rows, features)).astype(np.float32)
+    y = 1e5 * (X[:, 0] + 0.5 * X[:, 1] * X[:, 2]) + rng.normal(0, 1e3, rows)
+    return X, y - y.mean()
+
+
+@pytest.mark.parametrize('make_model', [
+    lambda: RandomForestRegressor(n_estimators=20, random_state=0),
+    lambda: GradientBoostingRegressor(n_estimators=50, random_state=0),
+], ids=['random_forest', 'gradient_boosting'])
+def test_sklearn_export_matches(make_model):
+    X, y = _regression()
+    model = make_model().fit(X, y)
+    assert check_equivalence(model, compile_model(model), X) <= 1e-9
+
+
+def test_xgboost_export_matches_near_zero_predictions():
+    xgboost = pytest.importorskip('xgboost')
+    X, y = _regression()
+    model = xgboost.XGBRegressor(n_estimators=200, max_depth=6, random_state=0).fit(X, y)
+    assert np.min(np.abs(model.predict(X))) < 100
+    assert check_equivalence(model, compile_model(model), X) <= 1e-5